@@ -0,0 +1,327 @@
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform as python_platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from contentpack import compile_pack, load_pack
+from sharding import ShardedPlatform
+from storytelling import (AdaptiveStorytellingPlatform, DEFAULT_MOOD_LEXICON, KnowledgeGraph, Mood,
+                          StoryElement, np)
+
+ELEMENT_TYPES = ['character', 'location', 'item', 'event']
+RELATIONSHIP_TYPES = ['guided_by', 'opposes', 'resides_in', 'owns', 'knows', 'leads_to']
+TAGS = ['heroic', 'mysterious', 'evil', 'powerful', 'ancient', 'funny', 'formal', 'casual',
+        'magical', 'ominous', 'wise', 'clumsy']
+FILLER_WORDS = ['the', 'path', 'slowly', 'towards', 'door', 'we', 'should', 'maybe', 'now', 'again']
+
+OPERATIONS = ['process_user_choice', 'generate_adaptive_content', 'find_elements_by_mood',
+              'get_related_elements', 'recommend_content', 'suggest_branching_paths']
+
+def build_synthetic_world(element_count: int, relationships_per_element: int = 3,
+                          seed: int = 1) -> KnowledgeGraph:
+    rng = random.Random(seed)
+    moods = list(Mood)
+    graph = KnowledgeGraph()
+    with graph.deferred_indexing():
+        # The sample hero is what generate_adaptive_content voices
+        graph.add_element(StoryElement('hero_1', 'character', 'Alex the Brave', ['heroic'],
+                                       {Mood.ADVENTUROUS: 0.8, Mood.TENSE: 0.6}))
+        for index in range(element_count - 1):
+            graph.add_element(StoryElement(
+                f'element_{index}', rng.choice(ELEMENT_TYPES), f'Element {index}', rng.sample(TAGS, 2),
+                {mood: round(rng.uniform(0.1, 1.0), 2) for mood in rng.sample(moods, rng.randint(1, 3))}))
+        element_ids = list(graph.nodes)
+        for from_id in element_ids:
+            for to_id in rng.sample(element_ids, min(relationships_per_element, len(element_ids))):
+                if to_id != from_id:
+                    graph.add_relationship(from_id, to_id, rng.choice(RELATIONSHIP_TYPES))
+    return graph
+
+def synthetic_choice_text(rng: random.Random) -> str:
+    keywords = [keyword for keywords in DEFAULT_MOOD_LEXICON.values() for keyword in keywords]
+    words = rng.sample(FILLER_WORDS, 4) + rng.sample(keywords, rng.randint(0, 3))
+    rng.shuffle(words)
+    return ' '.join(words)
+
+def populate_users(story_platform: AdaptiveStorytellingPlatform, user_count: int,
+                   choices_per_user: int, seed: int = 2) -> List[str]:
+    rng = random.Random(seed)
+    user_ids = [f'user_{index}' for index in range(user_count)]
+    story_platform.process_user_choices([(user_id, synthetic_choice_text(rng), rng.uniform(0.5, 15))
+                                         for _ in range(choices_per_user) for user_id in user_ids])
+    return user_ids
+
+def measure(operation: Callable[[], Any], iterations: int, warmup: int) -> Dict[str, float]:
+    for _ in range(warmup):
+        operation()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter_ns()
+        operation()
+        latencies.append(time.perf_counter_ns() - call_started)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    def percentile(fraction: float) -> float:
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] / 1000
+    return {
+        'iterations': iterations,
+        'mean_us': sum(latencies) / len(latencies) / 1000,
+        'p50_us': percentile(0.50),
+        'p95_us': percentile(0.95),
+        'p99_us': percentile(0.99),
+        'max_us': latencies[-1] / 1000,
+        'throughput_per_s': iterations / elapsed if elapsed else 0.0,
+    }
+
+def process_memory_kb() -> Dict[str, int]:
+    # Private (unshared) pages and proportional set size; Linux only
+    fields = {}
+    try:
+        with open('/proc/self/smaps_rollup') as handle:
+            for line in handle:
+                name, _, value = line.partition(':')
+                if name in ('Private_Clean', 'Private_Dirty', 'Pss'):
+                    fields[name] = int(value.split()[0])
+    except OSError:
+        return {}
+    return {'private_kb': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+            'pss_kb': fields.get('Pss', 0)}
+
+def _startup_worker(factory: Callable[[], AdaptiveStorytellingPlatform], ready, go, results):
+    try:
+        before = process_memory_kb()
+        started = time.perf_counter()
+        story_platform = factory()
+        story_platform.generate_adaptive_content('user_0')
+        cold_start = time.perf_counter() - started
+    except BaseException as error:
+        ready.put(repr(error))
+        raise
+    ready.put(True)
+    # Memory is read once every worker is up, so pages they share count as shared
+    go.wait()
+    after = process_memory_kb()
+    results.put({'cold_start_ms': cold_start * 1000,
+                 **{key: after[key] - before.get(key, 0) for key in after}})
+
+def measure_worker_startup(factory: Callable[[], AdaptiveStorytellingPlatform],
+                           workers: int) -> Optional[Dict[str, float]]:
+    # Cold start (platform built and first content served) and the memory
+    # each freshly forked worker adds, averaged over `workers` running at once.
+    # Workers start one after another so their cold starts do not compete.
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    context = multiprocessing.get_context('fork')
+    ready, results, go = context.SimpleQueue(), context.SimpleQueue(), context.Event()
+    gc.collect()
+    gc.freeze()  # Keeps the workers' collectors from touching every inherited page
+    processes = []
+    try:
+        for _ in range(workers):
+            process = context.Process(target=_startup_worker, args=(factory, ready, go, results), daemon=True)
+            process.start()
+            processes.append(process)
+            message = ready.get()
+            if message is not True:
+                raise RuntimeError(f"startup worker failed: {message}")
+        go.set()
+        measured = [results.get() for _ in processes]
+    finally:
+        go.set()
+        for process in processes:
+            process.join()
+        gc.unfreeze()
+    return {'workers': workers,
+            **{key: sum(result[key] for result in measured) / workers for key in measured[0]}}
+
+def run_startup(element_count: int, args: argparse.Namespace) -> Dict[str, Any]:
+    # Worker startup building the world from scratch, loading it from a
+    # content pack, and forking after the parent loaded the pack
+    def from_scratch():
+        return AdaptiveStorytellingPlatform(knowledge_graph=build_synthetic_world(
+            element_count, args.relationships_per_element, args.seed))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'world.pack')
+        compile_started = time.perf_counter()
+        header = compile_pack(path, from_scratch())
+        results = {'pack_bytes': header['bytes'], 'compile_seconds': time.perf_counter() - compile_started,
+                   'scratch': measure_worker_startup(from_scratch, args.startup_workers),
+                   'content_pack': measure_worker_startup(
+                       lambda: AdaptiveStorytellingPlatform(content_pack=load_pack(path)), args.startup_workers)}
+        pack = load_pack(path)
+        pack.graph
+        results['content_pack_preforked'] = measure_worker_startup(
+            lambda: AdaptiveStorytellingPlatform(content_pack=pack), args.startup_workers)
+
+    if not args.quiet:
+        for name in ('scratch', 'content_pack', 'content_pack_preforked'):
+            stats = results[name]
+            if stats is not None:
+                print(f"  startup {name:<23} cold {stats['cold_start_ms']:>10.1f}ms  "
+                      f"private {stats.get('private_kb', 0):>9,.0f}KB  pss {stats.get('pss_kb', 0):>9,.0f}KB",
+                      file=sys.stderr)
+    return results
+
+def measure_shard_scaling(factory: Callable[[], AdaptiveStorytellingPlatform], worker_counts: List[int],
+                          batches: List[List[Tuple[str, str, float]]]) -> Optional[Dict[str, Dict[str, float]]]:
+    # Choice throughput through ShardedPlatform for each worker count, and its
+    # speedup over the first count. The first batch warms every worker up.
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    results = {}
+    for workers in worker_counts:
+        with ShardedPlatform(workers, factory) as sharded:
+            sharded.process_user_choices(batches[0])
+            started = time.perf_counter()
+            for batch in batches[1:]:
+                sharded.process_user_choices(batch)
+            elapsed = time.perf_counter() - started
+        throughput = sum(len(batch) for batch in batches[1:]) / elapsed if elapsed else 0.0
+        baseline = results[str(worker_counts[0])]['throughput_per_s'] if results else throughput
+        results[str(workers)] = {'throughput_per_s': throughput,
+                                 'speedup': throughput / baseline if baseline else 0.0}
+    return results
+
+def run_size(element_count: int, args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    build_started = time.perf_counter()
+    graph = build_synthetic_world(element_count, args.relationships_per_element, args.seed)
+    build_seconds = time.perf_counter() - build_started
+
+    story_platform = AdaptiveStorytellingPlatform(knowledge_graph=graph)
+    user_ids = populate_users(story_platform, args.users, args.choices_per_user, args.seed + 1)
+    element_ids = list(graph.nodes)
+    moods = list(Mood)
+
+    def random_profile():
+        return story_platform.users[rng.choice(user_ids)]
+
+    operations = {
+        'process_user_choice': lambda: story_platform.process_user_choice(
+            rng.choice(user_ids), synthetic_choice_text(rng), rng.uniform(0.5, 15)),
+        'generate_adaptive_content': lambda: story_platform.generate_adaptive_content(rng.choice(user_ids)),
+        'find_elements_by_mood': lambda: graph.find_elements_by_mood(rng.choice(moods)),
+        'get_related_elements': lambda: graph.get_related_elements(rng.choice(element_ids)),
+        'recommend_content': lambda: story_platform.discovery_agent.recommend_content(random_profile(), {}),
+        'suggest_branching_paths': lambda: story_platform.discovery_agent.suggest_branching_paths(
+            graph.nodes[rng.choice(element_ids)], random_profile()),
+    }
+
+    results = {'build_seconds': build_seconds, 'operations': {}}
+    if args.startup_workers:
+        results['startup'] = run_startup(element_count, args)
+    if args.shard_workers:
+        # Own generator, so the operations below see the same random draws either way
+        shard_rng = random.Random(args.seed + 2)
+        batches = [[(shard_rng.choice(user_ids), synthetic_choice_text(shard_rng), shard_rng.uniform(0.5, 15))
+                    for _ in range(args.shard_batch)] for _ in range(args.shard_batches + 1)]
+        results['sharding'] = measure_shard_scaling(
+            lambda: AdaptiveStorytellingPlatform(knowledge_graph=graph), args.shard_workers, batches)
+        if not args.quiet and results['sharding'] is not None:
+            for workers, stats in results['sharding'].items():
+                print(f"  sharded choices, {workers:>2} workers    {stats['throughput_per_s']:>12,.0f}/s  "
+                      f"speedup {stats['speedup']:>5.2f}x", file=sys.stderr)
+    for name in args.operations:
+        results['operations'][name] = measure(operations[name], args.iterations, args.warmup)
+        if not args.quiet:
+            stats = results['operations'][name]
+            print(f"  {name:<28} p50 {stats['p50_us']:>10.1f}us  p95 {stats['p95_us']:>10.1f}us  "
+                  f"{stats['throughput_per_s']:>12,.0f}/s", file=sys.stderr)
+    return results
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    # A regression is a p50 latency more than `tolerance` above the baseline or
+    # a throughput more than `tolerance` below it
+    regressions = []
+    for size, size_results in current['results'].items():
+        baseline_size = baseline.get('results', {}).get(size)
+        if baseline_size is None:
+            continue
+        for name, stats in size_results['operations'].items():
+            baseline_stats = baseline_size['operations'].get(name)
+            if not baseline_stats or not baseline_stats['p50_us']:
+                continue
+            change = stats['p50_us'] / baseline_stats['p50_us'] - 1
+            if change > tolerance:
+                regressions.append(f"{name} @ {size} elements: p50 {baseline_stats['p50_us']:.1f}us -> "
+                                   f"{stats['p50_us']:.1f}us (+{change:.0%})")
+            if baseline_stats['throughput_per_s']:
+                change = 1 - stats['throughput_per_s'] / baseline_stats['throughput_per_s']
+                if change > tolerance:
+                    regressions.append(f"{name} @ {size} elements: throughput "
+                                       f"{baseline_stats['throughput_per_s']:,.0f}/s -> "
+                                       f"{stats['throughput_per_s']:,.0f}/s (-{change:.0%})")
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the platform hot paths on synthetic worlds')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000],
+                        help='world sizes in elements (up to 10^6)')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--choices-per-user', type=int, default=20)
+    parser.add_argument('--relationships-per-element', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--startup-workers', type=int, default=2,
+                        help='forked workers for the cold start and per-worker memory comparison (0 skips it)')
+    parser.add_argument('--shard-workers', type=int, nargs='*', default=[1, 2, 4],
+                        help='worker counts for the sharded choice throughput sweep (none skips it)')
+    parser.add_argument('--shard-batch', type=int, default=1_000, help='choices per sharded batch')
+    parser.add_argument('--shard-batches', type=int, default=5, help='timed batches per worker count')
+    parser.add_argument('--output', help='write results as JSON here (default: stdout)')
+    parser.add_argument('--compare', metavar='BASELINE', help='flag regressions against a saved result file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p50 slowdown or throughput drop before flagging a regression (0.2 = 20%%)')
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': python_platform.python_version(),
+            'machine': python_platform.platform(),
+            'numpy': np.__version__ if np is not None else None,
+            'users': args.users,
+            'choices_per_user': args.choices_per_user,
+            'iterations': args.iterations,
+            'seed': args.seed,
+        },
+        'results': {},
+    }
+    for size in args.sizes:
+        if not args.quiet:
+            print(f"World with {size:,} elements", file=sys.stderr)
+        report['results'][str(size)] = run_size(size, args)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            regressions = compare(report, json.load(handle), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.compare}", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
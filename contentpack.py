@@ -0,0 +1,199 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from storytelling import (AdaptiveStorytellingPlatform, CompiledTemplate, KnowledgeGraph, Mood, MoodAnalyzer,
+                          StoryElement, np)
+
+# Layout: a fixed header, UTF-8 JSON metadata (the agents' tables, the
+# compiled mood analyzer and the world's elements and relationships), then
+# the world's mood weights as little-endian float64 rows, one per element in
+# element order with one column per mood, starting on a page boundary so the
+# recommendation matrix can be used straight from the mapping.
+MAGIC = b'STRYPACK'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sII4Q')  # magic, format version, moods, metadata offset/length, weights offset/length
+ALIGNMENT = mmap.PAGESIZE
+
+class ContentPackError(ValueError):
+    pass
+
+def compile_pack(path: str, platform: AdaptiveStorytellingPlatform = None,
+                 pack_version: str = None) -> Dict[str, Any]:
+    # Freezes `platform`'s static content (a default platform, i.e. the
+    # built-in tables and sample world, if omitted). Written atomically, so
+    # processes that still map an older pack keep reading it. Returns the
+    # header fields.
+    platform = platform or AdaptiveStorytellingPlatform()
+    graph = platform.knowledge_graph
+    elements = list(graph.nodes.values())
+    weights = array('d')
+    for element in elements:
+        weights.extend(element.weights)
+    if sys.byteorder == 'big':
+        weights.byteswap()
+    weights = weights.tobytes()
+
+    metadata = {
+        'moods': [mood.value for mood in Mood],
+        'templates': {element_type: [template.to_state() for template in templates]
+                      for element_type, templates in platform.narrative_agent.compiled_templates.items()},
+        'dialogue_styles': {mood.value: style for mood, style in platform.dialogue_agent.dialogue_styles.items()},
+        'style_mappings': {mood.value: style for mood, style in platform.visual_agent.style_mappings.items()},
+        'mood_analyzer': platform.mood_analyzer.to_state(),
+        'elements': [[element.element_id, element.element_type, element.content, list(element.tags),
+                      element.usage_count, element.zero_moods] for element in elements],
+        'relationships': [[from_id, to_id, relationship_type]
+                          for (from_id, to_id), relationship_type in graph.relationships.items()],
+    }
+    digest = hashlib.sha256(json.dumps(metadata, sort_keys=True).encode('utf-8'))
+    digest.update(weights)
+    metadata['pack_version'] = pack_version or digest.hexdigest()[:16]
+    metadata['created'] = datetime.now().isoformat(timespec='seconds')
+    encoded = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+
+    metadata_offset = HEADER.size
+    weights_offset = -(-(metadata_offset + len(encoded)) // ALIGNMENT) * ALIGNMENT
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as handle:
+        handle.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(Mood), metadata_offset, len(encoded),
+                                 weights_offset, len(weights)))
+        handle.write(encoded)
+        handle.write(bytes(weights_offset - metadata_offset - len(encoded)))
+        handle.write(weights)
+    os.replace(temporary, path)
+    return {'pack_version': metadata['pack_version'], 'format_version': FORMAT_VERSION,
+            'elements': len(elements), 'relationships': len(metadata['relationships']),
+            'bytes': weights_offset + len(weights)}
+
+class ContentPack:
+    # A compiled pack mapped read-only. The tables are decoded once here and
+    # shared by every platform built on this pack; the world graph is built
+    # on first use, frozen, and reads its weight matrix from the mapping, so
+    # forked workers share those pages instead of holding a copy each.
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as handle:
+            try:
+                self.mapping = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ContentPackError(f"{path}: empty file")
+        if len(self.mapping) < HEADER.size:
+            raise ContentPackError(f"{path}: truncated header")
+        (magic, format_version, mood_count, metadata_offset, metadata_length,
+         self.weights_offset, weights_length) = HEADER.unpack_from(self.mapping)
+        if magic != MAGIC:
+            raise ContentPackError(f"{path}: not a content pack")
+        if format_version != FORMAT_VERSION:
+            raise ContentPackError(f"{path}: format version {format_version}, expected {FORMAT_VERSION}; recompile it")
+        if max(metadata_offset + metadata_length, self.weights_offset + weights_length) > len(self.mapping):
+            raise ContentPackError(f"{path}: truncated")
+        try:
+            metadata = json.loads(self.mapping[metadata_offset:metadata_offset + metadata_length])
+        except ValueError as error:
+            raise ContentPackError(f"{path}: unreadable metadata: {error}")
+        if metadata['moods'] != [mood.value for mood in Mood]:
+            raise ContentPackError(f"{path}: compiled for moods {metadata['moods']}; recompile it")
+        if weights_length != 8 * mood_count * len(metadata['elements']):
+            raise ContentPackError(f"{path}: weights section does not match {len(metadata['elements'])} elements")
+
+        self.pack_version = metadata['pack_version']
+        self.created = metadata['created']
+        self.compiled_templates = {element_type: [CompiledTemplate.from_state(state) for state in templates]
+                                   for element_type, templates in metadata['templates'].items()}
+        self.dialogue_styles = {Mood(mood): style for mood, style in metadata['dialogue_styles'].items()}
+        self.style_mappings = {Mood(mood): style for mood, style in metadata['style_mappings'].items()}
+        self.mood_analyzer = MoodAnalyzer.from_state(metadata['mood_analyzer'])
+        self.element_records = metadata['elements']
+        self.relationship_records = metadata['relationships']
+        self._graph: Optional[KnowledgeGraph] = None
+        self._lock = threading.Lock()
+
+    @property
+    def graph(self) -> KnowledgeGraph:
+        with self._lock:
+            if self._graph is None:
+                self._graph = self._build_graph()
+                self.element_records = self.relationship_records = None  # Now held by the graph
+            return self._graph
+
+    def _build_graph(self) -> KnowledgeGraph:
+        row_size = 8 * len(Mood)
+        mapping, offset = self.mapping, self.weights_offset
+        graph = KnowledgeGraph()
+        with graph.deferred_indexing():
+            # Packs written before explicit zero weights were kept have no zero_moods field
+            for row, (element_id, element_type, content, tags, usage_count, *zero_moods) in enumerate(
+                    self.element_records):
+                element = StoryElement(element_id, element_type, content, tags)
+                element.zero_moods = zero_moods[0] if zero_moods else 0
+                element.weights = array('d')
+                element.weights.frombytes(mapping[offset + row * row_size:offset + (row + 1) * row_size])
+                if sys.byteorder == 'big':
+                    element.weights.byteswap()
+                element.usage_count = usage_count
+                graph.add_element(element)
+            for from_id, to_id, relationship_type in self.relationship_records:
+                graph.add_relationship(from_id, to_id, relationship_type)
+        if np is not None:
+            # Read-only rows straight from the mapping; a frozen graph never writes them
+            graph.mood_matrix = np.frombuffer(mapping, dtype='<f8', count=len(self.element_records) * len(Mood),
+                                              offset=offset).reshape(-1, len(Mood))
+        return graph.freeze()
+
+_PACKS = {}  # real path -> ((mtime, size), ContentPack)
+_PACKS_LOCK = threading.Lock()
+
+def load_pack(path: str) -> ContentPack:
+    # One ContentPack per file per process; a pack replaced on disk is
+    # loaded again on the next call
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _PACKS_LOCK:
+        cached = _PACKS.get(path)
+        if cached is None or cached[0] != key:
+            cached = _PACKS[path] = (key, ContentPack(path))
+        return cached[1]
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Compile and inspect precompiled content packs')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    compile_command = commands.add_parser('compile', help='compile the built-in content, or a world file, into a pack')
+    compile_command.add_argument('path')
+    compile_command.add_argument('--world', help='JSONL/CSV world to pack instead of the sample world (see worldio.py)')
+    compile_command.add_argument('--pack-version', help='version label (default: a content hash)')
+
+    info = commands.add_parser('info', help='describe a pack')
+    info.add_argument('path')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compile':
+        platform = None
+        if args.world:
+            from worldio import load_world
+            platform = AdaptiveStorytellingPlatform(knowledge_graph=load_world(args.world)[0])
+        header = compile_pack(args.path, platform, args.pack_version)
+        print(f"Wrote pack {header['pack_version']} with {header['elements']} elements and "
+              f"{header['relationships']} relationships to {args.path} ({header['bytes']:,} bytes)")
+        return
+
+    started = time.perf_counter()
+    pack = ContentPack(args.path)
+    graph = pack.graph
+    print(f"Pack {pack.pack_version} (format {FORMAT_VERSION}, created {pack.created}): "
+          f"{len(graph.nodes)} elements, {len(graph.relationships)} relationships, "
+          f"loaded in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+if __name__ == "__main__":
+    main()
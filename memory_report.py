@@ -0,0 +1,72 @@
+import argparse
+import gc
+import random
+import tracemalloc
+from typing import Callable, Dict, List
+
+from storytelling import Mood, StoryElement
+
+ELEMENT_TYPES = ['character', 'location', 'item']
+TAG_POOL = ['heroic', 'mysterious', 'evil', 'powerful', 'ancient', 'funny', 'formal', 'casual',
+            'magical', 'ominous', 'wise', 'clumsy', 'alluring', 'determined']
+
+class LegacyStoryElement:
+    # The original dict-backed representation, kept only for comparison
+    def __init__(self, element_id: str, element_type: str, content: str,
+                 tags: List[str] = None, mood_weights: Dict[Mood, float] = None):
+        self.element_id = element_id
+        self.element_type = element_type
+        self.content = content
+        self.tags = tags or []
+        self.mood_weights = mood_weights or {}
+        self.usage_count = 0
+        self.relationships = {}
+
+def synthetic_element_specs(count: int, seed: int = 7) -> List[tuple]:
+    rng = random.Random(seed)
+    moods = list(Mood)
+    return [(f"element_{index}", rng.choice(ELEMENT_TYPES), f"Element {index}",
+             rng.sample(TAG_POOL, 2), {mood: round(rng.random(), 2) for mood in rng.sample(moods, 2)})
+            for index in range(count)]
+
+def bytes_per_element(factory: Callable, specs: List[tuple]) -> float:
+    # Strings and tag/weight inputs are allocated before tracing starts, so only
+    # the per-element structure is measured
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    elements = [factory(element_id, element_type, content, list(tags), dict(weights))
+                for element_id, element_type, content, tags, weights in specs]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # The list holding the elements is not part of their cost
+    list_overhead = 56 + 8 * len(elements)
+    del elements
+    return (after - before - list_overhead) / len(specs)
+
+def element_memory_report(count: int = 100_000) -> Dict[str, float]:
+    specs = synthetic_element_specs(count)
+    # Warm the tag table so interning cost is not billed to the first run
+    StoryElement('warmup', 'item', '', TAG_POOL, {})
+    legacy = bytes_per_element(LegacyStoryElement, specs)
+    compact = bytes_per_element(StoryElement, specs)
+    return {
+        'elements': count,
+        'legacy_bytes_per_element': round(legacy, 1),
+        'compact_bytes_per_element': round(compact, 1),
+        'saving_ratio': round(legacy / compact, 2) if compact else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-element memory of StoryElement representations')
+    parser.add_argument('--elements', type=int, default=100_000)
+    args = parser.parse_args()
+
+    report = element_memory_report(args.elements)
+    print(f"StoryElement memory over {report['elements']:,} synthetic elements")
+    print(f"  dict-backed (before): {report['legacy_bytes_per_element']:>8.1f} bytes/element")
+    print(f"  slotted (after):      {report['compact_bytes_per_element']:>8.1f} bytes/element")
+    print(f"  reduction:            {report['saving_ratio']:>8.2f}x")
+
+if __name__ == "__main__":
+    main()
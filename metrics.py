@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from storytelling import Instrumentation
+
+# Latency bucket upper bounds in seconds, 10us to 1s
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+METRIC_PREFIX = 'storytelling'
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction: float) -> float:
+        # Upper bound of the bucket holding the quantile; inf past the last bucket
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.quantile(0.50),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.counts)),
+        }
+
+class Span:
+    __slots__ = ('recorder', 'kind', 'name', 'started')
+
+    def __init__(self, recorder: 'MetricsRecorder', kind: str, name: str):
+        self.recorder = recorder
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self) -> 'Span':
+        self.started = time.perf_counter()
+        if self.kind == 'request' and self.recorder.trace:
+            self.recorder._begin_trace(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        finished = time.perf_counter()
+        self.recorder._finish(self, finished)
+
+class MetricsRecorder(Instrumentation):
+    # Per-stage and per-request latency histograms plus counters. With
+    # `trace=True` each request also keeps a span list (stage, start offset,
+    # duration), and the last `max_traces` requests are retained.
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, trace: bool = False,
+                 max_traces: int = 100):
+        self.buckets = buckets
+        self.trace = trace
+        self.stages: Dict[str, Histogram] = {}
+        self.requests: Dict[str, Histogram] = {}
+        self.counters: Dict[str, int] = {}
+        self.traces: Deque[Dict[str, Any]] = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+        self._active = threading.local()
+
+    def request(self, name: str) -> Span:
+        return Span(self, 'request', name)
+
+    def stage(self, name: str) -> Span:
+        return Span(self, 'stage', name)
+
+    def increment(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def _begin_trace(self, span: Span):
+        self._active.trace = {'request': span.name, 'started': time.time(), 'spans': []}
+        self._active.origin = span.started
+
+    def _finish(self, span: Span, finished: float):
+        elapsed = finished - span.started
+        histograms = self.requests if span.kind == 'request' else self.stages
+        with self._lock:
+            histogram = histograms.get(span.name)
+            if histogram is None:
+                histogram = histograms[span.name] = Histogram(self.buckets)
+            histogram.observe(elapsed)
+
+        trace = getattr(self._active, 'trace', None) if self.trace else None
+        if trace is None:
+            return
+        if span.kind == 'stage':
+            trace['spans'].append({'stage': span.name, 'offset': span.started - self._active.origin,
+                                   'seconds': elapsed})
+        else:
+            trace['seconds'] = elapsed
+            self._active.trace = None
+            with self._lock:
+                self.traces.append(trace)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'stages': {name: histogram.snapshot() for name, histogram in self.stages.items()},
+                'requests': {name: histogram.snapshot() for name, histogram in self.requests.items()},
+                'traces': list(self.traces),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.requests.clear()
+            self.counters.clear()
+            self.traces.clear()
+
+    def prometheus_text(self) -> str:
+        with self._lock:
+            lines = []
+            self._histogram_lines(lines, 'stage_seconds', 'Latency of each platform stage',
+                                  'stage', self.stages)
+            self._histogram_lines(lines, 'request_seconds', 'Latency of each platform call',
+                                  'operation', self.requests)
+            for name in sorted(self.counters):
+                metric = f'{METRIC_PREFIX}_{name}_total'
+                lines.append(f'# TYPE {metric} counter')
+                lines.append(f'{metric} {self.counters[name]}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str):
+        # Written atomically so a scraper (e.g. node_exporter's textfile
+        # collector) never sees a partial file
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as handle:
+            handle.write(self.prometheus_text())
+        os.replace(temporary, path)
+
+    def _histogram_lines(self, lines: List[str], suffix: str, description: str, label: str,
+                         histograms: Dict[str, Histogram]):
+        if not histograms:
+            return
+        metric = f'{METRIC_PREFIX}_{suffix}'
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} histogram')
+        for name in sorted(histograms):
+            histogram = histograms[name]
+            cumulative = 0
+            for bound, count in zip([*map(repr, histogram.buckets), '+Inf'], histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.sum!r}')
+            lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+
+class PeriodicDump:
+    # Rewrites the Prometheus text file every `interval` seconds on a daemon thread
+    def __init__(self, recorder: MetricsRecorder, path: str, interval: float = 10.0):
+        self.recorder = recorder
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'PeriodicDump':
+        self._thread = threading.Thread(target=self._run, name='storytelling-metrics-dump', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.recorder.dump(self.path)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.recorder.dump(self.path)
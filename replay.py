@@ -0,0 +1,142 @@
+import argparse
+import json
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from storytelling import AdaptiveStorytellingPlatform, DEFAULT_MOOD_LEXICON, Mood, UserChoice
+from worldio import WorldFormatError, parse_mood
+
+# One JSON object per line: UserChoice.to_state() plus the user_id, e.g.
+# {"user_id": "u1", "choice_id": "...", "choice_text": "...", "timestamp": "2024-05-01T12:00:00",
+#  "response_time": 2.5, "mood_impact": {"mysterious": 0.2}}
+# timestamp may also be a Unix epoch number; choice_id and mood_impact are optional.
+
+class ReplayFormatError(ValueError):
+    pass
+
+@dataclass
+class ReplayReport:
+    events: int = 0
+    users: int = 0
+    seconds: float = 0.0
+
+    @property
+    def events_per_second(self) -> float:
+        return self.events / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        return (f"Replayed {self.events} choices for {self.users} users in {self.seconds:.2f}s "
+                f"({self.events_per_second:,.0f} choices/s)")
+
+def parse_timestamp(value: Any, location: str) -> Optional[datetime]:
+    if value is None:
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value)
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise ReplayFormatError(f"{location}: invalid timestamp {value!r}")
+
+def iter_choice_events(path: str) -> Iterator[Tuple[str, UserChoice]]:
+    # Streams (user_id, UserChoice) pairs; missing choice ids are numbered by line
+    with open(path, encoding='utf-8') as handle:
+        for line_number, line in enumerate(handle, 1):
+            if not line.strip():
+                continue
+            location = f"{path}:{line_number}"
+            try:
+                record = json.loads(line)
+                yield record['user_id'], UserChoice(
+                    choice_id=record.get('choice_id') or f"{path}:{line_number}",
+                    choice_text=record['choice_text'],
+                    timestamp=parse_timestamp(record.get('timestamp'), location),
+                    response_time=float(record['response_time']),
+                    mood_impact={parse_mood(mood, location): float(impact)
+                                 for mood, impact in (record.get('mood_impact') or {}).items()})
+            except ReplayFormatError:
+                raise
+            except WorldFormatError as error:
+                raise ReplayFormatError(str(error))
+            except KeyError as error:
+                raise ReplayFormatError(f"{location}: choice is missing {error}")
+            except (TypeError, ValueError) as error:
+                raise ReplayFormatError(f"{location}: {error}")
+
+def replay(path: str, platform: AdaptiveStorytellingPlatform, reanalyze: bool = False,
+           chunk_size: int = 10000) -> Tuple[Dict[str, Mood], ReplayReport]:
+    report = ReplayReport()
+    started = time.perf_counter()
+
+    def counted(events):
+        for event in events:
+            report.events += 1
+            yield event
+
+    final_moods = platform.process_choices_batch(counted(iter_choice_events(path)), reanalyze, chunk_size)
+    if platform.storage is not None:
+        platform.storage.flush()
+    report.users = len(final_moods)
+    report.seconds = time.perf_counter() - started
+    return final_moods, report
+
+def write_synthetic_log(path: str, events: int, users: int, seed: int = 1) -> int:
+    # A plausible archive for load testing: keyword-bearing choices at
+    # increasing timestamps, one line per choice
+    rng = random.Random(seed)
+    keywords = [keyword for keywords in DEFAULT_MOOD_LEXICON.values() for keyword in keywords]
+    filler = ['the', 'path', 'slowly', 'towards', 'door', 'we', 'should', 'maybe', 'now', 'again']
+    timestamp = datetime(2024, 1, 1)
+    with open(path, 'w', encoding='utf-8') as handle:
+        for index in range(events):
+            timestamp += timedelta(seconds=rng.uniform(0, 2))
+            words = rng.sample(filler, 3) + rng.sample(keywords, rng.randint(0, 2))
+            handle.write(json.dumps({
+                'user_id': f"user_{rng.randrange(users)}",
+                'choice_id': f"choice_{index}",
+                'choice_text': ' '.join(words),
+                'timestamp': timestamp.isoformat(),
+                'response_time': round(rng.uniform(0.5, 15), 2),
+            }) + '\n')
+    return events
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Rebuild user profiles from archived choice logs')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='replay a JSONL choice log')
+    run.add_argument('path')
+    run.add_argument('--db', help='replay into this SQLite store (see storage.py) instead of memory')
+    run.add_argument('--reanalyze', action='store_true',
+                     help='recompute mood impacts even when the log already has them')
+    run.add_argument('--chunk-size', type=int, default=10000)
+
+    generate = commands.add_parser('generate', help='write a synthetic choice log')
+    generate.add_argument('path')
+    generate.add_argument('--events', type=int, default=1_000_000)
+    generate.add_argument('--users', type=int, default=10_000)
+    generate.add_argument('--seed', type=int, default=1)
+
+    args = parser.parse_args(argv)
+    if args.command == 'generate':
+        write_synthetic_log(args.path, args.events, args.users, args.seed)
+        print(f"Wrote {args.events} choices for up to {args.users} users to {args.path}")
+        return
+
+    store = None
+    if args.db:
+        from storage import SQLiteStore
+        store = SQLiteStore(args.db)
+    try:
+        platform = AdaptiveStorytellingPlatform(storage=store)
+        _, report = replay(args.path, platform, args.reanalyze, args.chunk_size)
+        print(report.summary())
+    finally:
+        if store is not None:
+            store.close()
+
+if __name__ == "__main__":
+    main()
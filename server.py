@@ -0,0 +1,444 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+from metrics import MetricsRecorder, PeriodicDump
+from storytelling import AdaptiveStorytellingPlatform, PregenerationConfig
+from wire import WireEncoder
+
+STATIC_FILES = {
+    '/': ('index.html', 'text/html; charset=utf-8'),
+    '/index.html': ('index.html', 'text/html; charset=utf-8'),
+    '/styles.css': ('styles.css', 'text/css; charset=utf-8'),
+}
+
+logger = logging.getLogger(__name__)
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable',
+           504: 'Gateway Timeout'}
+
+class Overloaded(Exception):
+    pass
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+@dataclass
+class ServerConfig:
+    host: str = '127.0.0.1'
+    port: int = 8000
+    max_batch_size: int = 64  # Requests handed to the platform in one call
+    max_batch_delay: float = 0.005  # Seconds to wait for a batch to fill up
+    max_pending: int = 1024  # Queued requests per endpoint before answering 503
+    request_timeout: float = 2.0  # Seconds before a request is answered with 504
+    max_body_size: int = 64 * 1024
+    profile_flush_interval: float = 30.0  # Seconds between write-backs of a spilling profile store
+
+class MicroBatcher:
+    def __init__(self, handler: Callable[[List[Any]], List[Any]], executor: ThreadPoolExecutor,
+                 max_batch_size: int, max_batch_delay: float, max_pending: int):
+        self.handler = handler
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.queue = asyncio.Queue(maxsize=max_pending)
+
+    async def submit(self, item: Any) -> Any:
+        if self.queue.full():
+            raise Overloaded()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((item, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.queue.qsize() < self.max_batch_size - 1:
+                # Give concurrent requests a moment to join this batch
+                await asyncio.sleep(self.max_batch_delay)
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            # Requests that already timed out are not worth computing
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            try:
+                results = await loop.run_in_executor(self.executor, self.handler, [item for item, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+class StoryServer:
+    def __init__(self, platform: AdaptiveStorytellingPlatform = None, config: ServerConfig = None):
+        self.platform = platform or AdaptiveStorytellingPlatform(instrumentation=MetricsRecorder())
+        self.config = config or ServerConfig()
+        self.wire = WireEncoder(self.platform)
+        # The platform is not thread-safe: one worker thread owns it, which also
+        # keeps each user's choices in arrival order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storytelling')
+        if self.platform.pregenerator is not None:
+            # Speculative renders run on that thread too, between batches
+            self.platform.pregenerator.executor = self.executor
+        self.static_root = os.path.dirname(os.path.abspath(__file__))
+        self.choice_batcher = None
+        self.content_batcher = None
+        self.open_streams = 0  # Counted against max_pending like a batcher's queue
+        self._tasks = []
+
+    async def start(self) -> asyncio.AbstractServer:
+        config = self.config
+        self.choice_batcher = MicroBatcher(self._process_choices, self.executor,
+                                           config.max_batch_size, config.max_batch_delay, config.max_pending)
+        self.content_batcher = MicroBatcher(self._generate_contents, self.executor,
+                                            config.max_batch_size, config.max_batch_delay, config.max_pending)
+        self._tasks = [asyncio.create_task(self.choice_batcher.run()),
+                       asyncio.create_task(self.content_batcher.run())]
+        if hasattr(self.platform.users, 'flush'):
+            self._tasks.append(asyncio.create_task(self._flush_profiles_periodically()))
+        return await asyncio.start_server(self.handle_connection, config.host, config.port)
+
+    async def close(self):
+        # Stops the background tasks, then writes back changed profiles on the
+        # platform thread before releasing it
+        for task in self._tasks:
+            task.cancel()
+        if self.platform.pregenerator is not None:
+            self.platform.pregenerator.close()
+        if hasattr(self.platform.users, 'flush'):
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._flush_profiles)
+        self.executor.shutdown(wait=True)
+
+    # Batch handlers run on the worker thread and return encoded bodies. Each
+    # request carries the preference version its client last acknowledged.
+    # Choice results are encoded as they are produced, so each one captures the
+    # profile as of that choice.
+    def _process_choices(self, requests: List[Tuple[str, str, float, Optional[int]]]) -> List[bytes]:
+        results = self.platform.iter_user_choices([request[:3] for request in requests])
+        return [self.wire.choice_result(result, request[3]) for request, result in zip(requests, results)]
+
+    def _generate_contents(self, requests: List[Tuple[str, Dict[str, Any], Optional[int]]]) -> List[bytes]:
+        contents = self.platform.generate_adaptive_contents([request[:2] for request in requests])
+        users = self.platform.users
+        return [self.wire.content(content, users[user_id], ack)
+                for (user_id, _, ack), content in zip(requests, contents)]
+
+    async def serve_forever(self):
+        server = await self.start()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.close()
+
+    async def _flush_profiles_periodically(self):
+        # A spilled profile that is still referenced can change after its
+        # spill; only a flush writes those changes back
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.config.profile_flush_interval)
+            await loop.run_in_executor(self.executor, self._flush_profiles)
+
+    def _flush_profiles(self):
+        # On the platform thread, which is the one changing the profiles
+        users = self.platform.users
+        if hasattr(users, 'evict_idle'):
+            users.evict_idle()
+        users.flush()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, content_type, payload = await self._dispatch(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if isinstance(payload, bytes):
+                    self._write_response(writer, status, content_type, payload, keep_alive)
+                    await writer.drain()
+                else:
+                    try:
+                        await self._write_stream(writer, content_type, payload, keep_alive)
+                    finally:
+                        self.open_streams -= 1  # Taken by _dispatch
+                if not keep_alive:
+                    break
+        except HTTPError as error:
+            self._write_response(writer, error.status, 'application/json',
+                                 json.dumps({'error': error.message}).encode(), False)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise HTTPError(400, 'malformed request line')
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            raise HTTPError(400, 'invalid Content-Length')
+        if length < 0:
+            raise HTTPError(400, 'invalid Content-Length')
+        if length > self.config.max_body_size:
+            raise HTTPError(413, 'request body too large')
+        body = await reader.readexactly(length) if length else b''
+        return method.upper(), urlsplit(target).path, headers, body
+
+    async def _dispatch(self, method: str, path: str, 
+                        body: bytes) -> Tuple[int, str, Union[bytes, AsyncIterator[bytes]]]:
+        try:
+            if path in STATIC_FILES:
+                if method != 'GET':
+                    raise HTTPError(405, 'use GET')
+                return self._static_file(path)
+            if path == '/health':
+                return 200, 'application/json', b'{"status":"ok"}'
+            if path in ('/metrics', '/metrics.json'):
+                return self._metrics(method, path)
+            if path == '/choice':
+                user_id, request = self._parse_json(method, body)
+                item = (user_id, self._choice_text(request), self._response_time(request), self._ack(request))
+                result = await self._submit(self.choice_batcher, item)
+            elif path == '/content':
+                user_id, request = self._parse_json(method, body)
+                result = await self._submit(self.content_batcher,
+                                            (user_id, self._context(request), self._ack(request)))
+            elif path == '/content/stream':
+                user_id, request = self._parse_json(method, body)
+                context, ack = self._context(request), self._ack(request)
+                if self.open_streams >= self.config.max_pending:
+                    raise HTTPError(503, 'server is overloaded, retry later')
+                self.open_streams += 1
+                return 200, 'application/x-ndjson', self._stream_content(user_id, context, ack)
+            else:
+                raise HTTPError(404, f'no route for {path}')
+        except HTTPError as error:
+            return error.status, 'application/json', json.dumps({'error': error.message}).encode()
+        except Exception as error:
+            # Request bodies are validated above, so anything else is a server bug
+            logger.exception('%s %s failed', method, path)
+            return 500, 'application/json', json.dumps({'error': repr(error)}).encode()
+
+        return 200, 'application/json', result
+
+    async def _submit(self, batcher: MicroBatcher, item: Any) -> Any:
+        try:
+            return await asyncio.wait_for(batcher.submit(item), self.config.request_timeout)
+        except Overloaded:
+            raise HTTPError(503, 'server is overloaded, retry later')
+        except asyncio.TimeoutError:
+            # A batch already handed to the platform still completes; only the
+            # response is abandoned
+            raise HTTPError(504, 'request timed out')
+
+    async def _stream_content(self, user_id: str, context: Dict[str, Any],
+                              ack: Optional[int]) -> AsyncIterator[bytes]:
+        # One NDJSON line per part, in the order the platform produces them.
+        # Streams bypass the micro-batcher but still run on the platform thread;
+        # each part gets request_timeout seconds, and a late one ends the stream.
+        timeout = self.config.request_timeout
+        parts = self.platform.aiter_adaptive_content(user_id, context, self.executor)
+        try:
+            while True:
+                try:
+                    part, value = await asyncio.wait_for(parts.__anext__(), timeout)
+                except StopAsyncIteration:
+                    break
+                if part == 'user_preferences':
+                    # Reads the live profile, so it is encoded on the platform thread
+                    yield await asyncio.wait_for(asyncio.wrap_future(self.executor.submit(
+                        lambda: self.wire.part(part, value, self.platform.users[user_id], ack))), timeout)
+                else:
+                    yield self.wire.part(part, value, None, ack)
+        except asyncio.TimeoutError:
+            # Headers are already sent, so failures are reported in-band
+            yield json.dumps({'error': 'request timed out', 'status': 504}).encode() + b'\n'
+        except Exception as error:
+            # Headers are already sent, so failures are reported in-band
+            logger.exception('content stream for %s failed', user_id)
+            yield json.dumps({'error': repr(error), 'status': 500}).encode() + b'\n'
+        finally:
+            await parts.aclose()
+
+    # Request fields are checked here, so a malformed body is answered with 400
+    # before anything reaches the platform thread
+    def _ack(self, request: Dict[str, Any]) -> Optional[int]:
+        # Preference version the client already has, if any
+        ack = request.get('ack')
+        if ack is not None and (not isinstance(ack, int) or isinstance(ack, bool)):
+            raise HTTPError(400, 'ack must be an integer')
+        return ack
+
+    def _choice_text(self, request: Dict[str, Any]) -> str:
+        choice_text = request.get('choice_text', '')
+        if not isinstance(choice_text, str):
+            raise HTTPError(400, 'choice_text must be a string')
+        return choice_text
+
+    def _response_time(self, request: Dict[str, Any]) -> float:
+        response_time = request.get('response_time', 0.0)
+        if (not isinstance(response_time, (int, float)) or isinstance(response_time, bool)
+                or not math.isfinite(response_time) or response_time < 0):
+            raise HTTPError(400, 'response_time must be a non-negative number of seconds')
+        return float(response_time)
+
+    def _context(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        context = request.get('context')
+        if context is None:
+            return {}
+        if not isinstance(context, dict):
+            raise HTTPError(400, 'context must be an object')
+        return context
+
+    def _parse_json(self, method: str, body: bytes) -> Tuple[str, Dict[str, Any]]:
+        if method != 'POST':
+            raise HTTPError(405, 'use POST')
+        try:
+            request = json.loads(body or b'{}')
+        except json.JSONDecodeError as error:
+            raise HTTPError(400, f'invalid JSON: {error}')
+        if not isinstance(request, dict) or not request.get('user_id'):
+            raise HTTPError(400, 'user_id is required')
+        user_id = request['user_id']
+        if not isinstance(user_id, (str, int)) or isinstance(user_id, bool):
+            raise HTTPError(400, 'user_id must be a string')
+        return str(user_id), request
+
+    def _metrics(self, method: str, path: str) -> Tuple[int, str, bytes]:
+        if method != 'GET':
+            raise HTTPError(405, 'use GET')
+        recorder = self.platform.instrumentation
+        if not isinstance(recorder, MetricsRecorder):
+            raise HTTPError(404, 'metrics are not enabled for this platform')
+        if path == '/metrics.json':
+            snapshot = recorder.snapshot()
+            if hasattr(self.platform.users, 'stats'):
+                snapshot['profiles'] = self.platform.users.stats()
+            return 200, 'application/json', json.dumps(snapshot).encode()
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', recorder.prometheus_text().encode()
+
+    def _static_file(self, path: str) -> Tuple[int, str, bytes]:
+        filename, content_type = STATIC_FILES[path]
+        with open(os.path.join(self.static_root, filename), 'rb') as handle:
+            return 200, content_type, handle.read()
+
+    def _write_response(self, writer: asyncio.StreamWriter, status: int, content_type: str,
+                        payload: bytes, keep_alive: bool):
+        headers = [
+            f'HTTP/1.1 {status} {REASONS.get(status, "")}',
+            f'Content-Type: {content_type}',
+            f'Content-Length: {len(payload)}',
+            f'Connection: {"keep-alive" if keep_alive else "close"}',
+        ]
+        if status == 503:
+            headers.append('Retry-After: 1')
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + payload)
+
+    async def _write_stream(self, writer: asyncio.StreamWriter, content_type: str,
+                            chunks: AsyncIterator[bytes], keep_alive: bool):
+        # Chunked transfer encoding; each chunk is flushed as soon as it is
+        # produced. A client that goes away closes the stream, which stops the
+        # remaining generation work.
+        headers = [
+            'HTTP/1.1 200 OK',
+            f'Content-Type: {content_type}',
+            'Transfer-Encoding: chunked',
+            f'Connection: {"keep-alive" if keep_alive else "close"}',
+        ]
+        try:
+            writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'))
+            async for chunk in chunks:
+                writer.write(f'{len(chunk):x}\r\n'.encode('latin-1') + chunk + b'\r\n')
+                await writer.drain()
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            await chunks.aclose()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the Adaptive Storytelling Platform over local HTTP')
+    parser.add_argument('--host', default=ServerConfig.host)
+    parser.add_argument('--port', type=int, default=ServerConfig.port)
+    parser.add_argument('--max-batch-size', type=int, default=ServerConfig.max_batch_size)
+    parser.add_argument('--max-batch-delay', type=float, default=ServerConfig.max_batch_delay)
+    parser.add_argument('--max-pending', type=int, default=ServerConfig.max_pending)
+    parser.add_argument('--request-timeout', type=float, default=ServerConfig.request_timeout)
+    parser.add_argument('--trace', action='store_true', help='keep per-request stage traces in /metrics.json')
+    parser.add_argument('--metrics-file', help='also write Prometheus metrics to this file periodically')
+    parser.add_argument('--metrics-interval', type=float, default=10.0)
+    parser.add_argument('--pregenerate-moods', type=int, default=0,
+                        help='render content for this many likely next moods per user in the background')
+    parser.add_argument('--profile-spill', metavar='PATH',
+                        help='keep at most --max-resident-profiles user profiles in memory and spill the rest here')
+    parser.add_argument('--max-resident-profiles', type=int, default=10000)
+    parser.add_argument('--profile-idle-seconds', type=float,
+                        help='also spill profiles untouched for this long')
+    parser.add_argument('--profile-flush-interval', type=float, default=ServerConfig.profile_flush_interval,
+                        help='seconds between write-backs of spilled profiles changed since their spill')
+    parser.add_argument('--history-limit', type=int,
+                        help='keep only this many recent choices per profile in memory')
+    args = parser.parse_args()
+
+    config = ServerConfig(host=args.host, port=args.port, max_batch_size=args.max_batch_size,
+                          max_batch_delay=args.max_batch_delay, max_pending=args.max_pending,
+                          request_timeout=args.request_timeout,
+                          profile_flush_interval=args.profile_flush_interval)
+    recorder = MetricsRecorder(trace=args.trace)
+    dump = PeriodicDump(recorder, args.metrics_file, args.metrics_interval).start() if args.metrics_file else None
+    pregeneration = PregenerationConfig(top_moods=args.pregenerate_moods) if args.pregenerate_moods else None
+    profiles = None
+    if args.profile_spill:
+        from storage import TieredProfileStore
+        profiles = TieredProfileStore(args.profile_spill, args.max_resident_profiles, args.profile_idle_seconds,
+                                      recorder)
+    platform = AdaptiveStorytellingPlatform(instrumentation=recorder, pregeneration=pregeneration,
+                                            profile_store=profiles, history_limit=args.history_limit)
+    print(f"Serving the storytelling platform on http://{config.host}:{config.port}")
+    try:
+        asyncio.run(StoryServer(platform, config).serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if dump is not None:
+            dump.stop()
+        if profiles is not None:
+            profiles.close()
+
+if __name__ == "__main__":
+    main()
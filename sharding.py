@@ -0,0 +1,227 @@
+import gc
+import hashlib
+import multiprocessing
+import os
+import threading
+from bisect import bisect_right
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from storytelling import AdaptiveStorytellingPlatform
+
+# Posted by the watchdog on the results queue, after anything the worker
+# managed to send before it exited
+WORKER_EXITED = 'worker_exited'
+
+class WorkerDied(RuntimeError):
+    pass
+
+class HashRing:
+    # Consistent hashing with virtual nodes, so resizing moves few users
+    def __init__(self, shard_count: int, replicas: int = 64):
+        points = sorted((self._hash(f"shard-{shard}-{replica}"), shard)
+                        for shard in range(shard_count) for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> int:
+        position = bisect_right(self.hashes, self._hash(key)) % len(self.hashes)
+        return self.shards[position]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def _choice_summaries(platform: AdaptiveStorytellingPlatform,
+                      requests: List[Tuple[str, str, float]]) -> List[Dict[str, Any]]:
+    # Choice results without the profile (history, engagement tracker and
+    # all), which would be pickled back on every call: only the preferences
+    # each choice changed travel to the parent
+    results = platform.iter_user_choices(requests)
+    summaries = []
+    for user_id, _, _ in requests:
+        before = dict(platform._get_user(user_id).narrative_preferences)
+        result = next(results)
+        profile = result['user_profile']
+        summaries.append({
+            'choice_id': result['choice_id'],
+            'engagement_level': result['engagement_level'],
+            'inferred_mood': result['inferred_mood'],
+            'preference_version': profile.preference_version,
+            'preferences': {key: value for key, value in profile.narrative_preferences.items()
+                            if before.get(key) != value},
+        })
+    return summaries
+
+def _run_worker(platform: Optional[AdaptiveStorytellingPlatform],
+                platform_factory: Callable[[], AdaptiveStorytellingPlatform], requests, results):
+    # Forked workers inherit the parent's freshly built platform (and its
+    # knowledge graph) copy-on-write
+    if platform is None:
+        platform = platform_factory()
+
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        request_id, method, args = message
+        try:
+            if method == 'process_user_choice':
+                result = _choice_summaries(platform, [args])[0]
+            elif method == 'process_user_choices':
+                result = _choice_summaries(platform, args[0])
+            else:
+                result = getattr(platform, method)(*args)
+            results.put((request_id, True, result))
+        except Exception as error:
+            results.put((request_id, False, error))
+
+class ShardedPlatform:
+    # Routes each user_id to one of N worker processes, each owning the profiles
+    # of its users. Every user's requests go through a single FIFO queue to a
+    # single worker, so their choices are applied in submission order.
+    def __init__(self, workers: int = None,
+                 platform_factory: Callable[[], AdaptiveStorytellingPlatform] = AdaptiveStorytellingPlatform):
+        self.worker_count = workers or os.cpu_count() or 1
+        self.ring = HashRing(self.worker_count)
+
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+            # Build the world once; workers share its pages read-only. Freezing
+            # moves it out of the collector's reach so GC passes in the workers
+            # do not touch (and copy) those pages.
+            template = platform_factory()
+            if template.storage is not None or not isinstance(template.users, dict):
+                # Its SQLite connection would be shared by every forked worker
+                raise ValueError("storage-backed platforms cannot be forked into workers; "
+                                 "use an in-memory platform_factory")
+            gc.collect()
+            gc.freeze()
+        else:
+            # Without fork each worker builds its own copy of the world
+            context = multiprocessing.get_context('spawn')
+            template = None
+
+        self.results = context.SimpleQueue()
+        self.request_queues = []
+        self.processes = []
+        for shard in range(self.worker_count):
+            requests = context.SimpleQueue()
+            process = context.Process(target=_run_worker, name=f'storytelling-shard-{shard}',
+                                      args=(template, platform_factory, requests, self.results), daemon=True)
+            process.start()
+            self.request_queues.append(requests)
+            self.processes.append(process)
+        if template is not None:
+            gc.unfreeze()
+
+        # request_id -> (shard, future); a shard whose worker exited fails
+        # everything still pending on it and every later submit
+        self._futures: Dict[int, Tuple[int, Future]] = {}
+        self._exit_codes: Dict[int, Optional[int]] = {}
+        self._next_request_id = 0
+        self._lock = threading.Lock()
+        self._collector = threading.Thread(target=self._collect_results, name='storytelling-shard-results',
+                                           daemon=True)
+        self._collector.start()
+        self._watchdog = threading.Thread(target=self._watch_workers, name='storytelling-shard-watchdog',
+                                          daemon=True)
+        self._watchdog.start()
+
+    def shard_for(self, user_id: str) -> int:
+        return self.ring.shard_for(user_id)
+
+    def submit(self, shard: int, method: str, *args: Any) -> Future:
+        future = Future()
+        with self._lock:
+            if shard in self._exit_codes:
+                future.set_exception(self._worker_died(shard))
+                return future
+            request_id = self._next_request_id
+            self._next_request_id += 1
+            self._futures[request_id] = (shard, future)
+            # Enqueued under the lock so request order per shard matches submission order
+            self.request_queues[shard].put((request_id, method, args))
+        return future
+
+    def process_user_choice(self, user_id: str, choice_text: str, response_time: float) -> Dict[str, Any]:
+        return self.submit(self.shard_for(user_id), 'process_user_choice',
+                           user_id, choice_text, response_time).result()
+
+    def generate_adaptive_content(self, user_id: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
+        return self.submit(self.shard_for(user_id), 'generate_adaptive_content', user_id, context).result()
+
+    def process_user_choices(self, requests: List[Tuple[str, str, float]]) -> List[Dict[str, Any]]:
+        return self._fan_out('process_user_choices', requests)
+
+    def generate_adaptive_contents(self, requests: List[Tuple[str, Optional[Dict[str, Any]]]]) -> List[Dict[str, Any]]:
+        return self._fan_out('generate_adaptive_contents', requests)
+
+    def close(self):
+        for requests in self.request_queues:
+            requests.put(None)
+        for process in self.processes:
+            process.join()
+        self._watchdog.join()
+        self.results.put(None)
+        self._collector.join()
+
+    def __enter__(self) -> 'ShardedPlatform':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _fan_out(self, method: str, requests: List[Tuple]) -> List[Any]:
+        # One message per shard carrying that shard's slice of the batch, then
+        # results are put back in request order
+        positions_by_shard: Dict[int, List[int]] = {}
+        for position, request in enumerate(requests):
+            positions_by_shard.setdefault(self.shard_for(request[0]), []).append(position)
+
+        futures = {shard: self.submit(shard, method, [requests[position] for position in positions])
+                   for shard, positions in positions_by_shard.items()}
+        results = [None] * len(requests)
+        for shard, future in futures.items():
+            for position, result in zip(positions_by_shard[shard], future.result()):
+                results[position] = result
+        return results
+
+    def _collect_results(self):
+        while True:
+            message = self.results.get()
+            if message is None:
+                break
+            if message[0] == WORKER_EXITED:
+                self._fail_shard(message[1], message[2])
+                continue
+            request_id, succeeded, payload = message
+            with self._lock:
+                _, future = self._futures.pop(request_id)
+            if succeeded:
+                future.set_result(payload)
+            else:
+                future.set_exception(payload)
+
+    def _watch_workers(self):
+        # A worker that crashed (or was killed) never answers its queue, so its
+        # futures are failed instead of left blocking forever. Runs until every
+        # worker has exited, close() included.
+        shards = {process.sentinel: shard for shard, process in enumerate(self.processes)}
+        while shards:
+            for sentinel in wait(list(shards)):
+                shard = shards.pop(sentinel)
+                self.processes[shard].join()
+                self.results.put((WORKER_EXITED, shard, self.processes[shard].exitcode))
+
+    def _fail_shard(self, shard: int, exit_code: Optional[int]):
+        with self._lock:
+            self._exit_codes[shard] = exit_code
+            pending = [request_id for request_id, (owner, _) in self._futures.items() if owner == shard]
+            futures = [self._futures.pop(request_id)[1] for request_id in pending]
+        for future in futures:
+            future.set_exception(self._worker_died(shard))
+
+    def _worker_died(self, shard: int) -> WorkerDied:
+        return WorkerDied(f"shard {shard} worker exited with code {self._exit_codes[shard]}")
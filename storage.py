@@ -0,0 +1,630 @@
+import atexit
+import json
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from storytelling import (Instrumentation, KnowledgeGraph, Mood, NULL_INSTRUMENTATION, StoryElement,
+                          UserChoice, UserProfile)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS elements (
+    element_id TEXT PRIMARY KEY,
+    ordinal INTEGER NOT NULL UNIQUE,
+    element_type TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    usage_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS element_moods (
+    element_id TEXT NOT NULL,
+    mood TEXT NOT NULL,
+    element_type TEXT NOT NULL,
+    weight REAL NOT NULL,
+    ordinal INTEGER NOT NULL,
+    PRIMARY KEY (element_id, mood)
+);
+CREATE INDEX IF NOT EXISTS element_moods_by_weight ON element_moods (mood, weight DESC, ordinal);
+CREATE INDEX IF NOT EXISTS element_moods_by_type ON element_moods (mood, element_type, weight DESC, ordinal);
+CREATE TABLE IF NOT EXISTS relationships (
+    from_id TEXT NOT NULL,
+    to_id TEXT NOT NULL,
+    relationship_type TEXT NOT NULL,
+    PRIMARY KEY (from_id, to_id)
+);
+CREATE INDEX IF NOT EXISTS relationships_by_target ON relationships (to_id);
+CREATE INDEX IF NOT EXISTS relationships_by_type ON relationships (relationship_type);
+CREATE TABLE IF NOT EXISTS profiles (
+    user_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS choices (
+    sequence INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    choice TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS choices_by_user ON choices (user_id, sequence);
+'''
+
+def _commit_when_idle(store_ref: 'weakref.ref', closed: threading.Event, interval: float):
+    # Holds only a weak reference, so an unclosed store can still be collected
+    while not closed.wait(interval):
+        store = store_ref()
+        if store is None:
+            return
+        store.commit_idle()
+        del store
+
+def _close_at_exit(store_ref: 'weakref.ref'):
+    store = store_ref()
+    if store is not None:
+        store.close()
+
+class SQLiteStore:
+    def __init__(self, path: str, commit_every: int = 256, commit_interval: float = 1.0,
+                 max_resident_profiles: int = 10000):
+        # Writes run inside an open transaction that is committed in groups of
+        # `commit_every` statements or every `commit_interval` seconds, so a
+        # choice does not cost an fsync. Reads on this connection already see
+        # uncommitted writes. A background thread also commits a transaction
+        # left open `commit_interval` seconds after the last write, so an idle
+        # store neither holds the write lock nor sits on uncommitted choices;
+        # the store is closed at exit if it is still open. At most
+        # `max_resident_profiles` profiles are kept loaded; the rest are read
+        # back from the store when needed.
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.pending_writes = 0
+        self.last_commit = time.monotonic()
+        self.dirty_profiles = {}  # user_id -> UserProfile, serialized at commit time
+        self.graph = PersistentKnowledgeGraph(self)
+        self.profiles = PersistentProfileMap(self, max_resident_profiles)
+        # Every statement on the shared connection, including reads, holds this
+        # lock, so the commit thread never commits under a half-read cursor
+        self._lock = threading.RLock()
+        self.closed = threading.Event()
+        threading.Thread(target=_commit_when_idle, args=(weakref.ref(self), self.closed, commit_interval),
+                         name='storytelling-store-commit', daemon=True).start()
+        atexit.register(_close_at_exit, weakref.ref(self))
+
+    def read(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        # All rows, fetched before the lock is released
+        with self._lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def read_one(self, sql: str, params: Tuple = ()) -> Optional[Tuple]:
+        with self._lock:
+            return self.connection.execute(sql, params).fetchone()
+
+    def write(self, sql: str, params: Tuple = ()):
+        with self._lock:
+            self._begin()
+            self.connection.execute(sql, params)
+            self.pending_writes += 1
+            self.maybe_commit()
+
+    def write_many(self, sql: str, rows: List[Tuple]):
+        with self._lock:
+            self._begin()
+            self.connection.executemany(sql, rows)
+            self.pending_writes += len(rows)
+            self.maybe_commit()
+
+    def mark_dirty(self, profile: UserProfile):
+        with self._lock:
+            self.dirty_profiles[profile.user_id] = profile
+            self.pending_writes += 1
+            self.maybe_commit()
+
+    def append_choice(self, user_id: str, choice: UserChoice):
+        self.write('INSERT INTO choices (user_id, choice) VALUES (?, ?)',
+                   (user_id, json.dumps(choice.to_state())))
+
+    def append_choices(self, choices: List[Tuple[str, UserChoice]]):
+        self.write_many('INSERT INTO choices (user_id, choice) VALUES (?, ?)',
+                        [(user_id, json.dumps(choice.to_state())) for user_id, choice in choices])
+
+    def maybe_commit(self):
+        if (self.pending_writes >= self.commit_every
+                or time.monotonic() - self.last_commit >= self.commit_interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self.dirty_profiles:
+                self._begin()
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO profiles (user_id, state) VALUES (?, ?)',
+                    [(user_id, json.dumps(profile.to_state(include_history=False)))
+                     for user_id, profile in self.dirty_profiles.items()])
+                self.dirty_profiles.clear()
+            if self.connection.in_transaction:
+                self.connection.execute('COMMIT')
+            self.pending_writes = 0
+            self.last_commit = time.monotonic()
+
+    def commit_idle(self):
+        # Commits the rows written so far once the transaction has been open
+        # for `commit_interval`. Dirty profiles are not serialized here, as
+        # the platform may be changing them on its own thread; flush() (on
+        # the next writes, or at close) saves them, and the committed choice
+        # log is enough to rebuild them in the meantime (see replay.py).
+        with self._lock:
+            if (not self.closed.is_set() and self.connection.in_transaction
+                    and time.monotonic() - self.last_commit >= self.commit_interval):
+                self.connection.execute('COMMIT')
+                self.last_commit = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self.closed.is_set():
+                return
+            self.closed.set()
+            self.flush()
+            self.connection.close()
+
+    def is_empty(self) -> bool:
+        return self.read_one('SELECT 1 FROM elements LIMIT 1') is None
+
+    def _begin(self):
+        if not self.connection.in_transaction:
+            self.connection.execute('BEGIN')
+
+class LazyNodeMap(MutableMapping):
+    # element_id -> StoryElement, loaded from the store on first access
+    def __init__(self, store: SQLiteStore, graph: 'PersistentKnowledgeGraph'):
+        self.store = store
+        self.graph = graph
+        self.loaded = {}
+
+    def __getitem__(self, element_id: str) -> StoryElement:
+        if element_id not in self.loaded:
+            self.load([element_id])
+            if element_id not in self.loaded:
+                raise KeyError(element_id)
+        return self.loaded[element_id]
+
+    def __setitem__(self, element_id: str, element: StoryElement):
+        self.loaded[element_id] = element
+
+    def __delitem__(self, element_id: str):
+        raise TypeError('story elements cannot be deleted from a persistent graph')
+
+    def __contains__(self, element_id: object) -> bool:
+        if element_id in self.loaded:
+            return True
+        return self.store.read_one('SELECT 1 FROM elements WHERE element_id = ?', (element_id,)) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for (element_id,) in self.store.read('SELECT element_id FROM elements ORDER BY ordinal'):
+            yield element_id
+
+    def __len__(self) -> int:
+        return self.store.read_one('SELECT COUNT(*) FROM elements')[0]
+
+    def load(self, element_ids: List[str]):
+        missing = [element_id for element_id in dict.fromkeys(element_ids) if element_id not in self.loaded]
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            marks = ','.join('?' * len(chunk))
+            weights = {}
+            for element_id, mood, weight in self.store.read(
+                    f'SELECT element_id, mood, weight FROM element_moods WHERE element_id IN ({marks})', chunk):
+                weights.setdefault(element_id, {})[Mood(mood)] = weight
+            for element_id, ordinal, element_type, content, tags, usage_count in self.store.read(
+                    f'SELECT element_id, ordinal, element_type, content, tags, usage_count '
+                    f'FROM elements WHERE element_id IN ({marks})', chunk):
+                element = StoryElement(element_id, element_type, content, json.loads(tags),
+                                       weights.get(element_id, {}))
+                element.usage_count = usage_count
+                element.graph = self.graph
+                self.loaded[element_id] = element
+                self.graph.ordinals[element_id] = ordinal
+
+class PersistentKnowledgeGraph(KnowledgeGraph):
+    # Answers neighbor and mood queries from SQLite indexes and only keeps the
+    # elements it has actually returned in memory, so opening a large world is
+    # as cheap as opening a small one.
+    def __init__(self, store: SQLiteStore):
+        super().__init__()
+        self.store = store
+        self.nodes = LazyNodeMap(store, self)
+        self.mood_matrix = None  # Recommendations use the indexed per-mood queries
+        self.usage_counts = None
+
+    def add_element(self, element: StoryElement):
+        self.version += 1
+        row = self.store.read_one('SELECT ordinal FROM elements WHERE element_id = ?', (element.element_id,))
+        if row is None:
+            ordinal = self.store.read_one('SELECT COALESCE(MAX(ordinal) + 1, 0) FROM elements')[0]
+        else:
+            ordinal = row[0]
+
+        # An upsert rather than INSERT OR REPLACE, which deletes the row and
+        # gives the replacement a new rowid
+        self.store.write('INSERT INTO elements VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (element_id) DO UPDATE SET '
+                         'element_type = excluded.element_type, content = excluded.content, '
+                         'tags = excluded.tags, usage_count = excluded.usage_count',
+                         (element.element_id, ordinal, element.element_type, element.content,
+                          json.dumps(list(element.tags)), element.usage_count))
+        self._write_mood_weights(element, ordinal)
+        previous = self.nodes.loaded.get(element.element_id)
+        if previous is not None and previous is not element:
+            previous.graph = None
+        element.graph = self
+        self.nodes[element.element_id] = element
+        self.ordinals[element.element_id] = ordinal
+
+    def add_relationship(self, from_id: str, to_id: str, relationship_type: str):
+        self.version += 1
+        # Neighbors come back in rowid order, so retyping an edge keeps its row
+        self.store.write('INSERT INTO relationships VALUES (?, ?, ?) ON CONFLICT (from_id, to_id) DO UPDATE SET '
+                         'relationship_type = excluded.relationship_type', (from_id, to_id, relationship_type))
+
+    def _write_weights(self, element_id: str, weights: Iterable[Tuple[int, Optional[float]]]):
+        self.version += 1
+        element = self.nodes[element_id]
+        for ordinal, weight in weights:
+            element.store_weight(ordinal, weight)
+        self._write_mood_weights(element, self.ordinals[element_id])
+
+    def record_usage(self, element_id: str, count: int = 1):
+        self.usage_version += 1
+        element = self.nodes[element_id]
+        element.usage_count += count
+        self.store.write('UPDATE elements SET usage_count = ? WHERE element_id = ?',
+                         (element.usage_count, element_id))
+
+    def weight_matrix(self) -> None:
+        return None
+
+    def rebuild_indexes(self):
+        # SQLite maintains the indexes; nothing to rebuild in memory
+        pass
+
+    def query(self, query, limit: int = None) -> List[StoryElement]:
+        raise TypeError('bitset queries need the in-memory KnowledgeGraph; '
+                        'use find_elements_by_mood and the neighbor queries instead')
+
+    def overlay(self):
+        raise TypeError('overlays need an in-memory KnowledgeGraph as their base')
+
+    def get_related_elements(self, element_id: str, relationship_type: str = None) -> List[StoryElement]:
+        return self._neighbors('SELECT to_id FROM relationships WHERE from_id = ?', element_id, relationship_type)
+
+    def get_referring_elements(self, element_id: str, relationship_type: str = None) -> List[StoryElement]:
+        return self._neighbors('SELECT from_id FROM relationships WHERE to_id = ?', element_id, relationship_type)
+
+    def get_relationships_by_type(self, relationship_type: str) -> List[Tuple[str, str]]:
+        return self.store.read('SELECT from_id, to_id FROM relationships WHERE relationship_type = ? '
+                               'ORDER BY rowid', (relationship_type,))
+
+    def outgoing_relationships(self, element_id: str) -> Dict[str, str]:
+        return dict(self.store.read('SELECT to_id, relationship_type FROM relationships WHERE from_id = ? '
+                                    'ORDER BY rowid', (element_id,)))
+
+    def find_elements_by_mood(self, mood: Mood, threshold: float = 0.5,
+                              element_type: str = None) -> List[StoryElement]:
+        if threshold <= 0:
+            # Every element qualifies, those without the mood at weight 0; one
+            # query, then loaded in bulk like the indexed case
+            sql = ('SELECT elements.element_id FROM elements LEFT JOIN element_moods '
+                   'ON element_moods.element_id = elements.element_id AND element_moods.mood = ?')
+            params = (mood.value,)
+            if element_type is not None:
+                sql += ' WHERE elements.element_type = ?'
+                params += (element_type,)
+            rows = self.store.read(sql + ' ORDER BY COALESCE(element_moods.weight, 0) DESC, elements.ordinal',
+                                   params)
+        elif element_type is None:
+            rows = self.store.read('SELECT element_id FROM element_moods WHERE mood = ? AND weight >= ? '
+                                   'ORDER BY weight DESC, ordinal', (mood.value, threshold))
+        else:
+            rows = self.store.read('SELECT element_id FROM element_moods WHERE mood = ? AND element_type = ? '
+                                   'AND weight >= ? ORDER BY weight DESC, ordinal',
+                                   (mood.value, element_type, threshold))
+        return self._load_elements([element_id for (element_id,) in rows])
+
+    def _neighbors(self, sql: str, element_id: str, relationship_type: Optional[str]) -> List[StoryElement]:
+        params = (element_id,)
+        if relationship_type is not None:
+            sql += ' AND relationship_type = ?'
+            params += (relationship_type,)
+        neighbor_ids = [neighbor_id for (neighbor_id,) in self.store.read(sql + ' ORDER BY rowid', params)]
+        return self._load_elements(neighbor_ids)
+
+    def _load_elements(self, element_ids: List[str]) -> List[StoryElement]:
+        self.nodes.load(element_ids)
+        loaded = self.nodes.loaded
+        return [loaded[element_id] for element_id in element_ids if element_id in loaded]
+
+    def _write_mood_weights(self, element: StoryElement, ordinal: int):
+        # Moods explicitly set to 0 get a row too, so they survive a reload;
+        # threshold queries never reach them
+        self.store.write('DELETE FROM element_moods WHERE element_id = ?', (element.element_id,))
+        self.store.write_many('INSERT INTO element_moods VALUES (?, ?, ?, ?, ?)',
+                              [(element.element_id, mood.value, element.element_type, weight, ordinal)
+                               for mood, weight in element.mood_weights.items()])
+
+class PersistentProfileMap(MutableMapping):
+    # user_id -> UserProfile, rehydrated from the store on first access. The
+    # `max_resident` most recently used profiles stay loaded; older ones are
+    # dropped (unsaved changes are still held by the store until its next
+    # commit) and read back when needed. A dropped profile that is still
+    # referenced elsewhere is handed out again rather than a second copy.
+    def __init__(self, store: SQLiteStore, max_resident: int = 10000):
+        self.store = store
+        self.max_resident = max_resident
+        self.loaded = OrderedDict()  # Most recently used last
+        self.detached = weakref.WeakValueDictionary()  # Dropped but still referenced
+
+    def __getitem__(self, user_id: str) -> UserProfile:
+        profile = self.loaded.get(user_id)
+        if profile is not None:
+            self.loaded.move_to_end(user_id)
+            return profile
+        profile = self.detached.pop(user_id, None) or self._load(user_id)
+        if profile is None:
+            raise KeyError(user_id)
+        self._keep(user_id, profile)
+        return profile
+
+    def __setitem__(self, user_id: str, profile: UserProfile):
+        self.detached.pop(user_id, None)
+        self._keep(user_id, profile)
+        self.store.mark_dirty(profile)
+
+    def __delitem__(self, user_id: str):
+        self.loaded.pop(user_id, None)
+        self.detached.pop(user_id, None)
+        self.store.dirty_profiles.pop(user_id, None)
+        self.store.write('DELETE FROM profiles WHERE user_id = ?', (user_id,))
+        self.store.write('DELETE FROM choices WHERE user_id = ?', (user_id,))
+
+    def __contains__(self, user_id: object) -> bool:
+        if user_id in self.loaded or user_id in self.store.dirty_profiles:
+            return True
+        return self.store.read_one('SELECT 1 FROM profiles WHERE user_id = ?', (user_id,)) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        seen = dict.fromkeys([*self.loaded, *self.store.dirty_profiles])
+        yield from list(seen)
+        for (user_id,) in self.store.read('SELECT user_id FROM profiles'):
+            if user_id not in seen:
+                yield user_id
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def choice_log(self, user_id: str, limit: Optional[int] = None) -> List[UserChoice]:
+        # Oldest first; with a limit, the most recent `limit` choices
+        if limit is None:
+            rows = self.store.read('SELECT choice FROM choices WHERE user_id = ? ORDER BY sequence', (user_id,))
+            return [UserChoice.from_state(json.loads(choice)) for (choice,) in rows]
+        rows = self.store.read('SELECT choice FROM choices WHERE user_id = ? ORDER BY sequence DESC LIMIT ?',
+                               (user_id, limit))
+        return [UserChoice.from_state(json.loads(choice)) for (choice,) in reversed(rows)]
+
+    def _keep(self, user_id: str, profile: UserProfile):
+        self.loaded[user_id] = profile
+        self.loaded.move_to_end(user_id)
+        while len(self.loaded) > self.max_resident:
+            dropped_id, dropped = self.loaded.popitem(last=False)
+            self.detached[dropped_id] = dropped
+
+    def _load(self, user_id: str) -> Optional[UserProfile]:
+        dirty = self.store.dirty_profiles.get(user_id)
+        if dirty is not None:
+            return dirty
+        row = self.store.read_one('SELECT state FROM profiles WHERE user_id = ?', (user_id,))
+        if row is None:
+            return None
+        state = json.loads(row[0])
+        return UserProfile.from_state(state, self.choice_log(user_id, state['history_limit']))
+
+class TieredProfileStore(MutableMapping):
+    # user_id -> UserProfile with at most `max_resident` profiles in memory.
+    # The least recently used profile, and with `idle_seconds` any profile not
+    # touched for that long, is spilled to a local SQLite file as its
+    # to_state() (preferences, rolling mood state and the already trimmed
+    # history) and rehydrated on its next access. A spilled profile that is
+    # still referenced elsewhere is kept and handed back as the same object,
+    # so in-flight changes to it are not lost. Changes made to it meanwhile
+    # reach the file on flush(), which the owner should call periodically
+    # (the server does); it writes those profiles back and lets go of the
+    # ones nothing holds any more. close() spills everything, so the file can
+    # be reopened later.
+    def __init__(self, path: str, max_resident: int = 10000, idle_seconds: Optional[float] = None,
+                 instrumentation: Instrumentation = NULL_INSTRUMENTATION, commit_every: int = 256):
+        if max_resident < 1:
+            raise ValueError('max_resident must be at least 1')
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS spilled_profiles '
+                                '(user_id TEXT PRIMARY KEY, state TEXT NOT NULL)')
+        self.max_resident = max_resident
+        self.idle_seconds = idle_seconds
+        self.instrumentation = instrumentation
+        self.commit_every = commit_every
+        self.resident = OrderedDict()  # user_id -> (UserProfile, last access), least recent first
+        self.detached = {}  # user_id -> UserProfile spilled but still referenced elsewhere
+        self.pending_writes = 0
+        self.evictions = 0
+        self.idle_evictions = 0
+        self.rehydrations = 0
+        self.reattached = 0
+        self.rehydration_seconds = 0.0
+        self.max_rehydration_seconds = 0.0
+        self._lock = threading.RLock()
+
+    def __getitem__(self, user_id: str) -> UserProfile:
+        with self._lock:
+            entry = self.resident.pop(user_id, None)
+            if entry is not None:
+                profile = entry[0]
+            else:
+                profile = self.detached.pop(user_id, None)
+                if profile is not None:
+                    self.reattached += 1
+                else:
+                    profile = self._rehydrate(user_id)
+            self._admit(user_id, profile)
+            return profile
+
+    def __setitem__(self, user_id: str, profile: UserProfile):
+        with self._lock:
+            self.resident.pop(user_id, None)
+            self.detached.pop(user_id, None)
+            self._admit(user_id, profile)
+
+    def __delitem__(self, user_id: str):
+        with self._lock:
+            found = self.resident.pop(user_id, None) is not None
+            found = self.detached.pop(user_id, None) is not None or found
+            deleted = self.connection.execute('DELETE FROM spilled_profiles WHERE user_id = ?', (user_id,))
+            if not found and deleted.rowcount == 0:
+                raise KeyError(user_id)
+
+    def __contains__(self, user_id: object) -> bool:
+        with self._lock:
+            if user_id in self.resident or user_id in self.detached:
+                return True
+            return self.connection.execute('SELECT 1 FROM spilled_profiles WHERE user_id = ?',
+                                           (user_id,)).fetchone() is not None
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            in_memory = list(self.resident) + [user_id for user_id in list(self.detached)
+                                               if user_id not in self.resident]
+            spilled = [user_id for (user_id,) in self.connection.execute('SELECT user_id FROM spilled_profiles')]
+        seen = set(in_memory)
+        yield from in_memory
+        for user_id in spilled:
+            if user_id not in seen:
+                yield user_id
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def clear(self):
+        with self._lock:
+            self.resident.clear()
+            self.detached.clear()
+            self.connection.execute('DELETE FROM spilled_profiles')
+
+    def evict_idle(self) -> int:
+        # Spills every profile idle for `idle_seconds`; access already does this
+        # lazily, a periodic call also catches users who never come back
+        if self.idle_seconds is None:
+            return 0
+        with self._lock:
+            cutoff = time.monotonic() - self.idle_seconds
+            evicted = 0
+            while self.resident and next(iter(self.resident.values()))[1] < cutoff:
+                self._evict()
+                evicted += 1
+            self.idle_evictions += evicted
+            return evicted
+
+    def flush(self):
+        # Writes back spilled profiles that may have changed while still
+        # referenced, then keeps only those something still holds
+        with self._lock:
+            detached, self.detached = self.detached, {}
+            self._spill_many(list(detached.items()))
+            self._commit()
+            references = {user_id: weakref.ref(profile) for user_id, profile in detached.items()}
+            del detached
+            for user_id, reference in references.items():
+                self._release(user_id, reference)
+
+    def close(self):
+        with self._lock:
+            self._spill_many([(user_id, profile) for user_id, (profile, _) in self.resident.items()]
+                             + list(self.detached.items()))
+            self.resident.clear()
+            self.detached.clear()
+            self._commit()
+            self.connection.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'resident': len(self.resident),
+                'max_resident': self.max_resident,
+                'detached': len(self.detached),
+                'evictions': self.evictions,
+                'idle_evictions': self.idle_evictions,
+                'rehydrations': self.rehydrations,
+                'reattached': self.reattached,
+                'rehydration_ms_mean': (self.rehydration_seconds / self.rehydrations * 1000
+                                        if self.rehydrations else 0.0),
+                'rehydration_ms_max': self.max_rehydration_seconds * 1000,
+            }
+
+    def _admit(self, user_id: str, profile: UserProfile):
+        now = time.monotonic()
+        self.resident[user_id] = (profile, now)
+        while len(self.resident) > self.max_resident:
+            self._evict()
+        if self.idle_seconds is not None:
+            cutoff = now - self.idle_seconds
+            while next(iter(self.resident.values()))[1] < cutoff:
+                self._evict()
+                self.idle_evictions += 1
+
+    def _evict(self):
+        user_id, (profile, _) = self.resident.popitem(last=False)
+        self._spill_many([(user_id, profile)])
+        reference = weakref.ref(profile)
+        del profile
+        self._release(user_id, reference)
+        self.evictions += 1
+        self.instrumentation.increment('profile_evictions')
+
+    def _release(self, user_id: str, reference: 'weakref.ref'):
+        # Called once the store dropped its own references to a written-back
+        # profile: one nothing else holds is gone, a live one may still change
+        profile = reference()
+        if profile is not None:
+            self.detached[user_id] = profile
+
+    def _rehydrate(self, user_id: str) -> UserProfile:
+        started = time.perf_counter()
+        with self.instrumentation.stage('profile_rehydration'):
+            row = self.connection.execute('SELECT state FROM spilled_profiles WHERE user_id = ?',
+                                          (user_id,)).fetchone()
+            if row is None:
+                raise KeyError(user_id)
+            profile = UserProfile.from_state(json.loads(row[0]))
+        elapsed = time.perf_counter() - started
+        self.rehydrations += 1
+        self.rehydration_seconds += elapsed
+        self.max_rehydration_seconds = max(self.max_rehydration_seconds, elapsed)
+        return profile
+
+    def _spill_many(self, profiles: List[Tuple[str, UserProfile]]):
+        if not profiles:
+            return
+        if not self.connection.in_transaction:
+            self.connection.execute('BEGIN')
+        self.connection.executemany('INSERT OR REPLACE INTO spilled_profiles (user_id, state) VALUES (?, ?)',
+                                    [(user_id, json.dumps(profile.to_state())) for user_id, profile in profiles])
+        self.pending_writes += len(profiles)
+        if self.pending_writes >= self.commit_every:
+            self._commit()
+
+    def _commit(self):
+        if self.connection.in_transaction:
+            self.connection.execute('COMMIT')
+        self.pending_writes = 0
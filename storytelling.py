@@ -1,11 +1,27 @@
+import asyncio
 import json
 import random
+import re
+import threading
 import time
 from datetime import datetime
-from typing import Dict, List, Any, Optional, Tuple
-from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Deque, Dict, Iterable, Iterator, List, Any, Optional, Tuple
+from dataclasses import dataclass, field, replace
 from enum import Enum
 import uuid
+import heapq
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import ChainMap, OrderedDict, defaultdict, deque
+from collections.abc import Mapping, MutableMapping, MutableSequence, Sequence
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+try:
+    import numpy as np
+except ImportError:  # Recommendations fall back to pure Python scoring
+    np = None
 
 class Mood(Enum):
     ADVENTUROUS = "adventurous"
@@ -16,11 +32,156 @@ class Mood(Enum):
     CONTEMPLATIVE = "contemplative"
     TENSE = "tense"
 
+# Column of each mood in dense mood-weight matrices and preference vectors
+MOOD_ORDINALS = {mood: ordinal for ordinal, mood in enumerate(Mood)}
+
 class EngagementLevel(Enum):
     LOW = "low"
     MEDIUM = "medium"
     HIGH = "high"
 
+# Simple keyword-based mood lexicon used by the default MoodAnalyzer
+DEFAULT_MOOD_LEXICON = {
+    Mood.ADVENTUROUS: ['explore', 'adventure', 'quest', 'journey', 'discover'],
+    Mood.MYSTERIOUS: ['investigate', 'mystery', 'secret', 'hidden', 'unknown'],
+    Mood.ROMANTIC: ['love', 'romance', 'heart', 'kiss', 'together'],
+    Mood.DARK: ['fight', 'battle', 'dark', 'evil', 'danger'],
+    Mood.HUMOROUS: ['joke', 'funny', 'laugh', 'silly', 'amusing']
+}
+
+class Instrumentation:
+    # Hooks the platform calls around each request and stage. This default
+    # records nothing; metrics.MetricsRecorder collects histograms, counters
+    # and traces.
+    NULL_SPAN = nullcontext()
+    
+    def request(self, name: str):
+        return self.NULL_SPAN
+    
+    def stage(self, name: str):
+        return self.NULL_SPAN
+    
+    def increment(self, name: str, value: int = 1):
+        pass
+
+NULL_INSTRUMENTATION = Instrumentation()
+
+class LRUCache:
+    # Bounded memo table. Keys carry the versions of everything the value was
+    # computed from, so a version bump makes old entries unreachable and they
+    # simply age out. maxsize 0 disables caching.
+    MISSING = object()
+    
+    def __init__(self, maxsize: int = 1024, name: str = 'cache', 
+                 instrumentation: Instrumentation = NULL_INSTRUMENTATION):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.hit_counter = f'{name}_hits'
+        self.miss_counter = f'{name}_misses'
+        self.instrumentation = instrumentation
+        self._lock = threading.Lock()
+    
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            value = self.entries.get(key, self.MISSING)
+            if value is self.MISSING:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        self.instrumentation.increment(self.miss_counter if value is self.MISSING else self.hit_counter)
+        return value
+    
+    def put(self, key: Any, value: Any):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+    
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+class MoodAnalyzer:
+    TOKEN_PATTERN = re.compile(r"\w+")
+    
+    def __init__(self, lexicon: Dict[Mood, List[str]] = None, 
+                 keyword_weight: float = 0.2, max_impact: float = 1.0):
+        self.keyword_weight = keyword_weight
+        self.max_impact = max_impact
+        self.moods = []  # lexicon order, keeps result ordering stable
+        self.terms = {}  # normalized term -> moods it contributes to
+        self.max_term_words = 1
+        
+        for mood, keywords in (lexicon or DEFAULT_MOOD_LEXICON).items():
+            self.moods.append(mood)
+            for keyword in keywords:
+                words = self.TOKEN_PATTERN.findall(keyword.lower())
+                if not words:
+                    continue
+                term = ' '.join(words)
+                moods = self.terms.setdefault(term, [])
+                if mood not in moods:
+                    moods.append(mood)
+                self.max_term_words = max(self.max_term_words, len(words))
+    
+    def analyze(self, text: str) -> Dict[Mood, float]:
+        words = self.TOKEN_PATTERN.findall(text.lower())
+        
+        # Each distinct term counts once, however often it appears
+        if self.max_term_words == 1:
+            matched = self.terms.keys() & set(words)
+        else:
+            matched = set()
+            for start in range(len(words)):
+                for length in range(1, min(self.max_term_words, len(words) - start) + 1):
+                    term = ' '.join(words[start:start + length])
+                    if term in self.terms:
+                        matched.add(term)
+        
+        if not matched:
+            return {}
+        
+        hits = {}
+        for term in matched:
+            for mood in self.terms[term]:
+                hits[mood] = hits.get(mood, 0) + 1
+        
+        return {mood: min(hits[mood] * self.keyword_weight, self.max_impact) 
+                for mood in self.moods if mood in hits}
+    
+    def analyze_batch(self, texts: List[str]) -> List[Dict[Mood, float]]:
+        analyze = self.analyze
+        return [analyze(text) for text in texts]
+    
+    def to_state(self) -> Dict[str, Any]:
+        # The compiled term table, so a content pack skips tokenizing the lexicon
+        return {
+            'keyword_weight': self.keyword_weight,
+            'max_impact': self.max_impact,
+            'moods': [mood.value for mood in self.moods],
+            'terms': {term: [mood.value for mood in moods] for term, moods in self.terms.items()},
+            'max_term_words': self.max_term_words,
+        }
+    
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'MoodAnalyzer':
+        analyzer = cls.__new__(cls)
+        analyzer.keyword_weight = state['keyword_weight']
+        analyzer.max_impact = state['max_impact']
+        analyzer.moods = [Mood(mood) for mood in state['moods']]
+        analyzer.terms = {term: [Mood(mood) for mood in moods] for term, moods in state['terms'].items()}
+        analyzer.max_term_words = state['max_term_words']
+        return analyzer
+
 @dataclass
 class UserChoice:
     choice_id: str
@@ -28,98 +189,1456 @@ class UserChoice:
     timestamp: datetime
     response_time: float
     mood_impact: Dict[Mood, float] = field(default_factory=dict)
+    
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            'choice_id': self.choice_id,
+            'choice_text': self.choice_text,
+            'timestamp': self.timestamp.isoformat() if self.timestamp else None,
+            'response_time': self.response_time,
+            'mood_impact': {mood.value: impact for mood, impact in self.mood_impact.items()},
+        }
+    
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'UserChoice':
+        return cls(
+            choice_id=state['choice_id'],
+            choice_text=state['choice_text'],
+            timestamp=datetime.fromisoformat(state['timestamp']) if state['timestamp'] else None,
+            response_time=state['response_time'],
+            mood_impact={Mood(mood): impact for mood, impact in state['mood_impact'].items()}
+        )
 
 @dataclass
 class UserProfile:
     user_id: str
     preferred_moods: List[Mood] = field(default_factory=list)
+    # A deque holding the last history_limit choices when that is set
     choice_history: List[UserChoice] = field(default_factory=list)
     engagement_patterns: Dict[str, float] = field(default_factory=dict)
     narrative_preferences: Dict[str, float] = field(default_factory=dict)
+    # Rolling mood state: sum over the last `mood_window` choices, or an
+    # exponentially decayed sum when `mood_decay` is set
+    mood_window: int = 5
+    mood_decay: Optional[float] = None
+    mood_scores: Dict[Mood, float] = field(default_factory=lambda: {mood: 0.0 for mood in Mood})
+    choice_count: int = 0
+    # Bumped whenever narrative_preferences change; cached recommendations are
+    # keyed on it together with profile_id, which tells a recreated profile
+    # (whose versions start over) from the one it replaced
+    preference_version: int = 0
+    profile_id: str = field(default_factory=lambda: uuid.uuid4().hex, compare=False)
+    # None keeps the full history in memory; with a limit, older choices are
+    # dropped and handed to history_sink if set
+    history_limit: Optional[int] = None
+    history_sink: Optional[Callable[[UserChoice], None]] = field(default=None, repr=False, compare=False)
+    # Per-user engagement statistics (a UserEngagementTracker)
+    engagement_tracker: Optional['UserEngagementTracker'] = field(default=None, repr=False, compare=False)
+    _recent_impacts: Deque[Dict[Mood, float]] = field(default_factory=deque, init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        if self.engagement_tracker is None:
+            self.engagement_tracker = UserEngagementTracker()
+        if self.history_limit is not None:
+            history = list(self.choice_history)
+            if self.history_sink is not None:
+                for expired in history[:max(0, len(history) - self.history_limit)]:
+                    self.history_sink(expired)
+            self.choice_history = deque(history, maxlen=self.history_limit)
     
     def add_choice(self, choice: UserChoice):
-        self.choice_history.append(choice)
+        history = self.choice_history
+        if self.history_limit is not None and len(history) == history.maxlen and self.history_sink is not None:
+            # The deque drops its oldest choice on append
+            self.history_sink(history[0] if history else choice)
+        history.append(choice)
+        self.choice_count += 1
         self._update_preferences(choice)
+        self._update_mood_scores(choice)
+    
+    def to_state(self, include_history: bool = True) -> Dict[str, Any]:
+        # JSON-safe snapshot; history_sink is not part of the state
+        state = {
+            'user_id': self.user_id,
+            'preferred_moods': [mood.value for mood in self.preferred_moods],
+            'engagement_patterns': dict(self.engagement_patterns),
+            'narrative_preferences': dict(self.narrative_preferences),
+            'mood_window': self.mood_window,
+            'mood_decay': self.mood_decay,
+            'mood_scores': {mood.value: score for mood, score in self.mood_scores.items()},
+            'choice_count': self.choice_count,
+            'preference_version': self.preference_version,
+            'profile_id': self.profile_id,
+            'history_limit': self.history_limit,
+            'recent_impacts': [{mood.value: impact for mood, impact in impacts.items()} 
+                               for impacts in self._recent_impacts],
+            'engagement': self.engagement_tracker.to_state(),
+        }
+        if include_history:
+            state['choice_history'] = [choice.to_state() for choice in self.choice_history]
+        return state
+    
+    @classmethod
+    def from_state(cls, state: Dict[str, Any], 
+                   choice_history: List[UserChoice] = None) -> 'UserProfile':
+        if choice_history is None:
+            choice_history = [UserChoice.from_state(choice) for choice in state.get('choice_history', [])]
+        profile = cls(
+            user_id=state['user_id'],
+            preferred_moods=[Mood(mood) for mood in state['preferred_moods']],
+            choice_history=choice_history,
+            engagement_patterns=dict(state['engagement_patterns']),
+            narrative_preferences=dict(state['narrative_preferences']),
+            mood_window=state['mood_window'],
+            mood_decay=state['mood_decay'],
+            mood_scores={mood: state['mood_scores'].get(mood.value, 0.0) for mood in Mood},
+            choice_count=state['choice_count'],
+            preference_version=state.get('preference_version', 0),
+            history_limit=state['history_limit'],
+            engagement_tracker=UserEngagementTracker.from_state(state['engagement'])
+        )
+        if 'profile_id' in state:
+            profile.profile_id = state['profile_id']
+        profile._recent_impacts.extend({Mood(mood): impact for mood, impact in impacts.items()} 
+                                       for impacts in state['recent_impacts'])
+        return profile
+    
+    def dominant_mood(self) -> Mood:
+        # Rounded so float drift from the rolling window cannot break ties;
+        # ties go to the earliest mood in the enum
+        return max(self.mood_scores, key=lambda mood: round(self.mood_scores[mood], 9))
     
     def _update_preferences(self, choice: UserChoice):
         # Update mood preferences based on choices
+        if choice.mood_impact:
+            self.preference_version += 1
         for mood, impact in choice.mood_impact.items():
             if mood.value not in self.narrative_preferences:
                 self.narrative_preferences[mood.value] = 0
             self.narrative_preferences[mood.value] += impact * 0.1
+    
+    def _update_mood_scores(self, choice: UserChoice):
+        if self.mood_decay is not None:
+            for mood in self.mood_scores:
+                self.mood_scores[mood] *= self.mood_decay
+            for mood, impact in choice.mood_impact.items():
+                self.mood_scores[mood] += impact
+            return
+        
+        self._recent_impacts.append(choice.mood_impact)
+        for mood, impact in choice.mood_impact.items():
+            self.mood_scores[mood] += impact
+        
+        if len(self._recent_impacts) > self.mood_window:
+            for mood, impact in self._recent_impacts.popleft().items():
+                self.mood_scores[mood] -= impact
+
+# Tags are interned process-wide; elements store small integer ids
+TAG_IDS = {}  # tag -> id
+TAG_NAMES = []  # id -> tag
+
+def intern_tag(tag: str) -> int:
+    tag_id = TAG_IDS.get(tag)
+    if tag_id is None:
+        tag_id = TAG_IDS[tag] = len(TAG_NAMES)
+        TAG_NAMES.append(tag)
+    return tag_id
+
+MOODS = tuple(Mood)
+
+class MoodWeights(MutableMapping):
+    # Dict-like view over a StoryElement's fixed-width weight array. A mood is
+    # present if its weight is nonzero or it was explicitly set to 0. Writes go
+    # through the element, so an element in a graph keeps the graph's indexes
+    # current.
+    __slots__ = ('element',)
+    
+    def __init__(self, element: 'StoryElement'):
+        self.element = element
+    
+    def __getitem__(self, mood: Mood) -> float:
+        ordinal = MOOD_ORDINALS[mood]
+        weight = self.element.weights[ordinal]
+        if not weight and not self.element.zero_moods >> ordinal & 1:
+            raise KeyError(mood)
+        return weight
+    
+    def __setitem__(self, mood: Mood, weight: float):
+        self.element.set_mood_weight(mood, weight)
+    
+    def __delitem__(self, mood: Mood):
+        if mood not in self:
+            raise KeyError(mood)
+        self.element.set_mood_weight(mood, None)
+    
+    def __contains__(self, mood: object) -> bool:
+        ordinal = MOOD_ORDINALS.get(mood)
+        return ordinal is not None and bool(self.element.weights[ordinal] or self.element.zero_moods >> ordinal & 1)
+    
+    def __iter__(self) -> Iterator[Mood]:
+        return (mood for mood, _ in self.items())
+    
+    def __len__(self) -> int:
+        return len(self.items())
+    
+    def get(self, mood: Mood, default: Any = None) -> Any:
+        return self.element.weights[MOOD_ORDINALS[mood]] if mood in self else default
+    
+    def items(self) -> List[Tuple[Mood, float]]:
+        zero_moods = self.element.zero_moods
+        return [(mood, weight) for ordinal, (mood, weight) in enumerate(zip(MOODS, self.element.weights)) 
+                if weight or zero_moods >> ordinal & 1]
+    
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+class ElementTags(MutableSequence):
+    # List-like view over a StoryElement's interned tag ids. Changes replace
+    # the element's tags through its `tags` setter, so an element in a graph
+    # is indexed under its new tags.
+    __slots__ = ('element',)
+    
+    def __init__(self, element: 'StoryElement'):
+        self.element = element
+    
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            return [TAG_NAMES[tag_id] for tag_id in self.element.tag_ids[index]]
+        return TAG_NAMES[self.element.tag_ids[index]]
+    
+    def __setitem__(self, index: Any, tag: Any):
+        tags = list(self)
+        tags[index] = tag
+        self.element.tags = tags
+    
+    def __delitem__(self, index: Any):
+        tags = list(self)
+        del tags[index]
+        self.element.tags = tags
+    
+    def insert(self, index: int, tag: str):
+        tags = list(self)
+        tags.insert(index, tag)
+        self.element.tags = tags
+    
+    def __len__(self) -> int:
+        return len(self.element.tag_ids)
+    
+    def __iter__(self) -> Iterator[str]:
+        return (TAG_NAMES[tag_id] for tag_id in self.element.tag_ids)
+    
+    def __contains__(self, tag: object) -> bool:
+        return isinstance(tag, str) and self.element.has_tag(tag)
+    
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, (ElementTags, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+    
+    __hash__ = None
+    
+    def __repr__(self) -> str:
+        return repr(list(self))
 
 class StoryElement:
+    # Slotted, with interned tag ids and mood weights in a float array indexed
+    # by mood ordinal; `tags` and `mood_weights` keep their list/dict behaviour
+    # through mutable views, and `relationships` lists outgoing edges.
+    # `graph` is the KnowledgeGraph the element was added to, if any: tag and
+    # weight changes made on the element are routed through it.
+    __slots__ = ('element_id', 'element_type', 'content', 'tag_ids', 'weights', 'zero_moods', 'usage_count', 
+                 'graph')
+    
     def __init__(self, element_id: str, element_type: str, content: str, 
                  tags: List[str] = None, mood_weights: Dict[Mood, float] = None):
+        self.graph = None
         self.element_id = element_id
         self.element_type = element_type
         self.content = content
-        self.tags = tags or []
+        self.tags = tags or ()
+        self.weights = array('d', bytes(8 * len(MOODS)))
+        self.zero_moods = 0  # Bit per mood ordinal explicitly set to a weight of 0
         self.mood_weights = mood_weights or {}
         self.usage_count = 0
-        self.relationships = {}
+    
+    @property
+    def tags(self) -> ElementTags:
+        return ElementTags(self)
+    
+    @tags.setter
+    def tags(self, tags: List[str]):
+        tag_ids = tuple(intern_tag(tag) for tag in tags)
+        if self.graph is None:
+            self.tag_ids = tag_ids
+            return
+        # Adding the element again reindexes it under the new tags
+        self.graph._check_writable()
+        self.tag_ids = tag_ids
+        self.graph.add_element(self)
+    
+    @property
+    def relationships(self) -> Dict[str, str]:
+        # Outgoing edges as a new {to_id: relationship_type} dict; change them
+        # with the graph's add_relationship
+        return self.graph.outgoing_relationships(self.element_id) if self.graph is not None else {}
+    
+    def __getstate__(self) -> Tuple:
+        # Tag ids are only meaningful within this process, so pickle names
+        return (self.element_id, self.element_type, self.content, list(self.tags), 
+                self.weights, self.zero_moods, self.usage_count)
+    
+    def __setstate__(self, state: Tuple):
+        self.graph = None
+        (self.element_id, self.element_type, self.content, tags, self.weights, self.zero_moods, 
+         self.usage_count) = state
+        self.tags = tags
+    
+    def copy(self) -> 'StoryElement':
+        element = StoryElement.__new__(StoryElement)
+        element.element_id = self.element_id
+        element.element_type = self.element_type
+        element.content = self.content
+        element.tag_ids = self.tag_ids
+        element.weights = array('d', self.weights)
+        element.zero_moods = self.zero_moods
+        element.usage_count = self.usage_count
+        element.graph = None
+        return element
+    
+    def has_tag(self, tag: str) -> bool:
+        tag_id = TAG_IDS.get(tag)
+        return tag_id is not None and tag_id in self.tag_ids
+    
+    @property
+    def mood_weights(self) -> MoodWeights:
+        return MoodWeights(self)
+    
+    @mood_weights.setter
+    def mood_weights(self, mood_weights: Dict[Mood, float]):
+        if self.graph is not None:
+            self.graph.set_mood_weights(self.element_id, mood_weights)
+            return
+        for ordinal, mood in enumerate(MOODS):
+            self.store_weight(ordinal, mood_weights.get(mood))
+    
+    def weighted_moods(self) -> List[Tuple[Mood, float]]:
+        # (mood, weight) for nonzero weights, which is what the indexes hold
+        return [(mood, weight) for mood, weight in zip(MOODS, self.weights) if weight]
+    
+    def set_mood_weight(self, mood: Mood, weight: Optional[float]):
+        # Unlike KnowledgeGraph.set_mood_weight, a weight of 0 keeps the mood
+        # listed in mood_weights; None removes it
+        if self.graph is not None:
+            self.graph._write_weights(self.element_id, ((MOOD_ORDINALS[mood], weight),))
+        else:
+            self.store_weight(MOOD_ORDINALS[mood], weight)
+    
+    def store_weight(self, ordinal: int, weight: Optional[float]):
+        # Writes the raw row; graphs call this after unindexing the element
+        self.weights[ordinal] = weight or 0.0
+        if weight is not None and not weight:
+            self.zero_moods |= 1 << ordinal
+        else:
+            self.zero_moods &= ~(1 << ordinal)
+
+def splice_sorted(keys: List[Any], values: List[Any], dropped: Iterable[int],
+                  inserted: Iterable[Tuple[Any, Any]]) -> Tuple[List[Any], List[Any]]:
+    # Parallel sorted lists without the entries at the `dropped` positions and
+    # with the (key, value) pairs `inserted`, built from slices in one pass
+    events = sorted([(position, 1, None, None) for position in dropped] +
+                    [(bisect_left(keys, key), 0, key, value) for key, value in inserted])
+    new_keys, new_values, start = [], [], 0
+    for position, is_drop, key, value in events:
+        new_keys += keys[start:position]
+        new_values += values[start:position]
+        if is_drop:
+            start = position + 1
+        else:
+            start = position
+            new_keys.append(key)
+            new_values.append(value)
+    new_keys += keys[start:]
+    new_values += values[start:]
+    return new_keys, new_values
+
+class MoodWeightIndex:
+    # Changes are collected and merged into the sorted lists on the next read,
+    # so adding n elements one at a time costs O(n log n) rather than O(n^2)
+    IN_PLACE_CHANGES = 16
+    
+    def __init__(self):
+        self.keys = []  # (-weight, insertion_order), ascending
+        self.element_ids = []  # parallel to keys
+        self.added = {}  # key -> element_id, not merged yet
+        self.removed = set()  # keys still in the sorted lists, to be dropped
+    
+    def insert(self, element_id: str, weight: float, order: int):
+        # An order belongs to one element, so a key removed and added back
+        # before the next read still points at the right element
+        key = (-weight, order)
+        if key in self.removed:
+            self.removed.discard(key)
+        else:
+            self.added[key] = element_id
+    
+    def remove(self, weight: float, order: int):
+        key = (-weight, order)
+        if self.added.pop(key, None) is None:
+            position = bisect_left(self.keys, key)
+            if position < len(self.keys) and self.keys[position] == key:
+                self.removed.add(key)
+    
+    def count_at_least(self, threshold: float) -> int:
+        # Position of the first key whose weight drops below threshold
+        self._merge()
+        return bisect_right(self.keys, (-threshold, float('inf')))
+    
+    def at_least(self, threshold: float) -> List[str]:
+        count = self.count_at_least(threshold)
+        return self.element_ids[:count]
+    
+    def _merge(self):
+        if not self.added and not self.removed:
+            return
+        keys, element_ids = self.keys, self.element_ids
+        if len(self.added) + len(self.removed) <= self.IN_PLACE_CHANGES:
+            # A few changes between reads: shifting in place beats copying
+            for key in self.removed:
+                position = bisect_left(keys, key)
+                del keys[position]
+                del element_ids[position]
+            for key, element_id in self.added.items():
+                position = bisect_left(keys, key)
+                keys.insert(position, key)
+                element_ids.insert(position, element_id)
+        else:
+            dropped = [bisect_left(keys, key) for key in self.removed]
+            self.keys, self.element_ids = splice_sorted(keys, element_ids, dropped, sorted(self.added.items()))
+        self.added = {}
+        self.removed = set()
+
+# Set bit positions of every byte value, for decoding bitsets
+BYTE_BITS = tuple(tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256))
+NONZERO_BYTE = re.compile(b'[^\x00]')
+MOOD_BUCKETS = 10  # Mood weights are bucketed in steps of 1 / MOOD_BUCKETS
+
+def mood_bucket(weight: float) -> int:
+    # Monotonic in the weight, so bucket(w) > bucket(t) implies w > t
+    return min(int(weight * MOOD_BUCKETS), MOOD_BUCKETS)
+
+def bitset_ordinals(bits: int) -> Iterator[int]:
+    # Set positions in ascending order; whole zero bytes are skipped in C
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    for match in NONZERO_BYTE.finditer(data):
+        base = match.start() * 8
+        for bit in BYTE_BITS[data[match.start()]]:
+            yield base + bit
+
+class BitsetIndex:
+    # key -> bitset over dense element ordinals. Bitsets are bytearrays so a
+    # single bit flips in place; queries read them as ints (cached until the
+    # bitset next changes) so combining them is one C-level operation.
+    def __init__(self):
+        self.bitsets = {}  # key -> bytearray
+        self.ints = {}  # key -> int view
+    
+    def add(self, key: Any, ordinal: int):
+        bits = self.bitsets.get(key)
+        if bits is None:
+            bits = self.bitsets[key] = bytearray()
+        byte = ordinal >> 3
+        if byte >= len(bits):
+            bits.extend(bytes(byte + 1 - len(bits)))
+        bits[byte] |= 1 << (ordinal & 7)
+        self.ints.pop(key, None)
+    
+    def discard(self, key: Any, ordinal: int):
+        bits = self.bitsets.get(key)
+        byte = ordinal >> 3
+        if bits is not None and byte < len(bits):
+            bits[byte] &= ~(1 << (ordinal & 7)) & 0xFF
+            self.ints.pop(key, None)
+    
+    def get(self, key: Any) -> int:
+        value = self.ints.get(key)
+        if value is None:
+            bits = self.bitsets.get(key)
+            value = self.ints[key] = int.from_bytes(bits, 'little') if bits else 0
+        return value
+    
+    @staticmethod
+    def from_ordinals(ordinals: Iterable[int]) -> int:
+        ordinals = list(ordinals)
+        if not ordinals:
+            return 0
+        bits = bytearray((max(ordinals) >> 3) + 1)
+        for ordinal in ordinals:
+            bits[ordinal >> 3] |= 1 << (ordinal & 7)
+        return int.from_bytes(bits, 'little')
+
+class ElementQuery(ABC):
+    # Composable element filters for KnowledgeGraph.query, combined with
+    # & (and), | (or) and ~ (not). evaluate() returns two bitsets: elements
+    # that surely match, and elements that may match and need matches() to
+    # decide (mood thresholds between bucket boundaries).
+    def __and__(self, other: 'ElementQuery') -> 'ElementQuery':
+        # Chains like a & b & c build one flat AllOf
+        return AllOf(*(self.queries if isinstance(self, AllOf) else (self,)), other)
+    
+    def __or__(self, other: 'ElementQuery') -> 'ElementQuery':
+        return AnyOf(*(self.queries if isinstance(self, AnyOf) else (self,)), other)
+    
+    def __invert__(self) -> 'ElementQuery':
+        return Not(self)
+    
+    @abstractmethod
+    def evaluate(self, graph: 'KnowledgeGraph') -> Tuple[int, int]:
+        pass
+    
+    @abstractmethod
+    def matches(self, graph: 'KnowledgeGraph', element: StoryElement) -> bool:
+        pass
+
+class Tagged(ElementQuery):
+    def __init__(self, tag: str):
+        self.tag = tag
+    
+    def evaluate(self, graph: 'KnowledgeGraph') -> Tuple[int, int]:
+        tag_id = TAG_IDS.get(self.tag)
+        return (graph.bitsets.get(('tag', tag_id)) if tag_id is not None else 0), 0
+    
+    def matches(self, graph: 'KnowledgeGraph', element: StoryElement) -> bool:
+        return element.has_tag(self.tag)
+
+class OfType(ElementQuery):
+    def __init__(self, element_type: str):
+        self.element_type = element_type
+    
+    def evaluate(self, graph: 'KnowledgeGraph') -> Tuple[int, int]:
+        return graph.bitsets.get(('type', self.element_type)), 0
+    
+    def matches(self, graph: 'KnowledgeGraph', element: StoryElement) -> bool:
+        return element.element_type == self.element_type
+
+class MoodAtLeast(ElementQuery):
+    # Same semantics as find_elements_by_mood: weight >= threshold, and a
+    # threshold <= 0 matches everything
+    def __init__(self, mood: Mood, threshold: float = 0.5):
+        self.mood = mood
+        self.threshold = threshold
+    
+    def evaluate(self, graph: 'KnowledgeGraph') -> Tuple[int, int]:
+        if self.threshold <= 0:
+            return graph.bitsets.get('all'), 0
+        bucket = mood_bucket(self.threshold)
+        sure = graph.bitsets.get(('mood', self.mood, bucket + 1)) if bucket < MOOD_BUCKETS else 0
+        return sure, graph.bitsets.get(('mood', self.mood, bucket)) & ~sure
+    
+    def matches(self, graph: 'KnowledgeGraph', element: StoryElement) -> bool:
+        return self.threshold <= 0 or element.mood_weights.get(self.mood, 0) >= self.threshold
+
+class RelatedTo(ElementQuery):
+    # Targets of element_id's outgoing relationships (optionally of one type)
+    def __init__(self, element_id: str, relationship_type: str = None):
+        self.element_id = element_id
+        self.relationship_type = relationship_type
+    
+    def evaluate(self, graph: 'KnowledgeGraph') -> Tuple[int, int]:
+        nodes, ordinals = graph.nodes, graph.ordinals
+        return BitsetIndex.from_ordinals(
+            ordinals[neighbor_id] for neighbor_id, relationship_type in graph.outgoing.get(self.element_id, {}).items()
+            if neighbor_id in nodes and self.relationship_type in (None, relationship_type)), 0
+    
+    def matches(self, graph: 'KnowledgeGraph', element: StoryElement) -> bool:
+        relationship_type = graph.outgoing.get(self.element_id, {}).get(element.element_id)
+        return relationship_type is not None and self.relationship_type in (None, relationship_type)
+
+class AllOf(ElementQuery):
+    def __init__(self, *queries: ElementQuery):
+        self.queries = queries
+    
+    def evaluate(self, graph: 'KnowledgeGraph') -> Tuple[int, int]:
+        sure = possible = graph.bitsets.get('all')
+        for query in self.queries:
+            query_sure, query_maybe = query.evaluate(graph)
+            sure &= query_sure
+            possible &= query_sure | query_maybe
+        return sure, possible & ~sure
+    
+    def matches(self, graph: 'KnowledgeGraph', element: StoryElement) -> bool:
+        return all(query.matches(graph, element) for query in self.queries)
+
+class AnyOf(ElementQuery):
+    def __init__(self, *queries: ElementQuery):
+        self.queries = queries
+    
+    def evaluate(self, graph: 'KnowledgeGraph') -> Tuple[int, int]:
+        sure = maybe = 0
+        for query in self.queries:
+            query_sure, query_maybe = query.evaluate(graph)
+            sure |= query_sure
+            maybe |= query_maybe
+        return sure, maybe & ~sure
+    
+    def matches(self, graph: 'KnowledgeGraph', element: StoryElement) -> bool:
+        return any(query.matches(graph, element) for query in self.queries)
+
+class Not(ElementQuery):
+    def __init__(self, query: ElementQuery):
+        self.query = query
+    
+    def evaluate(self, graph: 'KnowledgeGraph') -> Tuple[int, int]:
+        sure, maybe = self.query.evaluate(graph)
+        return graph.bitsets.get('all') & ~(sure | maybe), maybe
+    
+    def matches(self, graph: 'KnowledgeGraph', element: StoryElement) -> bool:
+        return not self.query.matches(graph, element)
 
 class KnowledgeGraph:
     def __init__(self):
         self.nodes = {}  # element_id -> StoryElement
         self.relationships = {}  # (from_id, to_id) -> relationship_type
-        
+        self.outgoing = defaultdict(dict)  # from_id -> {to_id: relationship_type}
+        self.incoming = defaultdict(dict)  # to_id -> {from_id: relationship_type}
+        self.relationships_by_type = defaultdict(dict)  # relationship_type -> {(from_id, to_id): None}
+        self.mood_index = defaultdict(MoodWeightIndex)  # (mood, element_type or None) -> MoodWeightIndex
+        self.ordinals = {}  # element_id -> dense ordinal, also breaks weight ties
+        self.ordinal_ids = []  # ordinal -> element_id
+        # Dense elements x Mood weights and per-element usage, rows by ordinal
+        self.mood_matrix = np.zeros((16, len(Mood))) if np is not None else None
+        self.usage_counts = np.zeros(16) if np is not None else None
+        # ('tag', tag_id), ('type', element_type), ('mood', mood, bucket) and
+        # 'all' -> bitset over ordinals; mood buckets are cumulative, so
+        # bucket b holds every element with mood_bucket(weight) >= b
+        self.bitsets = BitsetIndex()
+        # What each ordinal was last indexed under (type, tag ids and a row of
+        # mood weights), so an element changed in place and added again is
+        # unindexed from its old values rather than its current ones
+        self.indexed_types = []
+        self.indexed_tags = []
+        self.indexed_weights = array('d')
+        self.indexing_deferred = False  # See deferred_indexing()
+        # Bumped on every change to elements, weights or relationships;
+        # cached query results are keyed on it
+        self.version = 0
+        # Bumped by record_usage instead, since usage only moves recommendation
+        # scores: serving content leaves pools and pregenerated renders valid
+        self.usage_version = 0
+        self.frozen = False  # See freeze()
+    
+    def freeze(self) -> 'KnowledgeGraph':
+        # Shared bases of overlays are frozen: changes then raise and have to
+        # go through an overlay
+        self.frozen = True
+        return self
+    
+    def overlay(self) -> 'OverlayKnowledgeGraph':
+        # A per-tenant copy-on-write view of this graph, which gets frozen
+        return OverlayKnowledgeGraph(self)
+    
+    def _changed(self):
+        self._check_writable()
+        self.version += 1
+    
+    def _check_writable(self):
+        if self.frozen:
+            raise RuntimeError('this graph is frozen; change it through an overlay')
+    
     def add_element(self, element: StoryElement):
+        self._changed()
+        previous = self.nodes.get(element.element_id)
+        if previous is None:
+            self.ordinals[element.element_id] = len(self.ordinal_ids)
+            self.ordinal_ids.append(element.element_id)
+        elif not self.indexing_deferred:
+            self._unindex(element.element_id)
+        
+        if previous is not None and previous is not element:
+            previous.graph = None
+        element.graph = self
         self.nodes[element.element_id] = element
+        if not self.indexing_deferred:
+            self._index(element)
+            self._update_matrix_row(element)
+    
+    def set_mood_weight(self, element_id: str, mood: Mood, weight: float):
+        # A zero weight removes the mood
+        self._write_weights(element_id, ((MOOD_ORDINALS[mood], weight or None),))
+    
+    def set_mood_weights(self, element_id: str, mood_weights: Dict[Mood, float]):
+        # Replaces all of the element's weights; moods given as 0 stay listed
+        self._write_weights(element_id, [(ordinal, mood_weights.get(mood)) 
+                                         for ordinal, mood in enumerate(MOODS)])
+    
+    def _write_weights(self, element_id: str, weights: Iterable[Tuple[int, Optional[float]]]):
+        # (ordinal, weight) pairs, None for a mood to remove (see StoryElement.store_weight)
+        self._changed()
+        element = self.nodes[element_id]
+        if not self.indexing_deferred:
+            self._unindex(element_id)
+        for ordinal, weight in weights:
+            element.store_weight(ordinal, weight)
+        if not self.indexing_deferred:
+            self._index(element)
+            self._update_matrix_row(element)
+    
+    def record_usage(self, element_id: str, count: int = 1):
+        # Go through here rather than bumping usage_count directly, so the
+        # matrix and cached recommendations stay current
+        self._check_writable()
+        self.usage_version += 1
+        element = self.nodes[element_id]
+        element.usage_count += count
+        if self.usage_counts is not None and not self.indexing_deferred:
+            self.usage_counts[self.ordinals[element_id]] = element.usage_count
+    
+    @contextmanager
+    def deferred_indexing(self):
+        # For bulk loads: inside the block only nodes and the relationship map
+        # are written, and every secondary index is rebuilt once on exit
+        self.indexing_deferred = True
+        try:
+            yield self
+        finally:
+            self.indexing_deferred = False
+            self.rebuild_indexes()
+    
+    def rebuild_indexes(self):
+        self._changed()
+        self.outgoing = defaultdict(dict)
+        self.incoming = defaultdict(dict)
+        self.relationships_by_type = defaultdict(dict)
+        for (from_id, to_id), relationship_type in self.relationships.items():
+            self.outgoing[from_id][to_id] = relationship_type
+            self.incoming[to_id][from_id] = relationship_type
+            self.relationships_by_type[relationship_type][(from_id, to_id)] = None
+        
+        # Collect every (mood, type) entry, then sort each index once
+        entries = defaultdict(list)
+        self.indexed_types, self.indexed_tags, self.indexed_weights = [], [], array('d')
+        for element_id, element in self.nodes.items():
+            order = self.ordinals[element_id]
+            self._remember_indexed(order, element)
+            for mood, weight in element.weighted_moods():
+                entries[(mood, None)].append(((-weight, order), element_id))
+                entries[(mood, element.element_type)].append(((-weight, order), element_id))
+        self.mood_index = defaultdict(MoodWeightIndex)
+        for key, index_entries in entries.items():
+            index_entries.sort()
+            index = self.mood_index[key]
+            index.keys = [entry_key for entry_key, _ in index_entries]
+            index.element_ids = [element_id for _, element_id in index_entries]
+        
+        members = defaultdict(list)
+        for element_id, element in self.nodes.items():
+            for key in self._bit_keys(element):
+                members[key].append(self.ordinals[element_id])
+        self.bitsets = BitsetIndex()
+        for key, ordinals in members.items():
+            bits = bytearray((max(ordinals) >> 3) + 1)
+            for ordinal in ordinals:
+                bits[ordinal >> 3] |= 1 << (ordinal & 7)
+            self.bitsets.bitsets[key] = bits
+        
+        if np is not None:
+            capacity = max(16, len(self.ordinal_ids))
+            self.mood_matrix = np.zeros((capacity, len(Mood)))
+            self.usage_counts = np.zeros(capacity)
+            for element_id, element in self.nodes.items():
+                self._update_matrix_row(element)
+    
+    def weight_matrix(self) -> Optional[Tuple[Any, Any]]:
+        # (mood weights, usage counts) views over live rows, None without NumPy
+        if self.mood_matrix is None:
+            return None
+        size = len(self.ordinal_ids)
+        return self.mood_matrix[:size], self.usage_counts[:size]
+    
+    def _update_matrix_row(self, element: StoryElement):
+        if self.mood_matrix is None:
+            return
+        ordinal = self.ordinals[element.element_id]
+        if ordinal >= len(self.mood_matrix):
+            capacity = max(2 * len(self.mood_matrix), ordinal + 1)
+            mood_matrix, usage_counts = np.zeros((capacity, len(Mood))), np.zeros(capacity)
+            mood_matrix[:len(self.mood_matrix)] = self.mood_matrix
+            usage_counts[:len(self.usage_counts)] = self.usage_counts
+            self.mood_matrix, self.usage_counts = mood_matrix, usage_counts
+        
+        self.mood_matrix[ordinal] = element.weights
+        self.usage_counts[ordinal] = element.usage_count
+    
+    def _index(self, element: StoryElement):
+        order = self.ordinals[element.element_id]
+        for mood, weight in element.weighted_moods():
+            self.mood_index[(mood, None)].insert(element.element_id, weight, order)
+            self.mood_index[(mood, element.element_type)].insert(element.element_id, weight, order)
+            for bucket in range(mood_bucket(weight) + 1):
+                self.bitsets.add(('mood', mood, bucket), order)
+        self.bitsets.add('all', order)
+        self.bitsets.add(('type', element.element_type), order)
+        for tag_id in element.tag_ids:
+            self.bitsets.add(('tag', tag_id), order)
+        self._remember_indexed(order, element)
+    
+    def _unindex(self, element_id: str):
+        # Undoes _index from the remembered values
+        order = self.ordinals[element_id]
+        element_type, tag_ids, weights = self._indexed_as(order)
+        for mood, weight in zip(MOODS, weights):
+            if not weight:
+                continue
+            self.mood_index[(mood, None)].remove(weight, order)
+            self.mood_index[(mood, element_type)].remove(weight, order)
+            for bucket in range(mood_bucket(weight) + 1):
+                self.bitsets.discard(('mood', mood, bucket), order)
+        self.bitsets.discard('all', order)
+        self.bitsets.discard(('type', element_type), order)
+        for tag_id in tag_ids:
+            self.bitsets.discard(('tag', tag_id), order)
+    
+    def _remember_indexed(self, order: int, element: StoryElement):
+        missing = order + 1 - len(self.indexed_types)
+        if missing > 0:
+            self.indexed_types.extend([None] * missing)
+            self.indexed_tags.extend([()] * missing)
+            self.indexed_weights.frombytes(bytes(8 * len(MOODS) * missing))
+        self.indexed_types[order] = element.element_type
+        self.indexed_tags[order] = element.tag_ids
+        start = order * len(MOODS)
+        self.indexed_weights[start:start + len(MOODS)] = element.weights
+    
+    def _indexed_as(self, order: int) -> Tuple[str, Tuple[int, ...], Sequence[float]]:
+        start = order * len(MOODS)
+        return self.indexed_types[order], self.indexed_tags[order], self.indexed_weights[start:start + len(MOODS)]
+    
+    def _bit_keys(self, element: StoryElement) -> List[Any]:
+        keys = ['all', ('type', element.element_type)]
+        keys.extend(('tag', tag_id) for tag_id in element.tag_ids)
+        for mood, weight in element.weighted_moods():
+            keys.extend(('mood', mood, bucket) for bucket in range(mood_bucket(weight) + 1))
+        return keys
+    
+    def query(self, query: ElementQuery, limit: int = None) -> List[StoryElement]:
+        # Elements matching `query` in insertion order, e.g.
+        # OfType('character') & Tagged('mysterious') & ~Tagged('evil')
+        #     & MoodAtLeast(Mood.MYSTERIOUS, 0.6) & RelatedTo('hero_1')
+        sure, maybe = query.evaluate(self)
+        nodes, ordinal_ids = self.nodes, self.ordinal_ids
+        undecided = set(bitset_ordinals(maybe)) if maybe else ()
+        results = []
+        for ordinal in bitset_ordinals(sure | maybe):
+            element = nodes[ordinal_ids[ordinal]]
+            if ordinal in undecided and not query.matches(self, element):
+                continue
+            results.append(element)
+            if limit is not None and len(results) >= limit:
+                break
+        return results
     
     def add_relationship(self, from_id: str, to_id: str, relationship_type: str):
+        self._changed()
+        if self.indexing_deferred:
+            self.relationships[(from_id, to_id)] = relationship_type
+            return
+        
+        previous_type = self.relationships.get((from_id, to_id))
+        if previous_type is not None and previous_type != relationship_type:
+            del self.relationships_by_type[previous_type][(from_id, to_id)]
+            if not self.relationships_by_type[previous_type]:
+                del self.relationships_by_type[previous_type]
+        
         self.relationships[(from_id, to_id)] = relationship_type
+        self.outgoing[from_id][to_id] = relationship_type
+        self.incoming[to_id][from_id] = relationship_type
+        self.relationships_by_type[relationship_type][(from_id, to_id)] = None
         
     def get_related_elements(self, element_id: str, relationship_type: str = None) -> List[StoryElement]:
+        return self._collect_neighbors(self.outgoing.get(element_id), relationship_type)
+    
+    def get_referring_elements(self, element_id: str, relationship_type: str = None) -> List[StoryElement]:
+        # Reverse lookup, e.g. everything that `resides_in` a location
+        return self._collect_neighbors(self.incoming.get(element_id), relationship_type)
+    
+    def get_relationships_by_type(self, relationship_type: str) -> List[Tuple[str, str]]:
+        return list(self.relationships_by_type.get(relationship_type, ()))
+    
+    def outgoing_relationships(self, element_id: str) -> Dict[str, str]:
+        # {to_id: relationship_type}, a copy
+        return dict(self.outgoing.get(element_id) or {})
+    
+    def _collect_neighbors(self, neighbors: Optional[Dict[str, str]], 
+                           relationship_type: str = None) -> List[StoryElement]:
+        if not neighbors:
+            return []
         related = []
-        for (from_id, to_id), rel_type in self.relationships.items():
-            if from_id == element_id and (relationship_type is None or rel_type == relationship_type):
-                if to_id in self.nodes:
-                    related.append(self.nodes[to_id])
+        for neighbor_id, rel_type in neighbors.items():
+            if relationship_type is None or rel_type == relationship_type:
+                if neighbor_id in self.nodes:
+                    related.append(self.nodes[neighbor_id])
         return related
     
-    def find_elements_by_mood(self, mood: Mood, threshold: float = 0.5) -> List[StoryElement]:
-        return [element for element in self.nodes.values() 
-                if element.mood_weights.get(mood, 0) >= threshold]
+    def find_elements_by_mood(self, mood: Mood, threshold: float = 0.5, 
+                              element_type: str = None) -> List[StoryElement]:
+        # Strongest matches first
+        if threshold <= 0:
+            # Elements without an explicit weight count as 0 and still qualify
+            return sorted((element for element in self.nodes.values()
+                           if element_type is None or element.element_type == element_type),
+                          key=lambda element: -element.mood_weights.get(mood, 0))
+        
+        index = self.mood_index.get((mood, element_type))
+        if index is None:
+            return []
+        return [self.nodes[element_id] for element_id in index.at_least(threshold)]
+    
+    def _mood_entries(self, mood: Mood, threshold: float, 
+                      element_type: str = None) -> Tuple[List[Tuple[float, int]], List[str]]:
+        # Parallel (-weight, ordinal) keys and element ids for weight >= threshold,
+        # strongest first; fresh lists the caller may change
+        index = self.mood_index.get((mood, element_type))
+        if index is None:
+            return [], []
+        count = index.count_at_least(threshold)
+        return index.keys[:count], index.element_ids[:count]
+
+class LayeredMapping(Mapping):
+    # Read-only merged view: `local` entries override `base`, keys in
+    # `removed` (never also in `local`) are hidden. Base keys keep their base
+    # order; new keys follow.
+    def __init__(self, base: Mapping, local: Dict[Any, Any], removed: set):
+        self.base = base
+        self.local = local
+        self.removed = removed
+    
+    def __getitem__(self, key: Any) -> Any:
+        if key in self.local:
+            return self.local[key]
+        if key in self.removed:
+            raise KeyError(key)
+        return self.base[key]
+    
+    def __contains__(self, key: object) -> bool:
+        return key in self.local or (key not in self.removed and key in self.base)
+    
+    def __iter__(self) -> Iterator[Any]:
+        local, removed, base = self.local, self.removed, self.base
+        for key in base:
+            if key not in removed:
+                yield key
+        for key in local:
+            if key not in base:
+                yield key
+    
+    def __len__(self) -> int:
+        base = self.base
+        return len(base) - len(self.removed) + sum(1 for key in self.local if key not in base)
+
+class LayeredAdjacency(Mapping):
+    # element_id -> {neighbor_id: relationship_type} over an overlay's edges:
+    # the base's minus removed edges, with local edges added or retyped
+    def __init__(self, base: Mapping, local: Dict[str, Dict[str, str]], removed: Dict[str, set]):
+        self.base = base
+        self.local = local
+        self.removed = removed
+    
+    def __getitem__(self, element_id: str) -> Dict[str, str]:
+        base = self.base.get(element_id)
+        local = self.local.get(element_id)
+        removed = self.removed.get(element_id)
+        if not local and not removed:
+            if not base:
+                raise KeyError(element_id)
+            return base
+        neighbors = {}
+        if base:
+            for neighbor_id, relationship_type in base.items():
+                if not removed or neighbor_id not in removed:
+                    neighbors[neighbor_id] = relationship_type
+        if local:
+            neighbors.update(local)
+        if not neighbors:
+            raise KeyError(element_id)
+        return neighbors
+    
+    def __iter__(self) -> Iterator[str]:
+        for element_id in dict.fromkeys([*self.base, *self.local]):
+            if element_id in self:
+                yield element_id
+    
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+class ConcatenatedIds(Sequence):
+    # ordinal -> element_id for an overlay: the base's ordinals, then its own
+    def __init__(self, base: Sequence, extra: List[str]):
+        self.base = base
+        self.extra = extra
+    
+    def __getitem__(self, ordinal: int) -> str:
+        base_size = len(self.base)
+        return self.base[ordinal] if ordinal < base_size else self.extra[ordinal - base_size]
+    
+    def __len__(self) -> int:
+        return len(self.base) + len(self.extra)
+
+class LayeredBitsets:
+    # An overlay's bitsets: the base's with shadowed ordinals (base elements
+    # the overlay overrides or deletes) cleared, or'ed with the overlay's own.
+    # The overlay's own members are kept as ordinal sets, as they are few;
+    # merged bitsets are cached per key until either side changes.
+    def __init__(self, base: BitsetIndex):
+        self.base = base
+        self.members = defaultdict(set)  # key -> ordinals of the overlay's own elements
+        self.shadowed = 0
+        self.merged = {}
+    
+    def add(self, key: Any, ordinal: int):
+        self.members[key].add(ordinal)
+        self.merged.pop(key, None)
+    
+    def discard(self, key: Any, ordinal: int):
+        members = self.members.get(key)
+        if members is not None:
+            members.discard(ordinal)
+            self.merged.pop(key, None)
+    
+    def shadow(self, ordinal: int):
+        self.shadowed |= 1 << ordinal
+        self.merged.clear()
+    
+    def get(self, key: Any) -> int:
+        value = self.merged.get(key)
+        if value is None:
+            value = self.merged[key] = (self.base.get(key) & ~self.shadowed 
+                                        | BitsetIndex.from_ordinals(self.members.get(key, ())))
+        return value
+
+class OverlayKnowledgeGraph(KnowledgeGraph):
+    # A tenant's copy-on-write layer over a shared, frozen base graph. Added
+    # and changed elements and edges live here, deletions hide base entries,
+    # and the base is never written: weight changes and record_usage copy
+    # the base element into the overlay first, so usage counts are per
+    # tenant. Lookups, neighbor and mood queries, bitset queries and
+    # recommendations read through both layers; nothing from the base is
+    # copied. Once the overlay changes an element, recommendations take the
+    # per-mood index path, as the dense weight matrix would have to be
+    # materialized per tenant.
+    def __init__(self, base: KnowledgeGraph):
+        super().__init__()
+        self.base = base.freeze()
+        self.local_nodes = {}  # element_id -> StoryElement added or overridden here
+        self.removed_nodes = set()  # base element ids deleted here
+        self.shadowed_ids = set()  # base element ids overridden or deleted here
+        self.local_relationships = {}  # (from_id, to_id) -> relationship_type added or retyped here
+        self.removed_relationships = set()  # base (from_id, to_id) deleted here
+        self.local_outgoing = defaultdict(dict)
+        self.local_incoming = defaultdict(dict)
+        self.removed_outgoing = defaultdict(set)  # from_id -> to_ids of deleted base edges
+        self.removed_incoming = defaultdict(set)
+        self.extra_ids = []  # Ordinals past the base's, for elements new here
+        self.indexed = {}  # ordinal -> (element_type, tag_ids, weights) of this overlay's own elements
+        
+        self.nodes = LayeredMapping(base.nodes, self.local_nodes, self.removed_nodes)
+        self.relationships = LayeredMapping(base.relationships, self.local_relationships, 
+                                            self.removed_relationships)
+        self.outgoing = LayeredAdjacency(base.outgoing, self.local_outgoing, self.removed_outgoing)
+        self.incoming = LayeredAdjacency(base.incoming, self.local_incoming, self.removed_incoming)
+        self.ordinals = ChainMap({}, base.ordinals)
+        self.ordinal_ids = ConcatenatedIds(base.ordinal_ids, self.extra_ids)
+        self.bitsets = LayeredBitsets(base.bitsets)
+        self.mood_matrix = None
+        self.usage_counts = None
+    
+    def add_element(self, element: StoryElement):
+        self._changed()
+        element_id = element.element_id
+        previous = self.local_nodes.get(element_id)
+        if previous is not None:
+            if not self.indexing_deferred:
+                self._unindex(element_id)
+        elif element_id in self.base.nodes:
+            self.removed_nodes.discard(element_id)
+            self._shadow(element_id)
+        elif element_id not in self.ordinals:
+            self.ordinals[element_id] = len(self.ordinal_ids)
+            self.extra_ids.append(element_id)
+        
+        if previous is not None and previous is not element:
+            previous.graph = None
+        element.graph = self
+        self.local_nodes[element_id] = element
+        if not self.indexing_deferred:
+            self._index(element)
+    
+    def remove_element(self, element_id: str):
+        # Edges to and from the element stay but are skipped, as for any
+        # missing element
+        self._changed()
+        previous = self.local_nodes.pop(element_id, None)
+        if previous is not None:
+            previous.graph = None
+            if not self.indexing_deferred:
+                self._unindex(element_id)
+        if element_id in self.base.nodes and element_id not in self.removed_nodes:
+            self.removed_nodes.add(element_id)
+            self._shadow(element_id)
+        elif previous is None:
+            raise KeyError(element_id)
+    
+    def _write_weights(self, element_id: str, weights: Iterable[Tuple[int, Optional[float]]]):
+        self._own(element_id)
+        super()._write_weights(element_id, weights)
+    
+    def record_usage(self, element_id: str, count: int = 1):
+        self._own(element_id)
+        super().record_usage(element_id, count)
+    
+    def add_relationship(self, from_id: str, to_id: str, relationship_type: str):
+        self._changed()
+        self.local_relationships[(from_id, to_id)] = relationship_type
+        self.local_outgoing[from_id][to_id] = relationship_type
+        self.local_incoming[to_id][from_id] = relationship_type
+        if (from_id, to_id) in self.removed_relationships:
+            self.removed_relationships.discard((from_id, to_id))
+            self.removed_outgoing[from_id].discard(to_id)
+            self.removed_incoming[to_id].discard(from_id)
+    
+    def remove_relationship(self, from_id: str, to_id: str):
+        self._changed()
+        found = self.local_relationships.pop((from_id, to_id), None) is not None
+        if found:
+            del self.local_outgoing[from_id][to_id]
+            del self.local_incoming[to_id][from_id]
+        if (from_id, to_id) in self.base.relationships and (from_id, to_id) not in self.removed_relationships:
+            self.removed_relationships.add((from_id, to_id))
+            self.removed_outgoing[from_id].add(to_id)
+            self.removed_incoming[to_id].add(from_id)
+        elif not found:
+            raise KeyError((from_id, to_id))
+    
+    def get_relationships_by_type(self, relationship_type: str) -> List[Tuple[str, str]]:
+        local, removed = self.local_relationships, self.removed_relationships
+        pairs = [pair for pair in self.base.get_relationships_by_type(relationship_type)
+                 if pair not in removed and pair not in local]
+        pairs.extend(pair for pair, pair_type in local.items() if pair_type == relationship_type)
+        return pairs
+    
+    def rebuild_indexes(self):
+        # Only the overlay's own elements are indexed here
+        self._changed()
+        self.mood_index = defaultdict(MoodWeightIndex)
+        self.bitsets = LayeredBitsets(self.base.bitsets)
+        for element_id in self.shadowed_ids:
+            self.bitsets.shadow(self.ordinals[element_id])
+        self.indexed = {}
+        for element in self.local_nodes.values():
+            self._index(element)
+    
+    def weight_matrix(self) -> Optional[Tuple[Any, Any]]:
+        # The base's matrix is exact until this overlay changes an element
+        if self.local_nodes or self.shadowed_ids:
+            return None
+        return self.base.weight_matrix()
+    
+    def find_elements_by_mood(self, mood: Mood, threshold: float = 0.5, 
+                              element_type: str = None) -> List[StoryElement]:
+        if threshold <= 0:
+            return super().find_elements_by_mood(mood, threshold, element_type)
+        local, base_nodes = self.local_nodes, self.base.nodes
+        return [local.get(element_id) or base_nodes[element_id] 
+                for element_id in self._mood_entries(mood, threshold, element_type)[1]]
+    
+    def _mood_entries(self, mood: Mood, threshold: float, 
+                      element_type: str = None) -> Tuple[List[Tuple[float, int]], List[str]]:
+        # The base's entries with the shadowed ones taken out (found by their
+        # base key) and the overlay's own merged in, in one pass of slices
+        keys, element_ids = self.base._mood_entries(mood, threshold, element_type)
+        mood_ordinal = MOOD_ORDINALS[mood]
+        dropped = []
+        for element_id in self.shadowed_ids:
+            order = self.ordinals[element_id]
+            indexed_type, _, weights = self.base._indexed_as(order)
+            if element_type not in (None, indexed_type):
+                continue
+            weight = weights[mood_ordinal]
+            if weight < threshold:
+                continue
+            position = bisect_left(keys, (-weight, order))
+            if position < len(keys) and element_ids[position] == element_id:
+                dropped.append(position)
+        
+        local_keys, local_ids = super()._mood_entries(mood, threshold, element_type)
+        if not dropped and not local_keys:
+            return keys, element_ids
+        return splice_sorted(keys, element_ids, dropped, zip(local_keys, local_ids))
+    
+    def _remember_indexed(self, order: int, element: StoryElement):
+        self.indexed[order] = (element.element_type, element.tag_ids, array('d', element.weights))
+    
+    def _indexed_as(self, order: int) -> Tuple[str, Tuple[int, ...], Sequence[float]]:
+        indexed = self.indexed.get(order)
+        return indexed if indexed is not None else self.base._indexed_as(order)
+    
+    def _own(self, element_id: str) -> StoryElement:
+        # Copy-on-write: the overlay's own copy of a base element
+        element = self.local_nodes.get(element_id)
+        if element is None:
+            element = self.nodes[element_id].copy()
+            self.add_element(element)
+        return element
+    
+    def _shadow(self, element_id: str):
+        if element_id not in self.shadowed_ids:
+            self.shadowed_ids.add(element_id)
+            self.bitsets.shadow(self.ordinals[element_id])
 
 class UserEngagementTracker:
-    def __init__(self):
+    # Fixed cutoffs (seconds) used until a user has enough samples of their own
+    HIGH_ENGAGEMENT_CUTOFF = 3
+    LOW_ENGAGEMENT_CUTOFF = 10
+    LEVELS = tuple(EngagementLevel)  # Level of each code stored in the ring buffer
+    LEVEL_CODES = {level: code for code, level in enumerate(LEVELS)}
+    
+    def __init__(self, capacity: int = 256, min_samples: int = 5):
         self.session_start = time.time()
-        self.interaction_log = []
         self.current_mood = Mood.CONTEMPLATIVE
+        self.capacity = capacity
+        self.min_samples = min_samples
+        
+        # Ring buffer of the most recent interactions. The buffers grow with
+        # the first `capacity` choices, so a new profile only pays for empty ones.
+        self.timestamps = array('d')
+        self.response_times = array('d')
+        self.choice_ids = []
+        self.levels = bytearray()  # LEVEL_CODES of each interaction's engagement
+        self.next_slot = 0
+        self.size = 0
+        
+        # Streaming statistics over the ring buffer; total_choices is the
+        # only lifetime figure
+        self.total_choices = 0
+        self.response_time_sum = 0.0
+        self.sorted_response_times = []
+        self.engagement_counts = {level: 0 for level in EngagementLevel}
         
-    def track_choice(self, choice_time: float, choice_id: str) -> EngagementLevel:
-        self.interaction_log.append({
-            'timestamp': time.time(),
-            'choice_time': choice_time,
-            'choice_id': choice_id
-        })
+    def track_choice(self, choice_time: float, choice_id: str, 
+                     timestamp: float = None) -> EngagementLevel:
+        # Classify against the user's history before this choice joins it
+        engagement = self.classify_response_time(choice_time)
+        self._record(choice_time, choice_id, time.time() if timestamp is None else timestamp, engagement)
+        return engagement
+    
+    def _record(self, choice_time: float, choice_id: str, timestamp: float, engagement: EngagementLevel):
+        slot = self.next_slot
+        code = self.LEVEL_CODES[engagement]
+        if self.size == self.capacity:
+            expired = self.response_times[slot]
+            self.response_time_sum -= expired
+            del self.sorted_response_times[bisect_left(self.sorted_response_times, expired)]
+            self.engagement_counts[self.LEVELS[self.levels[slot]]] -= 1
+            self.timestamps[slot] = timestamp
+            self.response_times[slot] = choice_time
+            self.choice_ids[slot] = choice_id
+            self.levels[slot] = code
+        else:
+            # Still filling up: the next slot is the end of the buffers
+            self.size += 1
+            self.timestamps.append(timestamp)
+            self.response_times.append(choice_time)
+            self.choice_ids.append(choice_id)
+            self.levels.append(code)
+        self.next_slot = (slot + 1) % self.capacity
         
-        # Determine engagement based on response time
-        if choice_time < 3:
+        self.response_time_sum += choice_time
+        insort(self.sorted_response_times, choice_time)
+        self.engagement_counts[engagement] += 1
+        self.total_choices += 1
+    
+    def recent_interactions(self) -> List[Tuple[float, float, str]]:
+        # (timestamp, response_time, choice_id), oldest first
+        return [(self.timestamps[slot], self.response_times[slot], self.choice_ids[slot]) 
+                for slot in self._slots()]
+    
+    def _slots(self) -> List[int]:
+        start = (self.next_slot - self.size) % self.capacity
+        return [(start + offset) % self.capacity for offset in range(self.size)]
+    
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            'capacity': self.capacity,
+            'min_samples': self.min_samples,
+            'session_start': self.session_start,
+            'current_mood': self.current_mood.value,
+            'interactions': self.recent_interactions(),
+            'engagement_levels': [self.LEVELS[self.levels[slot]].value for slot in self._slots()],
+            'total_choices': self.total_choices,
+        }
+    
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'UserEngagementTracker':
+        tracker = cls(capacity=state['capacity'], min_samples=state['min_samples'])
+        tracker.session_start = state['session_start']
+        tracker.current_mood = Mood(state['current_mood'])
+        levels = state.get('engagement_levels')
+        for position, (timestamp, response_time, choice_id) in enumerate(state['interactions']):
+            # States saved without levels get them classified again
+            engagement = (EngagementLevel(levels[position]) if levels is not None 
+                          else tracker.classify_response_time(response_time))
+            tracker._record(response_time, choice_id, timestamp, engagement)
+        tracker.total_choices = state['total_choices']
+        return tracker
+    
+    def classify_response_time(self, choice_time: float) -> EngagementLevel:
+        if self.size < self.min_samples:
+            if choice_time < self.HIGH_ENGAGEMENT_CUTOFF:
+                return EngagementLevel.HIGH
+            elif choice_time < self.LOW_ENGAGEMENT_CUTOFF:
+                return EngagementLevel.MEDIUM
+            else:
+                return EngagementLevel.LOW
+        
+        # At or under this user's median is high, slower than their p95 is low
+        if choice_time <= self.percentile(0.5):
             return EngagementLevel.HIGH
-        elif choice_time < 10:
+        elif choice_time <= self.percentile(0.95):
             return EngagementLevel.MEDIUM
         else:
             return EngagementLevel.LOW
     
-    def infer_mood(self, recent_choices: List[UserChoice]) -> Mood:
-        if not recent_choices:
+    def mean_response_time(self) -> float:
+        return self.response_time_sum / self.size if self.size else 0.0
+    
+    def percentile(self, fraction: float) -> float:
+        if not self.size:
+            return 0.0
+        # Nearest-rank percentile over the current window
+        rank = max(0, min(self.size - 1, int(fraction * self.size + 0.5) - 1))
+        return self.sorted_response_times[rank]
+    
+    def rolling_stats(self) -> Dict[str, float]:
+        # Engagement counts cover the same window as the response times
+        stats = {
+            'mean_response_time': self.mean_response_time(),
+            'p50_response_time': self.percentile(0.5),
+            'p95_response_time': self.percentile(0.95),
+            'total_choices': float(self.total_choices),
+        }
+        for level, count in self.engagement_counts.items():
+            stats[f'{level.value}_engagement_count'] = float(count)
+        return stats
+    
+    def infer_profile_mood(self, user_profile: UserProfile) -> Mood:
+        # Constant time: reads the profile's rolling mood scores
+        if not user_profile.choice_count:
             return self.current_mood
-            
-        mood_scores = {mood: 0 for mood in Mood}
-        
-        for choice in recent_choices[-5:]:  # Consider last 5 choices
-            for mood, impact in choice.mood_impact.items():
-                mood_scores[mood] += impact
-        
-        # Return mood with highest score
-        return max(mood_scores, key=mood_scores.get) if mood_scores else self.current_mood
+        return user_profile.dominant_mood()
+
+# Mood-specific values for the emotion/atmosphere/situation template slots
+MOOD_SPECIFIC_CONTENT = {
+    Mood.ADVENTUROUS: {
+        'emotion': 'excitement',
+        'atmosphere': 'energy filled the air',
+        'situation': 'facing an unexpected challenge'
+    },
+    Mood.MYSTERIOUS: {
+        'emotion': 'suspicion',
+        'atmosphere': 'shadows danced mysteriously',
+        'situation': 'shrouded in mystery'
+    },
+    Mood.ROMANTIC: {
+        'emotion': 'longing',
+        'atmosphere': 'a gentle warmth pervaded',
+        'situation': 'sharing a tender moment'
+    },
+    Mood.DARK: {
+        'emotion': 'dread',
+        'atmosphere': 'an ominous presence loomed',
+        'situation': 'confronting their darkest fears'
+    },
+    Mood.HUMOROUS: {
+        'emotion': 'amusement',
+        'atmosphere': 'laughter echoed through the space',
+        'situation': 'in a hilariously awkward predicament'
+    },
+    Mood.CONTEMPLATIVE: {
+        'emotion': 'thoughtfulness',
+        'atmosphere': 'a serene calm settled over everything',
+        'situation': 'lost in deep contemplation'
+    },
+    Mood.TENSE: {
+        'emotion': 'anxiety',
+        'atmosphere': 'tension crackled in the air',
+        'situation': 'on edge and ready for anything'
+    }
+}
+
+# Slots filled from mood-appropriate knowledge graph elements: slot -> (element_type, fallback)
+ELEMENT_TEMPLATE_SLOTS = {
+    'character': ('character', "the protagonist"),
+    'character1': ('character', "the hero"),
+    'character2': ('character', "a mysterious figure"),
+    'location': ('location', "an unknown place"),
+}
+
+# Generic values for the remaining slots
+GENERIC_TEMPLATE_VALUES = {
+    'object': 'a mysterious artifact',
+    'revelation': 'hiding their true identity',
+    'true_nature': 'a key to ancient secrets',
+    'appearance': 'a simple choice',
+    'reality': 'a test of character',
+    'dialogue': 'The path ahead is uncertain',
+    'new_situation': 'facing an unexpected challenge',
+    'event': 'a crucial moment',
+    'atmosphere': 'an air of mystery'
+}
+
+class CompiledTemplate:
+    SLOT_PATTERN = re.compile(r"\{(\w+)\}")
+    
+    def __init__(self, template: str):
+        self.template = template
+        # Alternating literal text and placeholder names: literal, slot, literal, ...
+        parts = self.SLOT_PATTERN.split(template)
+        self.literals = parts[0::2]
+        self.slot_names = list(dict.fromkeys(parts[1::2]))  # Unique, in order of appearance
+        self.slot_positions = [self.slot_names.index(slot) for slot in parts[1::2]]
+    
+    def render(self, values: List[str]) -> str:
+        # `values` is parallel to slot_names; repeated placeholders share a value
+        pieces = [self.literals[0]]
+        for position, literal in zip(self.slot_positions, self.literals[1:]):
+            pieces.append(values[position])
+            pieces.append(literal)
+        return ''.join(pieces)
+    
+    def to_state(self) -> Dict[str, Any]:
+        return {'template': self.template, 'literals': self.literals, 
+                'slot_names': self.slot_names, 'slot_positions': self.slot_positions}
+    
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'CompiledTemplate':
+        # Skips parsing the template again
+        template = cls.__new__(cls)
+        template.template = state['template']
+        template.literals = state['literals']
+        template.slot_names = state['slot_names']
+        template.slot_positions = state['slot_positions']
+        return template
 
 class NarrativeAgent:
-    def __init__(self, knowledge_graph: KnowledgeGraph):
+    def __init__(self, knowledge_graph: KnowledgeGraph, pool_cache: LRUCache = None, 
+                 compiled_templates: Dict[str, List[CompiledTemplate]] = None):
         self.knowledge_graph = knowledge_graph
-        self.story_templates = self._initialize_templates()
+        # (mood, element_type, graph version) -> elements for template slots
+        self.pool_cache = pool_cache if pool_cache is not None else LRUCache(256, 'element_pool_cache')
+        if compiled_templates is None:
+            compiled_templates = {element_type: [CompiledTemplate(template) for template in templates]
+                                  for element_type, templates in self._initialize_templates().items()}
+        self.compiled_templates = compiled_templates
+        self.story_templates = {element_type: [template.template for template in templates]
+                                for element_type, templates in compiled_templates.items()}
         
     def _initialize_templates(self) -> Dict[str, List[str]]:
         return {
@@ -142,110 +1661,60 @@ class NarrativeAgent:
     
     def generate_narrative_element(self, element_type: str, context: Dict[str, Any], 
                                  user_mood: Mood) -> str:
-        templates = self.story_templates.get(element_type, [])
+        return self.generate_many(element_type, [context], user_mood)[0]
+    
+    def generate_many(self, element_type: str, contexts: List[Dict[str, Any]], 
+                      user_mood: Mood) -> List[str]:
+        templates = self.compiled_templates.get(element_type, [])
         if not templates:
-            return f"The story continues with {element_type}..."
+            return [f"The story continues with {element_type}..." for _ in contexts]
         
-        template = random.choice(templates)
-        
-        # Get mood-appropriate elements from knowledge graph
-        mood_elements = self.knowledge_graph.find_elements_by_mood(user_mood)
-        
-        # Fill template with context and mood-appropriate elements
-        filled_template = self._fill_template(template, context, mood_elements, user_mood)
-        
-        return filled_template
+        # Mood-appropriate element pools are looked up once for the whole batch
+        resolve_slot = self._slot_resolver(user_mood)
+        return [self._fill_template(random.choice(templates), context or {}, resolve_slot) 
+                for context in contexts]
     
-    def _fill_template(self, template: str, context: Dict[str, Any], 
-                      mood_elements: List[StoryElement], user_mood: Mood) -> str:
-        # Simple template filling logic
-        replacements = {}
-        
-        # Get characters from context or mood elements
-        characters = [elem for elem in mood_elements if elem.element_type == 'character']
-        if characters:
-            replacements['character'] = random.choice(characters).content
-            replacements['character1'] = random.choice(characters).content
-            replacements['character2'] = random.choice(characters).content
-        else:
-            replacements['character'] = "the protagonist"
-            replacements['character1'] = "the hero"
-            replacements['character2'] = "a mysterious figure"
-        
-        # Get locations
-        locations = [elem for elem in mood_elements if elem.element_type == 'location']
-        if locations:
-            replacements['location'] = random.choice(locations).content
-        else:
-            replacements['location'] = "an unknown place"
-        
-        # Mood-specific replacements
+    def _fill_template(self, template: CompiledTemplate, context: Dict[str, Any], 
+                       resolve_slot: Callable[[str], str]) -> str:
+        # Only the slots this template uses are resolved; context values win
+        values = [str(context[slot]) if slot in context else resolve_slot(slot) 
+                  for slot in template.slot_names]
+        return template.render(values)
+    
+    def _slot_resolver(self, user_mood: Mood) -> Callable[[str], str]:
         mood_specific = self._get_mood_specific_content(user_mood)
-        replacements.update(mood_specific)
-        
-        # Add more generic replacements
-        replacements.update({
-            'object': 'a mysterious artifact',
-            'revelation': 'hiding their true identity',
-            'true_nature': 'a key to ancient secrets',
-            'appearance': 'a simple choice',
-            'reality': 'a test of character',
-            'dialogue': 'The path ahead is uncertain',
-            'new_situation': 'facing an unexpected challenge',
-            'event': 'a crucial moment',
-            'atmosphere': mood_specific.get('atmosphere', 'an air of mystery')
-        })
-        
-        # Fill template
-        for key, value in replacements.items():
-            template = template.replace(f'{{{key}}}', str(value))
+        element_pools = {}
         
-        return template
+        def resolve_slot(slot: str) -> str:
+            if slot in ELEMENT_TEMPLATE_SLOTS:
+                element_type, fallback = ELEMENT_TEMPLATE_SLOTS[slot]
+                if element_type not in element_pools:
+                    element_pools[element_type] = self._element_pool(user_mood, element_type)
+                pool = element_pools[element_type]
+                return random.choice(pool).content if pool else fallback
+            if slot in mood_specific:
+                return mood_specific[slot]
+            # Unknown placeholders are left in place
+            return GENERIC_TEMPLATE_VALUES.get(slot, f'{{{slot}}}')
+        
+        return resolve_slot
+    
+    def _element_pool(self, mood: Mood, element_type: str) -> List[StoryElement]:
+        key = (mood, element_type, self.knowledge_graph.version)
+        pool = self.pool_cache.get(key)
+        if pool is LRUCache.MISSING:
+            pool = self.knowledge_graph.find_elements_by_mood(mood, element_type=element_type)
+            self.pool_cache.put(key, pool)
+        return pool
     
     def _get_mood_specific_content(self, mood: Mood) -> Dict[str, str]:
-        mood_content = {
-            Mood.ADVENTUROUS: {
-                'emotion': 'excitement',
-                'atmosphere': 'energy filled the air',
-                'situation': 'facing an unexpected challenge'
-            },
-            Mood.MYSTERIOUS: {
-                'emotion': 'suspicion',
-                'atmosphere': 'shadows danced mysteriously',
-                'situation': 'shrouded in mystery'
-            },
-            Mood.ROMANTIC: {
-                'emotion': 'longing',
-                'atmosphere': 'a gentle warmth pervaded',
-                'situation': 'sharing a tender moment'
-            },
-            Mood.DARK: {
-                'emotion': 'dread',
-                'atmosphere': 'an ominous presence loomed',
-                'situation': 'confronting their darkest fears'
-            },
-            Mood.HUMOROUS: {
-                'emotion': 'amusement',
-                'atmosphere': 'laughter echoed through the space',
-                'situation': 'in a hilariously awkward predicament'
-            },
-            Mood.CONTEMPLATIVE: {
-                'emotion': 'thoughtfulness',
-                'atmosphere': 'a serene calm settled over everything',
-                'situation': 'lost in deep contemplation'
-            },
-            Mood.TENSE: {
-                'emotion': 'anxiety',
-                'atmosphere': 'tension crackled in the air',
-                'situation': 'on edge and ready for anything'
-            }
-        }
-        return mood_content.get(mood, {})
+        return MOOD_SPECIFIC_CONTENT.get(mood, {})
 
 class DialogueAgent:
-    def __init__(self, knowledge_graph: KnowledgeGraph):
+    def __init__(self, knowledge_graph: KnowledgeGraph, 
+                 dialogue_styles: Dict[Mood, Dict[str, List[str]]] = None):
         self.knowledge_graph = knowledge_graph
-        self.dialogue_styles = self._initialize_dialogue_styles()
+        self.dialogue_styles = dialogue_styles if dialogue_styles is not None else self._initialize_dialogue_styles()
     
     def _initialize_dialogue_styles(self) -> Dict[Mood, Dict[str, List[str]]]:
         return {
@@ -303,16 +1772,16 @@ class DialogueAgent:
     
     def _customize_for_character(self, dialogue: str, character: StoryElement) -> str:
         # Simple customization based on character tags
-        if 'formal' in character.tags:
+        if character.has_tag('formal'):
             dialogue = dialogue.replace("you", "you, sir/madam")
-        elif 'casual' in character.tags:
+        elif character.has_tag('casual'):
             dialogue = dialogue.lower()
         
         return dialogue
 
 class VisualStyleAgent:
-    def __init__(self):
-        self.style_mappings = self._initialize_style_mappings()
+    def __init__(self, style_mappings: Dict[Mood, Dict[str, Any]] = None):
+        self.style_mappings = style_mappings if style_mappings is not None else self._initialize_style_mappings()
     
     def _initialize_style_mappings(self) -> Dict[Mood, Dict[str, Any]]:
         return {
@@ -357,42 +1826,158 @@ class VisualStyleAgent:
         return self.style_mappings.get(mood, self.style_mappings[Mood.CONTEMPLATIVE])
 
 class PersonalizedDiscovery:
-    def __init__(self, knowledge_graph: KnowledgeGraph):
+    PREFERENCE_THRESHOLD = 0.3  # Moods the user must lean towards to drive recommendations
+    MOOD_MATCH_THRESHOLD = 0.5  # Element weight needed to count as matching such a mood
+    MAX_USAGE = 3  # Content used this often is no longer recommended
+    # Scores are ranked as round(score * SCORE_SCALE), so float drift between
+    # the NumPy and pure-Python sums cannot reorder equal scores
+    SCORE_SCALE = 1e9
+    
+    def __init__(self, knowledge_graph: KnowledgeGraph, instrumentation: Instrumentation = NULL_INSTRUMENTATION, 
+                 cache_size: int = 1024):
         self.knowledge_graph = knowledge_graph
+        self.instrumentation = instrumentation
+        # (user_id, profile_id, preference version, graph version, usage version, k) -> recommendations
+        self.recommendation_cache = LRUCache(cache_size, 'recommendation_cache', instrumentation)
     
     def recommend_content(self, user_profile: UserProfile, 
-                         current_context: Dict[str, Any]) -> List[StoryElement]:
-        recommendations = []
-        
-        # Get user's preferred moods
-        mood_preferences = user_profile.narrative_preferences
-        
-        # Find content matching preferences
-        for mood_str, preference_score in mood_preferences.items():
-            if preference_score > 0.3:  # Threshold for recommendations
-                mood = Mood(mood_str)
-                matching_elements = self.knowledge_graph.find_elements_by_mood(mood)
-                
-                # Filter out already heavily used content
-                fresh_content = [elem for elem in matching_elements if elem.usage_count < 3]
-                recommendations.extend(fresh_content[:2])  # Top 2 per mood
-        
-        return recommendations[:5]  # Return top 5 recommendations
-    
-    def suggest_branching_paths(self, current_element: StoryElement, 
-                              user_profile: UserProfile) -> List[Tuple[str, StoryElement]]:
+                         current_context: Dict[str, Any], k: int = 5) -> List[StoryElement]:
+        # Fresh content matching a preferred mood, best preference score first
+        return self.recommend_for_users([user_profile], k)[0]
+    
+    def recommend_for_users(self, user_profiles: List[UserProfile], k: int = 5) -> List[List[StoryElement]]:
+        # Only users whose preferences or graph changed since their last
+        # request are scored again
+        cache = self.recommendation_cache
+        graph = self.knowledge_graph
+        keys = [(profile.user_id, profile.profile_id, profile.preference_version, graph.version, 
+                 graph.usage_version, k) for profile in user_profiles]
+        results = [cache.get(key) for key in keys]
+        stale = [position for position, result in enumerate(results) if result is LRUCache.MISSING]
+        if stale:
+            computed = self._score_users([user_profiles[position] for position in stale], k)
+            for position, recommendations in zip(stale, computed):
+                results[position] = recommendations
+                cache.put(keys[position], recommendations)
+        return [list(recommendations) for recommendations in results]
+    
+    def _score_users(self, user_profiles: List[UserProfile], k: int) -> List[List[StoryElement]]:
+        matrix = self.knowledge_graph.weight_matrix()
+        if matrix is None:
+            return [self._recommend_content_python(profile, k) for profile in user_profiles]
+        
+        weights, usage = matrix
+        preferences = np.array([self._preference_vector(profile) for profile in user_profiles])
+        if not len(weights) or not len(preferences):
+            return [[] for _ in user_profiles]
+        
+        # One users x elements product for every profile in the batch
+        freshness = np.maximum(0, 1 - usage * 0.2)
+        scores = preferences @ weights.T + freshness
+        liked_moods = preferences > self.PREFERENCE_THRESHOLD
+        matches = (weights >= self.MOOD_MATCH_THRESHOLD).astype(float) @ liked_moods.T.astype(float)
+        eligible = (matches.T > 0) & (usage < self.MAX_USAGE)
+        self.instrumentation.increment('elements_scanned', scores.size)
+        self.instrumentation.increment('recommendation_candidates', int(eligible.sum()))
+        
+        return [self._top_elements(scores[row], eligible[row], k) for row in range(len(user_profiles))]
+    
+    def _top_elements(self, scores, eligible, k: int) -> List[StoryElement]:
+        candidates = np.flatnonzero(eligible)
+        scores = np.rint(scores * self.SCORE_SCALE)
+        if 0 < k < len(candidates):
+            # Everything scoring at least the kth best, so ties at the cut are
+            # decided by the sort below rather than by the partition
+            candidate_scores = scores[candidates]
+            kth_best = np.partition(candidate_scores, len(candidates) - k)[len(candidates) - k]
+            candidates = candidates[candidate_scores >= kth_best]
+        # Highest score first, earlier elements win ties
+        candidates = candidates[np.lexsort((candidates, -scores[candidates]))][:k]
+        
+        nodes, ordinal_ids = self.knowledge_graph.nodes, self.knowledge_graph.ordinal_ids
+        return [nodes[ordinal_ids[ordinal]] for ordinal in candidates]
+    
+    def _recommend_content_python(self, user_profile: UserProfile, k: int) -> List[StoryElement]:
+        candidates = {}
+        scanned = 0
+        for mood_str, preference_score in user_profile.narrative_preferences.items():
+            if preference_score > self.PREFERENCE_THRESHOLD:
+                for element in self.knowledge_graph.find_elements_by_mood(Mood(mood_str), self.MOOD_MATCH_THRESHOLD):
+                    scanned += 1
+                    if element.usage_count < self.MAX_USAGE:
+                        candidates[element.element_id] = element
+        self.instrumentation.increment('elements_scanned', scanned)
+        self.instrumentation.increment('recommendation_candidates', len(candidates))
+        
+        ordinals = self.knowledge_graph.ordinals
+        return heapq.nsmallest(k, candidates.values(), key=lambda element: (
+            -round(self._calculate_preference_score(element, user_profile) * self.SCORE_SCALE),
+            ordinals[element.element_id]))
+    
+    def _preference_vector(self, user_profile: UserProfile) -> List[float]:
+        vector = [0.0] * len(Mood)
+        for mood_str, preference_score in user_profile.narrative_preferences.items():
+            vector[MOOD_ORDINALS[Mood(mood_str)]] = preference_score
+        return vector
+    
+    def suggest_branching_paths(self, current_element: StoryElement, user_profile: UserProfile, 
+                                k: int = 3, lookahead: int = 1, 
+                                beam_width: int = None) -> List[Tuple[str, StoryElement]]:
+        if lookahead > 1:
+            # Label each next step with the best path it leads into
+            best_by_first_hop = {}
+            for score, path in self.preview_paths(current_element, user_profile, lookahead, 
+                                                  beam_width or k, k=None):
+                best_by_first_hop.setdefault(path[0].element_id, path)
+            paths = list(best_by_first_hop.values())[:k]
+            return [(self._describe_path(path), path[0]) for path in paths]
+        
         # Get related elements
         related = self.knowledge_graph.get_related_elements(current_element.element_id)
         
-        # Score based on user preferences
-        scored_paths = []
-        for element in related:
-            score = self._calculate_preference_score(element, user_profile)
-            scored_paths.append((score, element))
+        # Score based on user preferences; the key keeps elements out of comparisons
+        scores = {element.element_id: self._calculate_preference_score(element, user_profile) 
+                  for element in related}
+        top_paths = heapq.nlargest(k, related, key=lambda element: scores[element.element_id])
+        return [(f"Path to {elem.content}", elem) for elem in top_paths]
+    
+    def preview_paths(self, current_element: StoryElement, user_profile: UserProfile, 
+                      depth: int = 3, beam_width: int = 3, 
+                      k: Optional[int] = 3) -> List[Tuple[float, List[StoryElement]]]:
+        # Beam search over outgoing relationships; a path's score is the sum of
+        # its elements' preference scores. Best first, excluding current_element.
+        node_scores = {}  # element_id -> score, shared by every path in this request
+        
+        def score(element: StoryElement) -> float:
+            if element.element_id not in node_scores:
+                node_scores[element.element_id] = self._calculate_preference_score(element, user_profile)
+            return node_scores[element.element_id]
         
-        # Sort by score and return top paths
-        scored_paths.sort(reverse=True)
-        return [(f"Path to {elem.content}", elem) for score, elem in scored_paths[:3]]
+        beams = [(0.0, [current_element])]
+        finished = []
+        for _ in range(depth):
+            expansions = []
+            for path_score, path in beams:
+                visited = {element.element_id for element in path}
+                next_steps = [element for element in self.knowledge_graph.get_related_elements(path[-1].element_id)
+                              if element.element_id not in visited]
+                if not next_steps and len(path) > 1:
+                    finished.append((path_score, path))  # Dead end, still a valid preview
+                for element in next_steps:
+                    expansions.append((path_score + score(element), path + [element]))
+            if not expansions:
+                beams = []
+                break
+            beams = heapq.nlargest(beam_width, expansions, key=lambda candidate: candidate[0])
+        
+        finished.extend(beam for beam in beams if len(beam[1]) > 1)
+        ranked = sorted(finished, key=lambda candidate: candidate[0], reverse=True)
+        if k is not None:
+            ranked = ranked[:k]
+        return [(path_score, path[1:]) for path_score, path in ranked]
+    
+    def _describe_path(self, path: List[StoryElement]) -> str:
+        return "Path to " + " -> ".join(element.content for element in path)
     
     def _calculate_preference_score(self, element: StoryElement, 
                                    user_profile: UserProfile) -> float:
@@ -409,18 +1994,220 @@ class PersonalizedDiscovery:
         
         return score
 
-class AdaptiveStorytellingPlatform:
+@dataclass
+class PregenerationConfig:
+    top_moods: int = 2  # Likely next moods rendered after each turn
+    buffer_size: int = 4  # Pregenerated renders kept per user
+    session_cap: int = 100  # Renders per user session before pregeneration stops
+    max_users: int = 10000  # Users with a buffer or session count at once, least recent dropped first
+
+class PregenerationSession:
+    __slots__ = ('renders', 'buffer', 'pending')
+    
     def __init__(self):
-        self.knowledge_graph = KnowledgeGraph()
-        self.narrative_agent = NarrativeAgent(self.knowledge_graph)
-        self.dialogue_agent = DialogueAgent(self.knowledge_graph)
-        self.visual_agent = VisualStyleAgent()
-        self.discovery_agent = PersonalizedDiscovery(self.knowledge_graph)
-        self.engagement_tracker = UserEngagementTracker()
-        self.users = {}  # user_id -> UserProfile
+        self.renders = 0  # Renders scheduled this session
+        self.buffer = OrderedDict()  # mood -> (graph_version, render)
+        self.pending = {}  # mood -> graph_version, queued for rendering
+
+class ContentPregenerator:
+    # Renders narrative, dialogue and visual style for a user's likely next
+    # moods while they read the current turn. Renders read the graph and the
+    # agents' caches, so they run on the thread that owns the platform: as
+    # tasks on `executor` (the server's platform thread), one render per task
+    # so requests queued meanwhile wait for a single render at most, or without
+    # one whenever the owner calls run_pending(). A render is served once, and
+    # only if the graph has not changed since.
+    def __init__(self, render: Callable[[Mood], Tuple[str, str, Dict[str, Any]]], 
+                 config: PregenerationConfig = None, instrumentation: Instrumentation = NULL_INSTRUMENTATION, 
+                 executor: Executor = None):
+        self.render = render
+        self.config = config or PregenerationConfig()
+        self.instrumentation = instrumentation
+        self.executor = executor
+        # user_id -> PregenerationSession, most recently active last; at most
+        # max_users, so buffers, session counts and queued renders stay bounded
+        self.sessions = OrderedDict()
+        self.queue = deque()  # (user_id, mood) in scheduling order
+        self.hits = 0
+        self.misses = 0
+        self.pregenerated = 0
+        self.discarded = 0  # Stale or evicted before use
+        self.capped = 0  # Renders skipped because of session_cap
+        self._draining = False  # A render task is on the executor
+        self._lock = threading.Lock()  # stats() may be read from other threads
+    
+    def schedule(self, user_id: str, moods: List[Mood], graph_version: int):
+        with self._lock:
+            session = self._session(user_id)
+            for mood in moods:
+                if mood in session.pending:
+                    session.pending[mood] = graph_version
+                    continue
+                buffered = session.buffer.get(mood)
+                if buffered is not None and buffered[0] == graph_version:
+                    continue
+                if session.renders >= self.config.session_cap:
+                    self.capped += 1
+                    continue
+                session.renders += 1
+                session.pending[mood] = graph_version
+                self.queue.append((user_id, mood))
+            if len(self.queue) > 2 * len(self.sessions) * len(MOOD_ORDINALS):
+                # Mostly entries of evicted or reset sessions, which are skipped anyway
+                self.queue = deque((queued_user, mood) for queued_user, mood in self.queue
+                                   if mood in getattr(self.sessions.get(queued_user), 'pending', ()))
+            if self.queue and self.executor is not None and not self._draining:
+                self._draining = True
+                self.executor.submit(self._render_next)
+    
+    def run_pending(self, limit: Optional[int] = None) -> int:
+        # Renders queued moods on the calling thread, which must own the
+        # platform; returns how many were rendered
+        rendered = 0
+        while (limit is None or rendered < limit) and self._pregenerate_next():
+            rendered += 1
+        return rendered
+    
+    def take(self, user_id: str, mood: Mood, graph_version: int) -> Optional[Tuple[str, str, Dict[str, Any]]]:
+        with self._lock:
+            session = self.sessions.get(user_id)
+            entry = session.buffer.pop(mood, None) if session is not None else None
+            if entry is not None and entry[0] != graph_version:
+                self.discarded += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self.instrumentation.increment('pregeneration_misses' if entry is None else 'pregeneration_hits')
+        return entry[1] if entry is not None else None
+    
+    def reset_session(self, user_id: str):
+        with self._lock:
+            session = self.sessions.pop(user_id, None)
+            if session is not None:
+                self.discarded += len(session.buffer)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            served = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / served if served else 0.0,
+                'pregenerated': self.pregenerated,
+                'discarded': self.discarded,
+                'capped': self.capped,
+                'buffered': sum(len(session.buffer) for session in self.sessions.values()),
+            }
+    
+    def close(self):
+        # Drops queued renders; a render task already on the executor finds nothing left
+        with self._lock:
+            self.queue.clear()
+            for session in self.sessions.values():
+                session.pending.clear()
+            self.executor = None
+    
+    def _render_next(self):
+        try:
+            self._pregenerate_next()
+        finally:
+            with self._lock:
+                self._draining = bool(self.queue) and self.executor is not None
+                if self._draining:
+                    # Behind whatever requests arrived during this render
+                    self.executor.submit(self._render_next)
+    
+    def _pregenerate_next(self) -> bool:
+        with self._lock:
+            while self.queue:
+                user_id, mood = self.queue.popleft()
+                session = self.sessions.get(user_id)
+                if session is not None and mood in session.pending:
+                    graph_version = session.pending.pop(mood)
+                    break
+            else:
+                return False
+        
+        rendered = self.render(mood)
+        with self._lock:
+            self.pregenerated += 1
+            buffer = self._session(user_id).buffer
+            buffer[mood] = (graph_version, rendered)
+            buffer.move_to_end(mood)
+            while len(buffer) > self.config.buffer_size:
+                buffer.popitem(last=False)
+                self.discarded += 1
+        self.instrumentation.increment('pregenerated')
+        return True
+    
+    def _session(self, user_id: str) -> PregenerationSession:
+        # Called under the lock; makes the user the most recently active
+        session = self.sessions.pop(user_id, None) or PregenerationSession()
+        self.sessions[user_id] = session
+        while len(self.sessions) > self.config.max_users:
+            self.discarded += len(self.sessions.popitem(last=False)[1].buffer)
+        return session
+
+class AdaptiveStorytellingPlatform:
+    def __init__(self, mood_lexicon: Dict[Mood, List[str]] = None, mood_window: int = 5, 
+                 mood_decay: Optional[float] = None, 
+                 history_limit: Optional[int] = None, storage: Any = None, 
+                 knowledge_graph: KnowledgeGraph = None, 
+                 instrumentation: Instrumentation = NULL_INSTRUMENTATION, cache_size: int = 1024, 
+                 pregeneration: PregenerationConfig = None, profile_store: MutableMapping = None, 
+                 content_pack: Any = None):
+        # `storage` (e.g. storage.SQLiteStore) supplies a persistent graph and
+        # profile map and receives every choice; a prebuilt `knowledge_graph`
+        # is used as-is instead of the sample world. With `pregeneration` set,
+        # content for each user's likely next moods is rendered between turns
+        # on the thread that owns the platform (see ContentPregenerator). A
+        # `profile_store` (e.g. storage.TieredProfileStore) replaces the
+        # in-memory user map. A `content_pack` (see contentpack.py) supplies
+        # the agents' tables, the mood analyzer and a shared, frozen world used
+        # through an overlay, so nothing static is rebuilt per platform.
+        # `history_limit` caps the choices each profile keeps in memory; by
+        # default it keeps them all.
+        if storage is not None and profile_store is not None:
+            raise ValueError('storage already keeps user profiles; pass either storage or profile_store')
+        self.storage = storage
+        self.content_pack = content_pack
+        if knowledge_graph is not None:
+            self.knowledge_graph = knowledge_graph
+        elif storage is not None:
+            self.knowledge_graph = storage.graph
+        elif content_pack is not None:
+            self.knowledge_graph = content_pack.graph.overlay()
+        else:
+            self.knowledge_graph = KnowledgeGraph()
+        pack = content_pack
+        self.narrative_agent = NarrativeAgent(self.knowledge_graph, 
+                                              LRUCache(cache_size, 'element_pool_cache', instrumentation), 
+                                              pack.compiled_templates if pack is not None else None)
+        self.dialogue_agent = DialogueAgent(self.knowledge_graph, 
+                                            pack.dialogue_styles if pack is not None else None)
+        self.visual_agent = VisualStyleAgent(pack.style_mappings if pack is not None else None)
+        self.instrumentation = instrumentation
+        self.discovery_agent = PersonalizedDiscovery(self.knowledge_graph, instrumentation, cache_size)
+        if pack is not None and mood_lexicon is None:
+            self.mood_analyzer = pack.mood_analyzer  # Read-only, shared by every platform on the pack
+        else:
+            self.mood_analyzer = MoodAnalyzer(mood_lexicon)
+        if storage is not None:
+            profile_store = storage.profiles
+        self.users = profile_store if profile_store is not None else {}  # user_id -> UserProfile
+        self.mood_window = mood_window
+        self.mood_decay = mood_decay
+        self.history_limit = history_limit
+        self.pregenerator = (ContentPregenerator(self._render_pregenerated, pregeneration, instrumentation)
+                             if pregeneration is not None else None)
         
         # Initialize with sample content
-        self._initialize_sample_content()
+        if knowledge_graph is None and (storage.is_empty() if storage is not None else content_pack is None):
+            self._initialize_sample_content()
+            if storage is not None:
+                storage.flush()
     
     def _initialize_sample_content(self):
         # Sample characters
@@ -472,16 +2259,38 @@ class AdaptiveStorytellingPlatform:
         self.knowledge_graph.add_relationship("villain_1", "location_2", "resides_in")
     
     def create_user(self, user_id: str) -> UserProfile:
-        user_profile = UserProfile(user_id)
+        user_profile = UserProfile(user_id, mood_window=self.mood_window, mood_decay=self.mood_decay, 
+                                   history_limit=self.history_limit)
         self.users[user_id] = user_profile
         return user_profile
     
     def process_user_choice(self, user_id: str, choice_text: str, 
                            response_time: float) -> Dict[str, Any]:
-        if user_id not in self.users:
-            self.create_user(user_id)
-        
-        user_profile = self.users[user_id]
+        instrumentation = self.instrumentation
+        with instrumentation.request('process_user_choice'):
+            with instrumentation.stage('mood_analysis'):
+                mood_impact = self._analyze_choice_mood_impact(choice_text)
+            return self._record_choice(user_id, choice_text, response_time, mood_impact)
+    
+    def process_user_choices(self, requests: List[Tuple[str, str, float]]) -> List[Dict[str, Any]]:
+        # (user_id, choice_text, response_time) requests, applied in order
+        return list(self.iter_user_choices(requests))
+    
+    def iter_user_choices(self, requests: List[Tuple[str, str, float]]) -> Iterator[Dict[str, Any]]:
+        # Yields each result right after its choice is applied, while the
+        # returned profile still reflects that choice; mood analysis for the
+        # whole batch is done up front in one pass
+        instrumentation = self.instrumentation
+        with instrumentation.stage('mood_analysis'):
+            mood_impacts = self.mood_analyzer.analyze_batch([choice_text for _, choice_text, _ in requests])
+        for (user_id, choice_text, response_time), mood_impact in zip(requests, mood_impacts):
+            with instrumentation.request('process_user_choice'):
+                result = self._record_choice(user_id, choice_text, response_time, mood_impact)
+            yield result
+    
+    def _record_choice(self, user_id: str, choice_text: str, response_time: float, 
+                       mood_impact: Dict[Mood, float]) -> Dict[str, Any]:
+        user_profile = self._get_user(user_id)
         
         # Create choice record
         choice = UserChoice(
@@ -489,17 +2298,29 @@ class AdaptiveStorytellingPlatform:
             choice_text=choice_text,
             timestamp=datetime.now(),
             response_time=response_time,
-            mood_impact=self._analyze_choice_mood_impact(choice_text)
+            mood_impact=mood_impact
         )
         
+        instrumentation = self.instrumentation
         # Update user profile
-        user_profile.add_choice(choice)
+        with instrumentation.stage('profile_update'):
+            user_profile.add_choice(choice)
         
-        # Track engagement
-        engagement = self.engagement_tracker.track_choice(response_time, choice.choice_id)
+        # Track engagement against this user's own response-time history
+        with instrumentation.stage('engagement'):
+            tracker = user_profile.engagement_tracker
+            engagement = tracker.track_choice(response_time, choice.choice_id)
+            user_profile.engagement_patterns.update(tracker.rolling_stats())
+        
+        if self.storage is not None:
+            with instrumentation.stage('storage'):
+                self.storage.append_choice(user_id, choice)
+                self.storage.mark_dirty(user_profile)
         
         # Infer current mood
-        current_mood = self.engagement_tracker.infer_mood(user_profile.choice_history)
+        with instrumentation.stage('mood_inference'):
+            current_mood = tracker.infer_profile_mood(user_profile)
+        instrumentation.increment('choices_processed')
         
         return {
             'choice_id': choice.choice_id,
@@ -508,48 +2329,193 @@ class AdaptiveStorytellingPlatform:
             'user_profile': user_profile
         }
     
-    def _analyze_choice_mood_impact(self, choice_text: str) -> Dict[Mood, float]:
-        # Simple keyword-based mood analysis
-        mood_keywords = {
-            Mood.ADVENTUROUS: ['explore', 'adventure', 'quest', 'journey', 'discover'],
-            Mood.MYSTERIOUS: ['investigate', 'mystery', 'secret', 'hidden', 'unknown'],
-            Mood.ROMANTIC: ['love', 'romance', 'heart', 'kiss', 'together'],
-            Mood.DARK: ['fight', 'battle', 'dark', 'evil', 'danger'],
-            Mood.HUMOROUS: ['joke', 'funny', 'laugh', 'silly', 'amusing']
-        }
+    def process_choices_batch(self, events: Iterable[Tuple[str, UserChoice]], reanalyze: bool = False, 
+                              chunk_size: int = 10000) -> Dict[str, Mood]:
+        # Replays recorded (user_id, UserChoice) events in order, keeping their
+        # ids and timestamps. Choices without a mood_impact (or all of them with
+        # `reanalyze`) are analyzed a chunk at a time into copies, leaving the
+        # caller's events as they were. Engagement stats and the inferred mood
+        # are worked out once per user per chunk, then the chunk's profiles are
+        # handed back, so only one chunk's worth is held at a time. Returns
+        # user_id -> inferred mood for every user touched.
+        instrumentation = self.instrumentation
+        final_moods = {}
+        with instrumentation.request('process_choices_batch'):
+            chunk = []
+            for event in events:
+                chunk.append(event)
+                if len(chunk) >= chunk_size:
+                    self._apply_choice_chunk(chunk, reanalyze, final_moods)
+                    chunk = []
+            if chunk:
+                self._apply_choice_chunk(chunk, reanalyze, final_moods)
+        return final_moods
+    
+    def _apply_choice_chunk(self, chunk: List[Tuple[str, UserChoice]], reanalyze: bool, 
+                            final_moods: Dict[str, Mood]):
+        instrumentation = self.instrumentation
+        with instrumentation.stage('mood_analysis'):
+            positions = [position for position, (_, choice) in enumerate(chunk)
+                         if reanalyze or not choice.mood_impact]
+            mood_impacts = self.mood_analyzer.analyze_batch([chunk[position][1].choice_text
+                                                             for position in positions])
+            if positions:
+                chunk = list(chunk)
+                for position, mood_impact in zip(positions, mood_impacts):
+                    user_id, choice = chunk[position]
+                    chunk[position] = (user_id, replace(choice, mood_impact=mood_impact))
         
-        mood_impact = {}
-        choice_lower = choice_text.lower()
+        touched = {}  # user_id -> UserProfile, in first-seen order
+        with instrumentation.stage('profile_update'):
+            for user_id, choice in chunk:
+                user_profile = touched.get(user_id)
+                if user_profile is None:
+                    user_profile = touched[user_id] = self._get_user(user_id)
+                user_profile.add_choice(choice)
+                timestamp = choice.timestamp.timestamp() if choice.timestamp else None
+                user_profile.engagement_tracker.track_choice(choice.response_time, choice.choice_id, timestamp)
         
-        for mood, keywords in mood_keywords.items():
-            impact = sum(0.2 for keyword in keywords if keyword in choice_lower)
-            if impact > 0:
-                mood_impact[mood] = min(impact, 1.0)
+        if self.storage is not None:
+            with instrumentation.stage('storage'):
+                self.storage.append_choices(chunk)
         
-        return mood_impact
+        with instrumentation.stage('mood_inference'):
+            for user_id, user_profile in touched.items():
+                tracker = user_profile.engagement_tracker
+                user_profile.engagement_patterns.update(tracker.rolling_stats())
+                final_moods[user_id] = tracker.infer_profile_mood(user_profile)
+        # Hand the chunk's profiles back to the user map: this marks them dirty
+        # in storage and writes back any that a bounded store spilled meanwhile
+        for user_id, user_profile in touched.items():
+            self.users[user_id] = user_profile
+        instrumentation.increment('choices_processed', len(chunk))
+    
+    def _analyze_choice_mood_impact(self, choice_text: str) -> Dict[Mood, float]:
+        return self.mood_analyzer.analyze(choice_text)
     
     def generate_adaptive_content(self, user_id: str, 
                                  context: Dict[str, Any] = None) -> Dict[str, Any]:
-        if user_id not in self.users:
-            self.create_user(user_id)
-        
-        user_profile = self.users[user_id]
-        current_mood = self.engagement_tracker.infer_mood(user_profile.choice_history)
+        instrumentation = self.instrumentation
+        with instrumentation.request('generate_adaptive_content'):
+            user_profile = self._get_user(user_id)
+            with instrumentation.stage('recommendations'):
+                recommendations = self.discovery_agent.recommend_content(user_profile, context or {})
+            return self._compose_content(user_profile, context or {}, recommendations)
+    
+    def iter_adaptive_content(self, user_id: str, 
+                              context: Dict[str, Any] = None) -> Iterator[Tuple[str, Any]]:
+        # Yields (part, value) pairs as each is ready, cheapest first:
+        # current_mood, visual_style, narrative, dialogue, recommendations,
+        # user_preferences. Closing the generator skips the remaining work.
+        instrumentation = self.instrumentation
         context = context or {}
+        user_profile = self._get_user(user_id)
+        with instrumentation.stage('mood_inference'):
+            current_mood = user_profile.engagement_tracker.infer_profile_mood(user_profile)
+        yield 'current_mood', current_mood
         
-        # Generate narrative content
-        narrative = self.narrative_agent.generate_narrative_element(
-            'scene_transitions', context, current_mood)
+        pregenerator = self.pregenerator if not context else None
+        rendered = None
+        if pregenerator is not None:
+            rendered = pregenerator.take(user_profile.user_id, current_mood, self.knowledge_graph.version)
+        if rendered is not None:
+            narrative, dialogue, visual_style = rendered
+            yield 'visual_style', visual_style
+            yield 'narrative', narrative
+            yield 'dialogue', dialogue
+        else:
+            with instrumentation.stage('visual_style'):
+                visual_style = self.visual_agent.get_visual_style(current_mood)
+            yield 'visual_style', visual_style
+            with instrumentation.stage('narrative'):
+                narrative = self.narrative_agent.generate_narrative_element(
+                    'scene_transitions', context, current_mood)
+            yield 'narrative', narrative
+            with instrumentation.stage('dialogue'):
+                dialogue = self.dialogue_agent.generate_dialogue('hero_1', 'reactions', current_mood, context)
+            yield 'dialogue', dialogue
         
-        # Generate dialogue
-        dialogue = self.dialogue_agent.generate_dialogue(
-            'hero_1', 'reactions', current_mood, context)
+        with instrumentation.stage('recommendations'):
+            recommendations = self.discovery_agent.recommend_content(user_profile, context)
+        yield 'recommendations', [elem.content for elem in recommendations]
+        self._record_served(recommendations)
+        instrumentation.increment('contents_generated')
         
-        # Get visual style
-        visual_style = self.visual_agent.get_visual_style(current_mood)
+        if pregenerator is not None:
+            pregenerator.schedule(user_profile.user_id, self._likely_moods(user_profile), 
+                                  self.knowledge_graph.version)
+        # A copy: the consumer may read it on another thread
+        yield 'user_preferences', dict(user_profile.narrative_preferences)
+    
+    async def aiter_adaptive_content(self, user_id: str, context: Dict[str, Any] = None, 
+                                     executor: Executor = None) -> AsyncIterator[Tuple[str, Any]]:
+        # iter_adaptive_content with each step run on `executor` (the thread
+        # that owns this platform; a private one if omitted) so the event loop
+        # stays free. Leaving the loop early or cancelling the consumer closes
+        # the stream once the step in flight finishes.
+        owned_executor = ThreadPoolExecutor(max_workers=1) if executor is None else None
+        executor = executor or owned_executor
+        parts = self.iter_adaptive_content(user_id, context)
+        step = None
+        try:
+            while True:
+                step = executor.submit(next, parts, None)
+                part = await asyncio.wrap_future(step)
+                if part is None:
+                    break
+                yield part
+        finally:
+            if step is not None and not step.done():
+                step.add_done_callback(lambda _: parts.close())
+            else:
+                executor.submit(parts.close)
+            if owned_executor is not None:
+                owned_executor.shutdown(wait=False)
+    
+    def generate_adaptive_contents(self, requests: List[Tuple[str, Optional[Dict[str, Any]]]]) -> List[Dict[str, Any]]:
+        # (user_id, context) requests; recommendations for the batch come from
+        # one matrix multiply
+        instrumentation = self.instrumentation
+        with instrumentation.request('generate_adaptive_contents'):
+            user_profiles = [self._get_user(user_id) for user_id, _ in requests]
+            with instrumentation.stage('recommendations'):
+                recommendations = self.discovery_agent.recommend_for_users(user_profiles)
+            return [self._compose_content(user_profile, context or {}, recommended)
+                    for user_profile, (_, context), recommended in zip(user_profiles, requests, recommendations)]
+    
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            'recommendations': self.discovery_agent.recommendation_cache.stats(),
+            'element_pools': self.narrative_agent.pool_cache.stats(),
+        }
+    
+    def _get_user(self, user_id: str) -> UserProfile:
+        # A single lookup, so a disk-backed user map loads the profile once
+        user_profile = self.users.get(user_id)
+        if user_profile is None:
+            user_profile = self.create_user(user_id)
+        return user_profile
+    
+    def _compose_content(self, user_profile: UserProfile, context: Dict[str, Any], 
+                         recommendations: List[StoryElement]) -> Dict[str, Any]:
+        instrumentation = self.instrumentation
+        with instrumentation.stage('mood_inference'):
+            current_mood = user_profile.engagement_tracker.infer_profile_mood(user_profile)
         
-        # Get recommendations
-        recommendations = self.discovery_agent.recommend_content(user_profile, context)
+        # Pregenerated renders only cover requests without context overrides
+        pregenerator = self.pregenerator if not context else None
+        rendered = None
+        if pregenerator is not None:
+            rendered = pregenerator.take(user_profile.user_id, current_mood, self.knowledge_graph.version)
+        if rendered is None:
+            rendered = self._render(current_mood, context, instrumentation)
+        narrative, dialogue, visual_style = rendered
+        self._record_served(recommendations)
+        instrumentation.increment('contents_generated')
+        
+        if pregenerator is not None:
+            pregenerator.schedule(user_profile.user_id, self._likely_moods(user_profile), 
+                                  self.knowledge_graph.version)
         
         return {
             'narrative': narrative,
@@ -559,6 +2525,40 @@ class AdaptiveStorytellingPlatform:
             'current_mood': current_mood,
             'user_preferences': user_profile.narrative_preferences
         }
+    
+    def _record_served(self, recommendations: List[StoryElement]):
+        # Served content ages, so users are not offered the same elements forever
+        for element in recommendations:
+            self.knowledge_graph.record_usage(element.element_id)
+    
+    def _render(self, mood: Mood, context: Dict[str, Any], 
+                instrumentation: Instrumentation) -> Tuple[str, str, Dict[str, Any]]:
+        # Generate narrative content
+        with instrumentation.stage('narrative'):
+            narrative = self.narrative_agent.generate_narrative_element(
+                'scene_transitions', context, mood)
+        
+        # Generate dialogue
+        with instrumentation.stage('dialogue'):
+            dialogue = self.dialogue_agent.generate_dialogue(
+                'hero_1', 'reactions', mood, context)
+        
+        # Get visual style
+        with instrumentation.stage('visual_style'):
+            visual_style = self.visual_agent.get_visual_style(mood)
+        return narrative, dialogue, visual_style
+    
+    def _render_pregenerated(self, mood: Mood) -> Tuple[str, str, Dict[str, Any]]:
+        # Background renders stay out of the request-path stage timings
+        return self._render(mood, {}, NULL_INSTRUMENTATION)
+    
+    def _likely_moods(self, user_profile: UserProfile) -> List[Mood]:
+        # The current dominant mood first, then the runners-up by rolling score
+        top_moods = self.pregenerator.config.top_moods
+        if not user_profile.choice_count:
+            return [user_profile.engagement_tracker.current_mood][:top_moods]
+        scores = user_profile.mood_scores
+        return heapq.nsmallest(top_moods, scores, key=lambda mood: (-round(scores[mood], 9), MOOD_ORDINALS[mood]))
 
 # Example usage and testing
 def demo_platform():
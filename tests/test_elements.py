@@ -0,0 +1,103 @@
+import pickle
+
+import pytest
+
+from storage import SQLiteStore
+from storytelling import KnowledgeGraph, Mood, StoryElement, Tagged
+
+def ids(elements):
+    return [element.element_id for element in elements]
+
+def sample_graph() -> KnowledgeGraph:
+    graph = KnowledgeGraph()
+    graph.add_element(StoryElement('hero', 'character', 'Hero', ['heroic'], {Mood.DARK: 0.5, Mood.ROMANTIC: 0}))
+    graph.add_element(StoryElement('villain', 'character', 'Villain', ['evil'], {Mood.DARK: 0.9}))
+    return graph
+
+def test_mood_weights_behave_like_a_dict():
+    element = StoryElement('hero', 'character', 'Hero', mood_weights={Mood.DARK: 0.5, Mood.ROMANTIC: 0})
+    weights = element.mood_weights
+    assert dict(weights) == {Mood.DARK: 0.5, Mood.ROMANTIC: 0}
+    assert (len(weights), Mood.ROMANTIC in weights, Mood.TENSE in weights) == (2, True, False)
+    assert weights[Mood.ROMANTIC] == 0 and weights.get(Mood.TENSE, -1) == -1
+    with pytest.raises(KeyError):
+        weights[Mood.TENSE]
+    weights[Mood.TENSE] = 0.25
+    del weights[Mood.ROMANTIC]
+    assert dict(element.mood_weights) == {Mood.DARK: 0.5, Mood.TENSE: 0.25}
+    with pytest.raises(KeyError):
+        del weights[Mood.ROMANTIC]
+    element.mood_weights = {Mood.HUMOROUS: 0.0}
+    assert dict(element.mood_weights) == {Mood.HUMOROUS: 0.0}
+
+def test_explicit_zero_weights_survive_copies_and_pickles():
+    element = sample_graph().nodes['hero']
+    for copied in (element.copy(), pickle.loads(pickle.dumps(element))):
+        assert dict(copied.mood_weights) == {Mood.DARK: 0.5, Mood.ROMANTIC: 0}
+        assert list(copied.tags) == ['heroic']
+
+def test_explicit_zero_weights_stay_out_of_the_indexes():
+    graph = sample_graph()
+    assert ids(graph.find_elements_by_mood(Mood.ROMANTIC, 0.01)) == []
+    graph.nodes['villain'].mood_weights[Mood.ROMANTIC] = 0.4
+    assert ids(graph.find_elements_by_mood(Mood.ROMANTIC, 0.01)) == ['villain']
+    graph.nodes['villain'].mood_weights[Mood.ROMANTIC] = 0
+    assert ids(graph.find_elements_by_mood(Mood.ROMANTIC, 0.01)) == []
+    assert Mood.ROMANTIC in graph.nodes['villain'].mood_weights
+    # The graph-level setter keeps its meaning: a zero weight removes the mood
+    graph.set_mood_weight('hero', Mood.ROMANTIC, 0)
+    assert Mood.ROMANTIC not in graph.nodes['hero'].mood_weights
+
+def test_tag_changes_reindex_the_element():
+    graph = sample_graph()
+    hero = graph.nodes['hero']
+    hero.tags.append('wise')
+    hero.tags.remove('heroic')
+    assert hero.tags == ['wise'] and hero.tags == ('wise',) and 'wise' in hero.tags
+    assert ids(graph.query(Tagged('wise'))) == ['hero']
+    assert ids(graph.query(Tagged('heroic'))) == []
+    hero.tags[0:1] = ['brave', 'kind']
+    assert ids(graph.query(Tagged('kind'))) == ['hero']
+
+def test_frozen_elements_reject_tag_changes():
+    graph = sample_graph()
+    overlay = graph.overlay()
+    with pytest.raises(RuntimeError):
+        graph.nodes['hero'].tags.append('wise')
+    assert list(graph.nodes['hero'].tags) == ['heroic']
+    assert ids(overlay.query(Tagged('wise'))) == []
+
+def test_relationships_list_outgoing_edges():
+    graph = sample_graph()
+    graph.add_relationship('hero', 'villain', 'opposes')
+    assert graph.nodes['hero'].relationships == {'villain': 'opposes'}
+    assert graph.nodes['villain'].relationships == {}
+    assert StoryElement('loose', 'item', 'Loose').relationships == {}
+    overlay = graph.overlay()
+    overlay.add_relationship('hero', 'villain', 'knows')
+    # Base elements are shared by every overlay, so they list the base's edges
+    assert overlay.nodes['hero'].relationships == {'villain': 'opposes'}
+    assert overlay.outgoing_relationships('hero') == {'villain': 'knows'}
+    overlay.add_element(StoryElement('sidekick', 'character', 'Sidekick'))
+    overlay.add_relationship('sidekick', 'hero', 'guided_by')
+    assert overlay.nodes['sidekick'].relationships == {'hero': 'guided_by'}
+
+def test_persistent_graph_keeps_zero_weights_and_tags(tmp_path):
+    path = str(tmp_path / 'world.db')
+    store = SQLiteStore(path)
+    source = sample_graph()
+    for element in source.nodes.values():
+        store.graph.add_element(element.copy())
+    store.graph.add_relationship('hero', 'villain', 'opposes')
+    store.graph.nodes['villain'].tags.append('cunning')
+    store.close()
+
+    store = SQLiteStore(path)
+    try:
+        hero, villain = store.graph.nodes['hero'], store.graph.nodes['villain']
+        assert dict(hero.mood_weights) == {Mood.DARK: 0.5, Mood.ROMANTIC: 0}
+        assert list(villain.tags) == ['evil', 'cunning']
+        assert hero.relationships == {'villain': 'opposes'}
+        assert ids(store.graph.find_elements_by_mood(Mood.ROMANTIC, 0.01)) == []
+    finally:
+        store.close()
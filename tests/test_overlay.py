@@ -0,0 +1,124 @@
+import random
+
+import pytest
+
+from benchmark import ELEMENT_TYPES, RELATIONSHIP_TYPES, TAGS, build_synthetic_world
+from storytelling import (KnowledgeGraph, Mood, MoodAtLeast, OfType, PersonalizedDiscovery, RelatedTo,
+                          StoryElement, Tagged, UserProfile)
+
+MOODS = list(Mood)
+
+def materialize(graph: KnowledgeGraph) -> KnowledgeGraph:
+    # A plain graph holding what the overlay shows, in the same order
+    materialized = KnowledgeGraph()
+    for element_id in graph.nodes:
+        materialized.add_element(graph.nodes[element_id].copy())
+    for (from_id, to_id), relationship_type in graph.relationships.items():
+        materialized.add_relationship(from_id, to_id, relationship_type)
+    return materialized
+
+def ids(elements):
+    return [element.element_id for element in elements]
+
+def assert_same_view(overlay: KnowledgeGraph, rng: random.Random):
+    reference = materialize(overlay)
+    assert list(overlay.nodes) == list(reference.nodes)
+    for element_id in reference.nodes:
+        shown, expected = overlay.nodes[element_id], reference.nodes[element_id]
+        assert ((shown.element_type, shown.tags, list(shown.weights), shown.usage_count)
+                == (expected.element_type, expected.tags, list(expected.weights), expected.usage_count))
+    for mood in MOODS:
+        for element_type in [None] + ELEMENT_TYPES:
+            for threshold in (0, 0.3, 0.5, 0.77, 1.0):
+                assert (ids(overlay.find_elements_by_mood(mood, threshold, element_type))
+                        == ids(reference.find_elements_by_mood(mood, threshold, element_type)))
+    for element_id in rng.sample(list(reference.nodes), 30) + ['missing']:
+        for relationship_type in (None, 'knows'):
+            assert (ids(overlay.get_related_elements(element_id, relationship_type))
+                    == ids(reference.get_related_elements(element_id, relationship_type)))
+            assert (ids(overlay.get_referring_elements(element_id, relationship_type))
+                    == ids(reference.get_referring_elements(element_id, relationship_type)))
+    for relationship_type in RELATIONSHIP_TYPES + ['ally']:
+        assert (set(overlay.get_relationships_by_type(relationship_type))
+                == set(reference.get_relationships_by_type(relationship_type)))
+    for _ in range(60):
+        terms = [Tagged(rng.choice(TAGS)), OfType(rng.choice(ELEMENT_TYPES)),
+                 MoodAtLeast(rng.choice(MOODS), rng.random()), RelatedTo(rng.choice(list(reference.nodes))),
+                 ~Tagged(rng.choice(TAGS))]
+        query = terms[0]
+        for term in rng.sample(terms, rng.randint(1, 4)):
+            query = (query & term) if rng.random() < 0.6 else (query | term)
+        assert ids(overlay.query(query)) == ids(reference.query(query))
+
+def edit(overlay: KnowledgeGraph, rng: random.Random, steps: int):
+    base_ids = list(overlay.base.nodes)
+    for step in range(steps):
+        current = list(overlay.nodes)
+        roll = rng.random()
+        if roll < 0.15:
+            element_id = f'new_{step}' if rng.random() < 0.7 else rng.choice(base_ids)
+            overlay.add_element(StoryElement(element_id, rng.choice(ELEMENT_TYPES), 'x', rng.sample(TAGS, 2),
+                                             {mood: round(rng.uniform(0.1, 1), 2) for mood in rng.sample(MOODS, 2)}))
+        elif roll < 0.3:
+            overlay.set_mood_weight(rng.choice(current), rng.choice(MOODS), rng.choice([0, round(rng.random(), 2)]))
+        elif roll < 0.4:
+            overlay.record_usage(rng.choice(current))
+        elif roll < 0.5:
+            overlay.remove_element(rng.choice(current))
+        elif roll < 0.55 and overlay.local_nodes:
+            element = rng.choice(list(overlay.local_nodes.values()))
+            element.mood_weights = {rng.choice(MOODS): round(rng.random(), 2)}
+            overlay.add_element(element)
+        elif roll < 0.8:
+            overlay.add_relationship(rng.choice(current), rng.choice(current),
+                                     rng.choice(RELATIONSHIP_TYPES + ['ally']))
+        else:
+            overlay.remove_relationship(*rng.choice(list(overlay.relationships)))
+
+@pytest.mark.parametrize('seed', [5, 6])
+def test_overlay_matches_materialized_graph(seed):
+    rng = random.Random(seed)
+    base = build_synthetic_world(1500, 3, seed)
+    overlay = base.overlay()
+    for _ in range(3):
+        edit(overlay, rng, 150)
+        assert_same_view(overlay, rng)
+    overlay.rebuild_indexes()
+    assert_same_view(overlay, rng)
+
+def test_overlay_leaves_base_untouched():
+    rng = random.Random(8)
+    base = build_synthetic_world(800, 3, 8)
+    elements = {element_id: (tuple(element.weights), element.usage_count) for element_id, element in base.nodes.items()}
+    relationships = dict(base.relationships)
+    edit(base.overlay(), rng, 300)
+    assert {element_id: (tuple(element.weights), element.usage_count)
+            for element_id, element in base.nodes.items()} == elements
+    assert dict(base.relationships) == relationships
+    with pytest.raises(RuntimeError):
+        base.record_usage(next(iter(base.nodes)))
+
+def test_nested_overlays_and_deferred_indexing():
+    rng = random.Random(9)
+    overlay = build_synthetic_world(800, 3, 9).overlay()
+    edit(overlay, rng, 100)
+    with overlay.deferred_indexing():
+        overlay.add_element(StoryElement('bulk', 'item', 'b', ['evil'], {Mood.DARK: 0.9}))
+        overlay.remove_element(next(iter(overlay.nodes)))
+    assert_same_view(overlay, rng)
+    nested = overlay.overlay()
+    nested.add_element(StoryElement('deep', 'character', 'd', ['wise'], {Mood.CONTEMPLATIVE: 0.95}))
+    nested.remove_element('bulk')
+    edit(nested, rng, 100)
+    assert_same_view(nested, rng)
+
+def test_overlay_recommendations_match_materialized_graph():
+    rng = random.Random(10)
+    overlay = build_synthetic_world(1500, 3, 10).overlay()
+    edit(overlay, rng, 200)
+    on_overlay = PersonalizedDiscovery(overlay, cache_size=0)
+    on_reference = PersonalizedDiscovery(materialize(overlay), cache_size=0)
+    for user in range(30):
+        profile = UserProfile(f'user_{user}', narrative_preferences={
+            mood.value: round(rng.uniform(0, 1), 2) for mood in rng.sample(MOODS, 3)})
+        assert ids(on_overlay.recommend_content(profile, {}, 8)) == ids(on_reference.recommend_content(profile, {}, 8))
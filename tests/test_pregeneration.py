@@ -0,0 +1,41 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from storytelling import AdaptiveStorytellingPlatform, PregenerationConfig
+
+def platform(**config):
+    return AdaptiveStorytellingPlatform(pregeneration=PregenerationConfig(**config))
+
+def test_renders_wait_for_the_owner():
+    story_platform = platform(top_moods=2)
+    story_platform.process_user_choice('u', 'I explore the mysterious forest', 2.0)
+    story_platform.generate_adaptive_content('u')
+    pregenerator = story_platform.pregenerator
+    assert pregenerator.stats()['pregenerated'] == 0
+    assert pregenerator.run_pending(limit=1) == 1
+    assert pregenerator.run_pending() == 1 and pregenerator.run_pending() == 0
+    story_platform.generate_adaptive_content('u')
+    assert pregenerator.stats()['hits'] == 1
+
+def test_renders_run_on_the_owning_executor():
+    owner = ThreadPoolExecutor(max_workers=1)
+    story_platform = platform(top_moods=3)
+    render_threads = []
+    render = story_platform.pregenerator.render
+    story_platform.pregenerator.render = lambda mood: render_threads.append(threading.get_ident()) or render(mood)
+    story_platform.pregenerator.executor = owner
+    try:
+        owner_thread = owner.submit(threading.get_ident).result()
+        owner.submit(story_platform.process_user_choice, 'u', 'I fight the dark shadow', 2.0).result()
+        owner.submit(story_platform.generate_adaptive_content, 'u').result()
+    finally:
+        owner.shutdown(wait=True)
+    assert render_threads and set(render_threads) == {owner_thread}
+    assert story_platform.pregenerator.stats()['pregenerated'] == len(render_threads)
+
+def test_queued_renders_of_evicted_users_are_skipped():
+    story_platform = platform(top_moods=1, max_users=1)
+    for user_id in ('a', 'b'):
+        story_platform.generate_adaptive_content(user_id)
+    assert story_platform.pregenerator.run_pending() == 1
+    assert set(story_platform.pregenerator.sessions) == {'b'}
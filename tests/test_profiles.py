@@ -0,0 +1,104 @@
+from datetime import datetime
+
+from storytelling import (AdaptiveStorytellingPlatform, EngagementLevel, Mood, UserChoice, UserEngagementTracker,
+                          UserProfile)
+
+def make_choice(index: int) -> UserChoice:
+    return UserChoice(f'c{index}', 'explore', datetime(2024, 1, 1), 2.0, {Mood.ADVENTUROUS: 0.2})
+
+def test_history_is_unbounded_by_default():
+    platform = AdaptiveStorytellingPlatform()
+    for _ in range(250):
+        platform.process_user_choice('u', 'I explore the forest', 2.0)
+    assert len(platform.users['u'].choice_history) == 250
+
+def test_history_limit_hands_dropped_choices_to_the_sink():
+    expired = []
+    profile = UserProfile('u', choice_history=[make_choice(index) for index in range(5)],
+                          history_limit=3, history_sink=expired.append)
+    assert [choice.choice_id for choice in expired] == ['c0', 'c1']
+    for index in range(5, 10):
+        profile.add_choice(make_choice(index))
+    assert [choice.choice_id for choice in profile.choice_history] == ['c7', 'c8', 'c9']
+    assert [choice.choice_id for choice in expired] == [f'c{index}' for index in range(7)]
+    assert profile.choice_count == 5
+
+def test_zero_history_limit_keeps_nothing():
+    expired = []
+    profile = UserProfile('u', history_limit=0, history_sink=expired.append)
+    profile.add_choice(make_choice(0))
+    assert not profile.choice_history
+    assert [choice.choice_id for choice in expired] == ['c0']
+
+def test_bounded_history_survives_a_state_round_trip():
+    profile = UserProfile('u', history_limit=2)
+    for index in range(4):
+        profile.add_choice(make_choice(index))
+    restored = UserProfile.from_state(profile.to_state())
+    assert [choice.choice_id for choice in restored.choice_history] == ['c2', 'c3']
+    restored.add_choice(make_choice(4))
+    assert [choice.choice_id for choice in restored.choice_history] == ['c3', 'c4']
+
+def test_tracker_buffers_grow_with_the_first_choices():
+    tracker = UserEngagementTracker(capacity=4)
+    assert (len(tracker.timestamps), len(tracker.response_times), len(tracker.choice_ids)) == (0, 0, 0)
+    for index in range(6):
+        tracker.track_choice(float(index), f'c{index}', timestamp=float(index))
+    assert (len(tracker.timestamps), len(tracker.response_times), len(tracker.choice_ids)) == (4, 4, 4)
+    assert [choice_id for _, _, choice_id in tracker.recent_interactions()] == ['c2', 'c3', 'c4', 'c5']
+    assert tracker.total_choices == 6
+
+def test_tracker_engagement_counts_cover_the_window():
+    tracker = UserEngagementTracker(capacity=3, min_samples=10)
+    for response_time in (20.0, 20.0, 20.0):
+        tracker.track_choice(response_time, 'slow')
+    assert tracker.engagement_counts[EngagementLevel.LOW] == 3
+    for response_time in (1.0, 1.0):
+        tracker.track_choice(response_time, 'fast')
+    assert tracker.engagement_counts == {EngagementLevel.HIGH: 2, EngagementLevel.MEDIUM: 0, EngagementLevel.LOW: 1}
+    assert sum(tracker.engagement_counts.values()) == tracker.size
+    stats = tracker.rolling_stats()
+    assert (stats['high_engagement_count'], stats['low_engagement_count']) == (2, 1)
+
+def test_steady_pace_stays_highly_engaged():
+    tracker = UserEngagementTracker()
+    levels = [tracker.track_choice(2.0, f'c{index}') for index in range(20)]
+    assert set(levels) == {EngagementLevel.HIGH}
+
+def test_tracker_survives_a_state_round_trip():
+    tracker = UserEngagementTracker(capacity=3, min_samples=10)
+    for index, response_time in enumerate((20.0, 5.0, 1.0, 1.0)):
+        tracker.track_choice(response_time, f'c{index}', timestamp=float(index))
+    state = tracker.to_state()
+    restored = UserEngagementTracker.from_state(state)
+    assert restored.recent_interactions() == tracker.recent_interactions()
+    assert restored.engagement_counts == tracker.engagement_counts
+    assert restored.total_choices == 4
+    del state['engagement_levels']
+    reclassified = UserEngagementTracker.from_state(state)
+    assert reclassified.engagement_counts == tracker.engagement_counts
+
+class RecordingUsers(dict):
+    def __init__(self):
+        super().__init__()
+        self.handed_back = []
+
+    def __setitem__(self, user_id, profile):
+        self.handed_back.append(user_id)
+        super().__setitem__(user_id, profile)
+
+def test_replay_copies_analyzed_choices_and_hands_profiles_back_per_chunk():
+    texts = ['I explore the forest', 'I fight the dark shadow', 'I laugh at the jester']
+    events = [(f'u{index % 2}', UserChoice(f'c{index}', texts[index % 3], datetime(2024, 1, 1, 0, index), 2.0))
+              for index in range(6)]
+    users = RecordingUsers()
+    platform = AdaptiveStorytellingPlatform(profile_store=users)
+    for user_id in ('u0', 'u1'):
+        platform.create_user(user_id)
+    users.handed_back.clear()
+    moods = platform.process_choices_batch(events, chunk_size=4)
+    assert moods == AdaptiveStorytellingPlatform().process_choices_batch(events)
+    assert all(choice.mood_impact == {} for _, choice in events)
+    assert all(choice.mood_impact for choice in users['u0'].choice_history)
+    # Chunks [0..3] and [4, 5] each hand back the users they touched
+    assert users.handed_back == ['u0', 'u1', 'u0', 'u1']
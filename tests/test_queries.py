@@ -0,0 +1,161 @@
+import random
+
+import pytest
+
+from benchmark import ELEMENT_TYPES, RELATIONSHIP_TYPES, TAGS, build_synthetic_world
+from storytelling import (AllOf, AnyOf, KnowledgeGraph, Mood, MoodAtLeast, Not, OfType, RelatedTo,
+                          StoryElement, Tagged)
+
+MOODS = list(Mood)
+THRESHOLDS = [-1, 0, 0.05, 0.1, 0.5, 0.6, 0.65, 0.99, 1.0, 1.1]
+
+def reference_matches(graph: KnowledgeGraph, query, element: StoryElement) -> bool:
+    # Straight from the element and the relationship map, without any index
+    if isinstance(query, Tagged):
+        return query.tag in element.tags
+    if isinstance(query, OfType):
+        return element.element_type == query.element_type
+    if isinstance(query, MoodAtLeast):
+        return query.threshold <= 0 or element.mood_weights.get(query.mood, 0) >= query.threshold
+    if isinstance(query, RelatedTo):
+        relationship_type = graph.relationships.get((query.element_id, element.element_id))
+        return relationship_type is not None and query.relationship_type in (None, relationship_type)
+    if isinstance(query, AllOf):
+        return all(reference_matches(graph, part, element) for part in query.queries)
+    if isinstance(query, AnyOf):
+        return any(reference_matches(graph, part, element) for part in query.queries)
+    if isinstance(query, Not):
+        return not reference_matches(graph, query.query, element)
+    raise TypeError(query)
+
+def random_query(rng: random.Random, ids, depth: int = 0):
+    if depth > 2 or rng.random() < 0.5:
+        kind = rng.randrange(4)
+        if kind == 0:
+            return Tagged(rng.choice(TAGS + ['unknown-tag']))
+        if kind == 1:
+            return OfType(rng.choice(ELEMENT_TYPES))
+        if kind == 2:
+            return MoodAtLeast(rng.choice(MOODS), rng.choice(THRESHOLDS + [round(rng.random(), 3)]))
+        return RelatedTo(rng.choice(ids), rng.choice([None] + RELATIONSHIP_TYPES))
+    kind = rng.randrange(3)
+    if kind == 0:
+        return random_query(rng, ids, depth + 1) & random_query(rng, ids, depth + 1)
+    if kind == 1:
+        return random_query(rng, ids, depth + 1) | random_query(rng, ids, depth + 1)
+    return ~random_query(rng, ids, depth + 1)
+
+def mutate(graph: KnowledgeGraph, rng: random.Random, steps: int):
+    # Weight changes, replacements, elements changed in place and added
+    # again, new elements and new edges
+    for step in range(steps):
+        ids = list(graph.nodes)
+        element_id = rng.choice(ids)
+        roll = rng.random()
+        if roll < 0.3:
+            graph.set_mood_weight(element_id, rng.choice(MOODS), rng.choice([0, 0.05, 0.3, 0.6, 1.0, rng.random()]))
+        elif roll < 0.5:
+            graph.add_element(StoryElement(element_id, rng.choice(ELEMENT_TYPES), 'replaced', rng.sample(TAGS, 2),
+                                           {rng.choice(MOODS): rng.random()}))
+        elif roll < 0.7:
+            element = graph.nodes[element_id]
+            element.mood_weights = {mood: round(rng.random(), 2) for mood in rng.sample(MOODS, 2)}
+            element.tags = rng.sample(TAGS, 2)
+            element.element_type = rng.choice(ELEMENT_TYPES)
+            graph.add_element(element)
+        else:
+            graph.add_element(StoryElement(f'new_{step}', rng.choice(ELEMENT_TYPES), 'new', rng.sample(TAGS, 3),
+                                           {rng.choice(MOODS): rng.random()}))
+        graph.add_relationship(rng.choice(ids), element_id, rng.choice(RELATIONSHIP_TYPES))
+
+def assert_queries_match_scan(graph: KnowledgeGraph, rng: random.Random, count: int = 200):
+    ids = list(graph.nodes)
+    in_order = sorted(graph.nodes.values(), key=lambda element: graph.ordinals[element.element_id])
+    for _ in range(count):
+        query = random_query(rng, ids)
+        expected = [element.element_id for element in in_order if reference_matches(graph, query, element)]
+        assert [element.element_id for element in graph.query(query)] == expected
+
+def assert_mood_index_matches_scan(graph: KnowledgeGraph):
+    for mood in MOODS:
+        for element_type in [None] + ELEMENT_TYPES:
+            for threshold in (0.05, 0.5, 0.85):
+                expected = sorted(
+                    (element for element in graph.nodes.values()
+                     if element.mood_weights.get(mood, 0) >= threshold
+                     and element_type in (None, element.element_type)),
+                    key=lambda element: (-element.mood_weights[mood], graph.ordinals[element.element_id]))
+                found = graph.find_elements_by_mood(mood, threshold, element_type)
+                assert [element.element_id for element in found] == [element.element_id for element in expected]
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_queries_match_linear_scan(seed):
+    rng = random.Random(seed)
+    graph = build_synthetic_world(1500, 3, seed)
+    assert_queries_match_scan(graph, rng)
+    mutate(graph, rng, 400)
+    assert_queries_match_scan(graph, rng)
+    graph.rebuild_indexes()
+    assert_queries_match_scan(graph, rng)
+
+@pytest.mark.parametrize('seed', [1, 2])
+def test_mood_index_matches_linear_scan(seed):
+    rng = random.Random(seed)
+    graph = build_synthetic_world(800, 3, seed)
+    mutate(graph, rng, 300)
+    assert_mood_index_matches_scan(graph)
+    graph.rebuild_indexes()
+    assert_mood_index_matches_scan(graph)
+
+def test_limit_keeps_insertion_order():
+    graph = build_synthetic_world(500, 3, 7)
+    query = MoodAtLeast(Mood.DARK, 0.3) | Tagged('evil')
+    assert graph.query(query, limit=10) == graph.query(query)[:10]
+
+@pytest.mark.parametrize('seed', [4, 5])
+def test_direct_weight_writes_keep_indexes_current(seed):
+    rng = random.Random(seed)
+    graph = build_synthetic_world(800, 3, seed)
+    for step in range(600):
+        element = graph.nodes[rng.choice(list(graph.nodes))]
+        mood = rng.choice(MOODS)
+        roll = rng.random()
+        if roll < 0.4:
+            element.mood_weights[mood] = round(rng.random(), 2)
+        elif roll < 0.6 and mood in element.mood_weights:
+            del element.mood_weights[mood]
+        elif roll < 0.8:
+            element.mood_weights = {mood: round(rng.random(), 2) for mood in rng.sample(MOODS, 2)}
+        else:
+            element.set_mood_weight(mood, rng.choice([0, 0.5, 1.0]))
+        if step % 50 == 0:
+            # Reads in between merge the pending index changes
+            graph.find_elements_by_mood(mood, 0.5)
+    assert_mood_index_matches_scan(graph)
+    assert_queries_match_scan(graph, rng)
+
+def test_replaced_and_frozen_elements_do_not_touch_indexes():
+    graph = build_synthetic_world(200, 3, 8)
+    replaced = graph.nodes['hero_1']
+    graph.add_element(StoryElement('hero_1', 'character', 'Alex the Brave', ['heroic'], {Mood.DARK: 0.2}))
+    replaced.mood_weights[Mood.DARK] = 1.0
+    assert 'hero_1' not in [element.element_id for element in graph.find_elements_by_mood(Mood.DARK, 0.5)]
+
+    overlay = graph.overlay()
+    with pytest.raises(RuntimeError):
+        overlay.nodes['hero_1'].mood_weights[Mood.DARK] = 1.0
+    assert 'hero_1' not in [element.element_id for element in overlay.find_elements_by_mood(Mood.DARK, 0.5)]
+    overlay.set_mood_weight('hero_1', Mood.DARK, 1.0)
+    overlay.nodes['hero_1'].mood_weights[Mood.ROMANTIC] = 0.9
+    assert 'hero_1' in [element.element_id for element in overlay.find_elements_by_mood(Mood.ROMANTIC, 0.9)]
+    assert graph.nodes['hero_1'].mood_weights.get(Mood.ROMANTIC) is None
+
+def test_one_at_a_time_build_matches_rebuild():
+    rng = random.Random(9)
+    graph = KnowledgeGraph()
+    for ordinal in range(3000):
+        graph.add_element(StoryElement(f'e{ordinal}', rng.choice(ELEMENT_TYPES), 'x', rng.sample(TAGS, 2),
+                                       {mood: round(rng.random(), 2) for mood in rng.sample(MOODS, 3)}))
+        if ordinal % 500 == 0:
+            graph.find_elements_by_mood(rng.choice(MOODS), 0.5)
+    assert_mood_index_matches_scan(graph)
@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from benchmark import ELEMENT_TYPES, TAGS, build_synthetic_world
+from storytelling import (AdaptiveStorytellingPlatform, KnowledgeGraph, Mood, PersonalizedDiscovery, StoryElement,
+                          UserProfile, np)
+
+pytestmark = pytest.mark.skipif(np is None, reason='the matrix path needs NumPy')
+
+MOODS = list(Mood)
+
+def random_profile(rng: random.Random, user: int) -> UserProfile:
+    return UserProfile(f'user_{user}', narrative_preferences={
+        mood.value: rng.choice([0.1, 0.35, 0.5, round(rng.uniform(0, 1), 2)]) for mood in rng.sample(MOODS, 3)})
+
+def tied_world(rng: random.Random, size: int) -> KnowledgeGraph:
+    # Coarse weights and usage counts, so many elements share a score
+    graph = KnowledgeGraph()
+    for index in range(size):
+        graph.add_element(StoryElement(f'element_{index}', rng.choice(ELEMENT_TYPES), 'tied', rng.sample(TAGS, 2),
+                                       {mood: rng.choice([0.5, 1.0]) for mood in rng.sample(MOODS, 2)}))
+        if rng.random() < 0.3:
+            graph.record_usage(f'element_{index}', rng.randrange(4))
+    return graph
+
+def assert_matrix_matches_python(graph: KnowledgeGraph, rng: random.Random):
+    discovery = PersonalizedDiscovery(graph, cache_size=0)
+    profiles = [random_profile(rng, user) for user in range(40)]
+    for k in (1, 5, 20):
+        batched = discovery._score_users(profiles, k)
+        for profile, recommended in zip(profiles, batched):
+            expected = discovery._recommend_content_python(profile, k)
+            assert [element.element_id for element in recommended] == [element.element_id for element in expected]
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_matrix_ranking_matches_python(seed):
+    rng = random.Random(seed)
+    graph = build_synthetic_world(2000, 3, seed)
+    for element_id in rng.sample(list(graph.nodes), 300):
+        graph.record_usage(element_id, rng.randrange(1, 4))
+    assert_matrix_matches_python(graph, rng)
+
+@pytest.mark.parametrize('seed', [4, 5])
+def test_matrix_ranking_breaks_ties_like_python(seed):
+    rng = random.Random(seed)
+    assert_matrix_matches_python(tied_world(rng, 1000), rng)
+
+def test_equal_scores_go_to_earlier_elements():
+    graph = KnowledgeGraph()
+    for index in range(1000):
+        graph.add_element(StoryElement(f'element_{index}', 'item', 'same', [], {Mood.DARK: 0.8}))
+    profile = UserProfile('user', narrative_preferences={Mood.DARK.value: 0.5})
+    recommended = PersonalizedDiscovery(graph, cache_size=0).recommend_content(profile, {}, 5)
+    assert [element.element_id for element in recommended] == [f'element_{index}' for index in range(5)]
+
+def test_growing_the_matrix_keeps_rows_and_zeroes_the_rest():
+    graph = KnowledgeGraph()
+    for index in range(40):
+        graph.add_element(StoryElement(f'element_{index}', 'item', 'x', [], {MOODS[index % len(MOODS)]: 0.5}))
+        graph.record_usage(f'element_{index}', index % 3)
+    weights, usage = graph.weight_matrix()
+    for element_id, element in graph.nodes.items():
+        ordinal = graph.ordinals[element_id]
+        assert list(weights[ordinal]) == list(element.weights) and usage[ordinal] == element.usage_count
+    assert not graph.mood_matrix[40:].any() and not graph.usage_counts[40:].any()
+
+def test_served_recommendations_are_recorded():
+    graph = KnowledgeGraph()
+    for index in range(6):
+        graph.add_element(StoryElement(f'element_{index}', 'item', f'item {index}', [], {Mood.DARK: 0.9 - index / 20}))
+    platform = AdaptiveStorytellingPlatform(knowledge_graph=graph)
+    platform.create_user('u').narrative_preferences = {Mood.DARK.value: 0.8}
+    version = graph.version
+    served = [platform.generate_adaptive_content('u')['recommendations'] for _ in range(4)]
+    assert served[0] == [f'item {index}' for index in range(5)]
+    assert 'item 5' in served[1]  # Fresher than the elements served once already
+    assert sum(element.usage_count for element in graph.nodes.values()) == sum(map(len, served)) == 18
+    assert platform.generate_adaptive_content('u')['recommendations'] == []
+    assert graph.version == version
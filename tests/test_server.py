@@ -0,0 +1,92 @@
+import asyncio
+import json
+import logging
+
+import pytest
+
+from server import ServerConfig, StoryServer
+from storage import TieredProfileStore
+from storytelling import AdaptiveStorytellingPlatform
+
+def run(scenario, platform=None, **config):
+    # Runs scenario(server) against a started server on an ephemeral port
+    async def main():
+        server = StoryServer(platform, ServerConfig(port=0, **config))
+        listener = await server.start()
+        try:
+            return await scenario(server)
+        finally:
+            listener.close()
+            await server.close()
+    return asyncio.run(main())
+
+async def post(server, path, body):
+    status, _, payload = await server._dispatch('POST', path, json.dumps(body).encode())
+    if not isinstance(payload, bytes):
+        payload = b''.join([chunk async for chunk in payload])
+        server.open_streams -= 1  # Normally released by handle_connection
+    return status, payload
+
+@pytest.mark.parametrize('path, body', [
+    ('/choice', {'choice_text': 'explore'}),
+    ('/choice', {'user_id': ['u'], 'choice_text': 'explore'}),
+    ('/choice', {'user_id': 'u', 'choice_text': 3}),
+    ('/choice', {'user_id': 'u', 'response_time': 'slow'}),
+    ('/choice', {'user_id': 'u', 'response_time': -1}),
+    ('/choice', {'user_id': 'u', 'response_time': True}),
+    ('/choice', {'user_id': 'u', 'ack': '3'}),
+    ('/content', {'user_id': 'u', 'context': ['dark']}),
+    ('/content/stream', {'user_id': 'u', 'ack': 1.5}),
+])
+def test_malformed_bodies_are_rejected(path, body):
+    status, payload = run(lambda server: post(server, path, body))
+    assert status == 400 and 'error' in json.loads(payload)
+
+def test_choice_content_and_stream():
+    async def scenario(server):
+        choice = await post(server, '/choice', {'user_id': 'u', 'choice_text': 'I explore the forest',
+                                                 'response_time': 2})
+        content = await post(server, '/content', {'user_id': 'u', 'context': {}, 'ack': 1})
+        stream = await post(server, '/content/stream', {'user_id': 'u'})
+        return choice, content, stream
+    (choice_status, choice), (content_status, content), (stream_status, stream) = run(scenario)
+    assert (choice_status, content_status, stream_status) == (200, 200, 200)
+    assert json.loads(choice)['user_profile']['preferences']['version'] == 1
+    assert json.loads(content)['preferences'] == {'version': 1}
+    parts = [json.loads(line)['part'] for line in stream.splitlines()]
+    assert parts == ['current_mood', 'visual_style', 'narrative', 'dialogue', 'recommendations', 'preferences']
+
+def test_server_errors_are_logged_as_500(caplog):
+    async def scenario(server):
+        def broken(requests):
+            raise KeyError('platform bug')
+        server.choice_batcher.handler = broken
+        return await post(server, '/choice', {'user_id': 'u', 'choice_text': 'explore'})
+    with caplog.at_level(logging.ERROR, logger='server'):
+        status, payload = run(scenario)
+    assert status == 500 and 'platform bug' in json.loads(payload)['error']
+    assert any(record.exc_info for record in caplog.records)
+
+@pytest.mark.parametrize('flush_interval', [0.01, 3600])
+def test_changed_spilled_profiles_are_written_back(tmp_path, flush_interval):
+    # Periodically, and at the latest when the server closes
+    path = str(tmp_path / 'profiles.db')
+    profiles = TieredProfileStore(path, max_resident=1)
+    platform = AdaptiveStorytellingPlatform(profile_store=profiles)
+
+    async def scenario(server):
+        await post(server, '/choice', {'user_id': 'a', 'choice_text': 'explore'})
+        held = profiles['a']
+        await post(server, '/choice', {'user_id': 'b', 'choice_text': 'explore'})
+        held.narrative_preferences['pace'] = 'slow'  # Changed after its spill
+        await asyncio.sleep(0.05)
+        return profiles.stats()
+    stats = run(scenario, platform, profile_flush_interval=flush_interval)
+    assert stats['detached'] == 1
+    profiles.connection.close()
+
+    reopened = TieredProfileStore(path)
+    try:
+        assert reopened['a'].narrative_preferences['pace'] == 'slow'
+    finally:
+        reopened.close()
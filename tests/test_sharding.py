@@ -0,0 +1,35 @@
+import os
+import signal
+import time
+
+import pytest
+
+from sharding import ShardedPlatform, WorkerDied
+from storytelling import AdaptiveStorytellingPlatform
+
+class SlowPlatform(AdaptiveStorytellingPlatform):
+    def wait(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+def summary(result):
+    return result['inferred_mood'], result['engagement_level']
+
+def test_batches_match_a_single_platform():
+    texts = ['I explore the mysterious forest', 'I fight the dark shadow', 'I laugh at the jester']
+    requests = [(f'user_{index % 7}', texts[index % 3], 1.0 + index % 5) for index in range(40)]
+    expected = [summary(result) for result in AdaptiveStorytellingPlatform().process_user_choices(requests)]
+    with ShardedPlatform(workers=2) as sharded:
+        assert [summary(result) for result in sharded.process_user_choices(requests)] == expected
+
+def test_pending_futures_fail_when_a_worker_dies():
+    with ShardedPlatform(workers=2, platform_factory=SlowPlatform) as sharded:
+        pending = sharded.submit(0, 'wait', 30)
+        survivor = sharded.submit(1, 'wait', 0.1)
+        os.kill(sharded.processes[0].pid, signal.SIGKILL)
+        with pytest.raises(WorkerDied, match='shard 0'):
+            pending.result(timeout=10)
+        assert survivor.result(timeout=10) == 0.1
+        with pytest.raises(WorkerDied):
+            sharded.submit(0, 'wait', 0).result(timeout=10)
+        assert sharded.submit(1, 'wait', 0).result(timeout=10) == 0
@@ -0,0 +1,149 @@
+import random
+import threading
+
+import pytest
+
+from benchmark import ELEMENT_TYPES, RELATIONSHIP_TYPES, build_synthetic_world
+from storage import SQLiteStore, TieredProfileStore
+from storytelling import AdaptiveStorytellingPlatform, KnowledgeGraph, Mood, StoryElement, UserProfile
+
+MOODS = list(Mood)
+
+def ids(elements):
+    return [element.element_id for element in elements]
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteStore(str(tmp_path / 'world.db'), commit_interval=0.01)
+    yield store
+    store.close()
+
+def copy_world(source: KnowledgeGraph, target: KnowledgeGraph):
+    for element in source.nodes.values():
+        target.add_element(element.copy())
+    for (from_id, to_id), relationship_type in source.relationships.items():
+        target.add_relationship(from_id, to_id, relationship_type)
+
+def assert_same_answers(graph: KnowledgeGraph, reference: KnowledgeGraph, rng: random.Random):
+    for mood in MOODS:
+        for element_type in [None] + ELEMENT_TYPES:
+            for threshold in (0, 0.5, 0.9):
+                assert (ids(graph.find_elements_by_mood(mood, threshold, element_type))
+                        == ids(reference.find_elements_by_mood(mood, threshold, element_type)))
+    for element_id in rng.sample(list(reference.nodes), 40):
+        assert ids(graph.get_related_elements(element_id)) == ids(reference.get_related_elements(element_id))
+        assert ids(graph.get_referring_elements(element_id)) == ids(reference.get_referring_elements(element_id))
+    for relationship_type in RELATIONSHIP_TYPES:
+        assert (graph.get_relationships_by_type(relationship_type)
+                == reference.get_relationships_by_type(relationship_type))
+
+def test_persistent_graph_matches_in_memory_graph(store):
+    rng = random.Random(3)
+    reference = build_synthetic_world(400, 3, 3)
+    copy_world(reference, store.graph)
+    assert_same_answers(store.graph, reference, rng)
+
+def test_retyping_keeps_neighbor_order(store):
+    rng = random.Random(4)
+    reference = build_synthetic_world(300, 3, 4)
+    copy_world(reference, store.graph)
+    for graph in (reference, store.graph):
+        graph.add_element(StoryElement('element_7', 'item', 'retyped', ['evil'], {Mood.DARK: 0.95}))
+    for from_id, to_id in rng.sample(list(reference.relationships), 50):
+        for graph in (reference, store.graph):
+            graph.add_relationship(from_id, to_id, 'ally')
+    assert list(store.graph.nodes) == list(reference.nodes)
+    assert_same_answers(store.graph, reference, rng)
+
+def test_reads_while_the_commit_thread_commits(store):
+    copy_world(build_synthetic_world(300, 3, 5), store.graph)
+    errors = []
+
+    def write():
+        # Straight to the store, as the graph's own objects belong to one thread
+        try:
+            for step in range(300):
+                store.write('UPDATE elements SET usage_count = usage_count + 1 WHERE element_id = ?',
+                            (f'element_{step % 299}',))
+                store.commit_idle()
+        except Exception as error:
+            errors.append(error)
+    writer = threading.Thread(target=write)
+    writer.start()
+    while writer.is_alive():
+        assert len(store.graph.find_elements_by_mood(Mood.DARK, 0)) == 300
+    writer.join()
+    assert not errors
+
+def test_profiles_survive_reopening(tmp_path):
+    path = str(tmp_path / 'world.db')
+    platform = AdaptiveStorytellingPlatform(storage=SQLiteStore(path))
+    for choice_text in ('I explore the forest', 'I investigate the strange sound'):
+        platform.process_user_choice('u', choice_text, 2.0)
+    preferences = dict(platform.users['u'].narrative_preferences)
+    platform.storage.close()
+
+    store = SQLiteStore(path)
+    try:
+        reopened = AdaptiveStorytellingPlatform(storage=store)
+        profile = reopened.users['u']
+        assert profile.narrative_preferences == preferences
+        assert [choice.choice_text for choice in profile.choice_history] == [
+            'I explore the forest', 'I investigate the strange sound']
+    finally:
+        store.close()
+
+@pytest.fixture
+def profiles(tmp_path):
+    profiles = TieredProfileStore(str(tmp_path / 'profiles.db'), max_resident=2)
+    yield profiles
+    profiles.close()
+
+def add_profiles(profiles, *user_ids):
+    for user_id in user_ids:
+        profile = UserProfile(user_id)
+        profile.narrative_preferences['name'] = user_id
+        profiles[user_id] = profile
+
+def test_least_recently_used_profiles_are_spilled_and_rehydrated(profiles):
+    add_profiles(profiles, 'a', 'b')
+    profiles['a']
+    add_profiles(profiles, 'c')
+    assert list(profiles.resident) == ['a', 'c'] and not profiles.detached
+    assert sorted(profiles) == ['a', 'b', 'c'] and 'b' in profiles
+    assert profiles['b'].narrative_preferences['name'] == 'b'
+    stats = profiles.stats()
+    assert (stats['resident'], stats['evictions'], stats['rehydrations'], stats['detached']) == (2, 2, 1, 0)
+    assert stats['rehydration_ms_max'] >= stats['rehydration_ms_mean'] > 0
+
+def test_held_profiles_are_handed_back_and_written_back(profiles):
+    add_profiles(profiles, 'a')
+    held = profiles['a']
+    add_profiles(profiles, 'b', 'c')
+    assert profiles.detached == {'a': held}
+    held.narrative_preferences['name'] = 'changed'
+    profiles.flush()
+    assert profiles.detached == {'a': held}
+    del held
+    profiles.flush()
+    assert not profiles.detached
+    assert profiles['a'].narrative_preferences['name'] == 'changed'
+    assert profiles.stats()['rehydrations'] == 1
+
+def test_reattached_profiles_are_the_same_object(profiles):
+    add_profiles(profiles, 'a')
+    held = profiles['a']
+    add_profiles(profiles, 'b', 'c')
+    assert profiles['a'] is held
+    assert profiles.stats()['reattached'] == 1 and not profiles.detached
+
+def test_idle_profiles_are_spilled(tmp_path):
+    profiles = TieredProfileStore(str(tmp_path / 'profiles.db'), max_resident=10, idle_seconds=3600)
+    try:
+        add_profiles(profiles, 'a', 'b')
+        assert profiles.evict_idle() == 0
+        profiles.idle_seconds = 0
+        assert profiles.evict_idle() == 2
+        assert profiles.stats()['idle_evictions'] == 2 and not profiles.resident
+    finally:
+        profiles.close()
@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from benchmark import build_synthetic_world
+from storage import SQLiteStore
+from worldio import WorldFormatError, export_world, load_world
+
+ELEMENTS = [
+    {'kind': 'element', 'element_id': 'hero', 'element_type': 'character', 'content': 'Hero',
+     'tags': ['heroic'], 'mood_weights': {'adventurous': 0.8}},
+    {'kind': 'element', 'element_id': 'forest', 'element_type': 'location', 'content': 'Forest',
+     'tags': [], 'mood_weights': {'MYSTERIOUS': 0.7}},
+]
+
+def write_world(path, records):
+    with open(path, 'w', encoding='utf-8') as handle:
+        for record in records:
+            handle.write(json.dumps(record) + '\n')
+    return str(path)
+
+def relationship(from_id, to_id, relationship_type='knows'):
+    return {'kind': 'relationship', 'from_id': from_id, 'to_id': to_id, 'relationship_type': relationship_type}
+
+@pytest.mark.parametrize('edge', [('hero', 'ghost'), ('ghost', 'hero')])
+def test_unknown_source_or_target_is_dangling(tmp_path, edge):
+    path = write_world(tmp_path / 'world.jsonl', ELEMENTS + [relationship('hero', 'forest'), relationship(*edge)])
+    with pytest.raises(WorldFormatError, match='1 relationships'):
+        load_world(path)
+    graph, report = load_world(path, on_dangling='drop')
+    assert list(graph.relationships) == [('hero', 'forest')]
+    assert (report.relationships, report.dangling_relationships) == (1, 1)
+    graph, report = load_world(path, on_dangling='keep')
+    assert edge in graph.relationships and report.relationships == 2
+
+def test_relationships_may_name_later_elements(tmp_path):
+    path = write_world(tmp_path / 'world.jsonl', [relationship('hero', 'forest', 'resides_in')] + ELEMENTS)
+    graph, report = load_world(path)
+    assert [element.element_id for element in graph.get_related_elements('hero')] == ['forest']
+    assert report.dangling_relationships == 0
+
+def test_load_into_the_sqlite_graph(tmp_path):
+    path = write_world(tmp_path / 'world.jsonl', ELEMENTS + [relationship('forest', 'hero'),
+                                                             relationship('ghost', 'hero')])
+    store = SQLiteStore(str(tmp_path / 'world.db'))
+    try:
+        with pytest.raises(WorldFormatError):
+            load_world(path, store.graph)
+        _, report = load_world(path, store.graph, on_dangling='drop')
+        assert report.dangling_relationships == 1
+        assert [element.element_id for element in store.graph.get_referring_elements('hero')] == ['forest']
+    finally:
+        store.close()
+
+@pytest.mark.parametrize('extension', ['jsonl', 'csv'])
+def test_export_round_trip(tmp_path, extension):
+    world = build_synthetic_world(300, 3, 2)
+    path = str(tmp_path / f'world.{extension}')
+    assert export_world(world, path) == (len(world.nodes), len(world.relationships))
+    loaded, _ = load_world(path)
+    assert list(loaded.nodes) == list(world.nodes)
+    assert list(loaded.relationships.items()) == list(world.relationships.items())
+    assert all(loaded.nodes[element_id].mood_weights == element.mood_weights
+               for element_id, element in world.nodes.items())
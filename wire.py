@@ -0,0 +1,110 @@
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, Optional
+
+from storytelling import AdaptiveStorytellingPlatform, EngagementLevel, Mood, UserProfile
+
+_dumps = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+
+# Enum members and their JSON, computed once
+ENUM_JSON = {member: _dumps(member.value) for enum in (Mood, EngagementLevel) for member in enum}
+
+class WireEncoder:
+    # Compact JSON for platform responses. Visual styles are the platform's
+    # static per-mood dicts, so their JSON is computed once. Preferences go out
+    # as a change set against the version the client last acknowledged:
+    #   {"version": 7}                                   nothing changed since the ack
+    #   {"version": 7, "base": 5, "changes": {...}}      changes since version 5
+    #   {"version": 7, "full": {...}}                    unknown or missing ack
+    # The last `history` versions sent to each user are kept to diff against.
+    def __init__(self, platform: AdaptiveStorytellingPlatform, history: int = 8, max_users: int = 100_000):
+        self.style_json = {id(style): (style, _dumps(style))
+                           for style in platform.visual_agent.style_mappings.values()}
+        self.history = history
+        self.max_users = max_users
+        self.snapshots = OrderedDict()  # user_id -> (profile_id, OrderedDict(version -> preferences))
+        self._lock = threading.Lock()
+
+    def choice_result(self, result: Dict[str, Any], ack: Optional[int] = None) -> bytes:
+        profile = result['user_profile']
+        return (f'{{"choice_id":{_dumps(result["choice_id"])},'
+                f'"engagement_level":{ENUM_JSON[result["engagement_level"]]},'
+                f'"inferred_mood":{ENUM_JSON[result["inferred_mood"]]},'
+                f'"user_profile":{self.profile(profile, ack)}}}').encode('utf-8')
+
+    def content(self, content: Dict[str, Any], profile: UserProfile, ack: Optional[int] = None) -> bytes:
+        return (f'{{"narrative":{_dumps(content["narrative"])},'
+                f'"dialogue":{_dumps(content["dialogue"])},'
+                f'"visual_style":{self.visual_style(content["visual_style"])},'
+                f'"recommendations":{_dumps(content["recommendations"])},'
+                f'"current_mood":{ENUM_JSON[content["current_mood"]]},'
+                f'"preferences":{self.preferences(profile, ack)}}}').encode('utf-8')
+
+    def part(self, part: str, value: Any, profile: UserProfile, ack: Optional[int] = None) -> bytes:
+        # One NDJSON line of a content stream
+        if part == 'user_preferences':
+            part, encoded = 'preferences', self.preferences(profile, ack)
+        elif part == 'visual_style':
+            encoded = self.visual_style(value)
+        else:
+            encoded = self.value(value)
+        return f'{{"part":"{part}","value":{encoded}}}\n'.encode('utf-8')
+
+    def profile(self, profile: UserProfile, ack: Optional[int] = None) -> str:
+        return (f'{{"user_id":{_dumps(profile.user_id)},'
+                f'"preferred_moods":[{",".join(ENUM_JSON[mood] for mood in profile.preferred_moods)}],'
+                f'"choice_count":{profile.choice_count},'
+                f'"engagement_patterns":{_dumps(profile.engagement_patterns)},'
+                f'"preferences":{self.preferences(profile, ack)}}}')
+
+    def visual_style(self, style: Dict[str, Any]) -> str:
+        cached = self.style_json.get(id(style))
+        if cached is not None and cached[0] is style:
+            return cached[1]
+        return _dumps(style)
+
+    def preferences(self, profile: UserProfile, ack: Optional[int] = None) -> str:
+        version = profile.preference_version
+        current = profile.narrative_preferences
+        with self._lock:
+            profile_id, snapshots = self.snapshots.pop(profile.user_id, None) or (None, None)
+            if profile_id != profile.profile_id:
+                snapshots = OrderedDict()  # New or recreated profile; its versions start over
+            self.snapshots[profile.user_id] = (profile.profile_id, snapshots)  # Most recently served user last
+            # Only a version this profile was actually sent can be a base
+            base = snapshots.get(ack) if ack is not None else None
+            if version not in snapshots:
+                snapshots[version] = dict(current)
+                while len(snapshots) > self.history:
+                    snapshots.popitem(last=False)
+            while len(self.snapshots) > self.max_users:
+                self.snapshots.popitem(last=False)
+
+        if ack == version and base is not None:
+            return f'{{"version":{version}}}'
+        if base is None:
+            return f'{{"version":{version},"full":{_dumps(current)}}}'
+        changes = {key: value for key, value in current.items() if base.get(key) != value}
+        encoded = f'{{"version":{version},"base":{ack},"changes":{_dumps(changes)}'
+        removed = [key for key in base if key not in current]
+        if removed:
+            encoded += f',"removed":{_dumps(removed)}'
+        return encoded + '}'
+
+    def value(self, value: Any) -> str:
+        # Anything else a response may carry
+        if isinstance(value, Enum):
+            return ENUM_JSON.get(value) or _dumps(value.value)
+        if isinstance(value, datetime):
+            return _dumps(value.isoformat())
+        if isinstance(value, UserProfile):
+            return self.profile(value)
+        if isinstance(value, dict):
+            return '{' + ','.join(f'{_dumps(key.value if isinstance(key, Enum) else str(key))}:{self.value(item)}'
+                                  for key, item in value.items()) + '}'
+        if isinstance(value, (list, tuple)):
+            return '[' + ','.join(self.value(item) for item in value) + ']'
+        return _dumps(value)
@@ -0,0 +1,224 @@
+import argparse
+import csv
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from storytelling import AdaptiveStorytellingPlatform, KnowledgeGraph, Mood, StoryElement
+
+# Accept both the enum value ("mysterious") and the member name ("MYSTERIOUS")
+MOODS_BY_NAME = {**{mood.value: mood for mood in Mood}, **{mood.name.lower(): mood for mood in Mood}}
+
+# CSV dumps keep elements and relationships in one file, distinguished by `kind`;
+# mood weights get one column per mood and tags are joined with TAG_SEPARATOR
+CSV_COLUMNS = (['kind', 'element_id', 'element_type', 'content', 'tags', 'usage_count']
+               + [mood.value for mood in Mood]
+               + ['from_id', 'to_id', 'relationship_type'])
+TAG_SEPARATOR = '|'
+
+class WorldFormatError(ValueError):
+    pass
+
+@dataclass
+class LoadReport:
+    elements: int = 0
+    relationships: int = 0
+    dangling_relationships: int = 0
+    seconds: float = 0.0
+
+    @property
+    def elements_per_second(self) -> float:
+        return self.elements / self.seconds if self.seconds else 0.0
+
+    @property
+    def relationships_per_second(self) -> float:
+        return self.relationships / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        return (f"Loaded {self.elements} elements and {self.relationships} relationships "
+                f"in {self.seconds:.2f}s ({self.elements_per_second:,.0f} elements/s, "
+                f"{self.relationships_per_second:,.0f} relationships/s); "
+                f"{self.dangling_relationships} dangling relationships")
+
+def parse_mood(name: str, location: str) -> Mood:
+    mood = MOODS_BY_NAME.get(name.strip().lower())
+    if mood is None:
+        raise WorldFormatError(f"{location}: unknown mood {name!r}")
+    return mood
+
+def detect_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    if extension == '.csv':
+        return 'csv'
+    raise WorldFormatError(f"cannot tell the format of {path}; pass format='jsonl' or 'csv'")
+
+def iter_jsonl_records(path: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    # Yields (location, record) one line at a time
+    with open(path, encoding='utf-8') as handle:
+        for line_number, line in enumerate(handle, 1):
+            if not line.strip():
+                continue
+            location = f"{path}:{line_number}"
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as error:
+                raise WorldFormatError(f"{location}: {error}")
+            yield location, record
+
+def iter_csv_records(path: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    with open(path, newline='', encoding='utf-8') as handle:
+        for row_number, row in enumerate(csv.DictReader(handle), 2):
+            location = f"{path}:{row_number}"
+            if row.get('kind') == 'element':
+                tags = row.get('tags') or ''
+                yield location, {
+                    'kind': 'element',
+                    'element_id': row['element_id'],
+                    'element_type': row['element_type'],
+                    'content': row['content'],
+                    'tags': tags.split(TAG_SEPARATOR) if tags else [],
+                    'usage_count': int(row.get('usage_count') or 0),
+                    'mood_weights': {mood: float(row[mood]) for mood in MOODS_BY_NAME
+                                     if row.get(mood) not in (None, '')},
+                }
+            else:
+                yield location, row
+
+def element_from_record(record: Dict[str, Any], location: str) -> StoryElement:
+    try:
+        mood_weights = {parse_mood(name, location): float(weight)
+                        for name, weight in (record.get('mood_weights') or {}).items()}
+        element = StoryElement(record['element_id'], record['element_type'], record['content'],
+                               tags=list(record.get('tags') or []), mood_weights=mood_weights)
+    except KeyError as error:
+        raise WorldFormatError(f"{location}: element is missing {error}")
+    element.usage_count = int(record.get('usage_count') or 0)
+    return element
+
+def load_world(path: str, graph: KnowledgeGraph = None, format: str = None,
+               on_dangling: str = 'error') -> Tuple[KnowledgeGraph, LoadReport]:
+    # Streams a JSONL/CSV dump into `graph` (a new KnowledgeGraph by default).
+    # Both endpoints of a relationship are checked as it is read, through
+    # `graph.nodes`, so any graph (including the SQLite-backed one) works.
+    # Relationships may point at elements further down the file: those are held
+    # back and added after everything is read, once their endpoints exist.
+    # Endpoints that never show up are dangling; on_dangling is 'error',
+    # 'drop' or 'keep'.
+    if on_dangling not in ('error', 'drop', 'keep'):
+        raise ValueError(f"on_dangling must be 'error', 'drop' or 'keep', not {on_dangling!r}")
+    graph = graph if graph is not None else KnowledgeGraph()
+    records = iter_jsonl_records(path) if (format or detect_format(path)) == 'jsonl' else iter_csv_records(path)
+    report = LoadReport()
+    started = time.perf_counter()
+    nodes = graph.nodes
+    forward = []  # (from_id, to_id, relationship_type) naming an element not read yet
+
+    with graph.deferred_indexing():
+        for location, record in records:
+            kind = record.get('kind')
+            if kind == 'element':
+                graph.add_element(element_from_record(record, location))
+                report.elements += 1
+            elif kind == 'relationship':
+                try:
+                    edge = (record['from_id'], record['to_id'], record['relationship_type'])
+                except KeyError as error:
+                    raise WorldFormatError(f"{location}: relationship is missing {error}")
+                if edge[0] in nodes and edge[1] in nodes:
+                    graph.add_relationship(*edge)
+                    report.relationships += 1
+                else:
+                    forward.append(edge)
+            else:
+                raise WorldFormatError(f"{location}: unknown record kind {kind!r}")
+
+        dangling = [edge for edge in forward if edge[0] not in nodes or edge[1] not in nodes]
+        report.dangling_relationships = len(dangling)
+        if dangling and on_dangling == 'error':
+            examples = ', '.join(f"{from_id} -> {to_id}" for from_id, to_id, _ in dangling[:5])
+            raise WorldFormatError(f"{len(dangling)} relationships point at unknown elements: {examples}")
+        for edge in forward:
+            if on_dangling == 'keep' or (edge[0] in nodes and edge[1] in nodes):
+                graph.add_relationship(*edge)
+                report.relationships += 1
+
+    report.seconds = time.perf_counter() - started
+    return graph, report
+
+def element_record(element: StoryElement) -> Dict[str, Any]:
+    return {
+        'kind': 'element',
+        'element_id': element.element_id,
+        'element_type': element.element_type,
+        'content': element.content,
+        'tags': list(element.tags),
+        'usage_count': element.usage_count,
+        'mood_weights': {mood.value: weight for mood, weight in element.mood_weights.items()},
+    }
+
+def export_world(graph: KnowledgeGraph, path: str, format: str = None) -> Tuple[int, int]:
+    # Writes every element, then every relationship; returns the counts
+    format = format or detect_format(path)
+    elements = relationships = 0
+    with open(path, 'w', newline='', encoding='utf-8') as handle:
+        if format == 'jsonl':
+            for element in graph.nodes.values():
+                handle.write(json.dumps(element_record(element)) + '\n')
+                elements += 1
+            for (from_id, to_id), relationship_type in graph.relationships.items():
+                handle.write(json.dumps({'kind': 'relationship', 'from_id': from_id, 'to_id': to_id,
+                                         'relationship_type': relationship_type}) + '\n')
+                relationships += 1
+        else:
+            writer = csv.DictWriter(handle, fieldnames=CSV_COLUMNS)
+            writer.writeheader()
+            for element in graph.nodes.values():
+                record = element_record(element)
+                row = {column: record[column] for column in
+                       ('kind', 'element_id', 'element_type', 'content', 'usage_count')}
+                row['tags'] = TAG_SEPARATOR.join(record['tags'])
+                row.update(record['mood_weights'])
+                writer.writerow(row)
+                elements += 1
+            for (from_id, to_id), relationship_type in graph.relationships.items():
+                writer.writerow({'kind': 'relationship', 'from_id': from_id, 'to_id': to_id,
+                                 'relationship_type': relationship_type})
+                relationships += 1
+    return elements, relationships
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Import and export story worlds as JSONL or CSV')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('load', help='load a world and report throughput')
+    load.add_argument('path')
+    load.add_argument('--format', choices=['jsonl', 'csv'])
+    load.add_argument('--on-dangling', choices=['error', 'drop', 'keep'], default='error')
+
+    convert = commands.add_parser('convert', help='load a world and write it out again')
+    convert.add_argument('source')
+    convert.add_argument('destination')
+    convert.add_argument('--on-dangling', choices=['error', 'drop', 'keep'], default='error')
+
+    sample = commands.add_parser('export-sample', help='write the built-in sample world')
+    sample.add_argument('path')
+
+    args = parser.parse_args(argv)
+    if args.command == 'load':
+        _, report = load_world(args.path, format=args.format, on_dangling=args.on_dangling)
+        print(report.summary())
+    elif args.command == 'convert':
+        graph, report = load_world(args.source, on_dangling=args.on_dangling)
+        print(report.summary())
+        elements, relationships = export_world(graph, args.destination)
+        print(f"Wrote {elements} elements and {relationships} relationships to {args.destination}")
+    else:
+        elements, relationships = export_world(AdaptiveStorytellingPlatform().knowledge_graph, args.path)
+        print(f"Wrote {elements} elements and {relationships} relationships to {args.path}")
+
+if __name__ == "__main__":
+    main()